@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/corpus.py
+
+ベンチマーク用の合成コーパス (Markdown / HTML / TXT / PDF) を生成する。
+乱数シードを固定しているので、同じ引数なら毎回同じファイルができる。
+
+    python benchmarks/corpus.py bench_corpus --docs 200
+"""
+
+import os
+import random
+import argparse
+from typing import Dict, List
+
+# 日本語の業務文書風の語彙 (PDF は標準フォントで描けるよう英語のみ)
+_JA_WORDS = [
+    "ゼロトラスト", "ブラウザ", "セキュリティ", "経営層", "導入効果", "運用コスト",
+    "情報漏洩", "エンドポイント", "クラウド", "アクセス制御", "可視化", "監査ログ",
+    "生産性", "リスク", "ガバナンス", "従業員", "端末", "ポリシー", "SaaS", "Seraphic",
+    "日立ソリューションズ", "island.io", "拡張機能", "脆弱性", "隔離", "認証",
+]
+_EN_WORDS = [
+    "zero", "trust", "browser", "security", "policy", "endpoint", "cloud", "access",
+    "control", "audit", "risk", "governance", "employee", "device", "isolation",
+    "extension", "vulnerability", "authentication", "Seraphic", "enterprise", "cost",
+    "productivity", "visibility", "compliance", "deployment", "rollout", "session",
+]
+
+# 形式ごとの割合 (合計 1.0)
+FORMAT_MIX = {"md": 0.3, "html": 0.25, "txt": 0.25, "pdf": 0.2}
+
+
+def _sentence(rng: random.Random, words: List[str], ja: bool) -> str:
+    picked = [rng.choice(words) for _ in range(rng.randint(6, 14))]
+    if ja:
+        return "、".join("".join(picked[i:i + 3]) for i in range(0, len(picked), 3)) + "。"
+    return " ".join(picked).capitalize() + "."
+
+
+def _paragraphs(rng: random.Random, n_chars: int, ja: bool = True) -> List[str]:
+    words = _JA_WORDS if ja else _EN_WORDS
+    paras, total = [], 0
+    while total < n_chars:
+        para = " ".join(_sentence(rng, words, ja) for _ in range(rng.randint(3, 7)))
+        paras.append(para)
+        total += len(para)
+    return paras
+
+
+def _escape_pdf(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str, pages: List[List[str]]):
+    """1ページ = 行のリスト。Helvetica で描画する最小限の PDF を書き出す"""
+    objs: List[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for lines in pages:
+        ops = " ".join(f"({_escape_pdf(line)}) '" for line in lines)
+        content = f"BT /F1 10 Tf 40 800 Td 12 TL {ops} ET".encode("latin-1", "replace")
+        objs.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        objs.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objs)
+        )
+        kids.append(len(objs))
+    objs[1] = (b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % k for k in kids)
+               + b"] /Count %d >>" % len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    out += b"".join(b"%010d 00000 n \n" % off for off in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(bytes(out))
+
+
+def _wrap(text: str, width: int = 90) -> List[str]:
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}".strip()
+    if line:
+        lines.append(line)
+    return lines
+
+
+def generate_corpus(out_dir: str, n_docs: int = 200, seed: int = 0,
+                    min_chars: int = 1000, max_chars: int = 12000,
+                    max_pdf_pages: int = 40) -> Dict[str, int]:
+    """out_dir に n_docs 件の文書を書き出し、形式ごとの件数を返す"""
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    formats = list(FORMAT_MIX)
+    weights = [FORMAT_MIX[f] for f in formats]
+    counts = {f: 0 for f in formats}
+
+    for i in range(n_docs):
+        fmt = rng.choices(formats, weights)[0]
+        counts[fmt] += 1
+        sub = os.path.join(out_dir, f"group{i % 8}")
+        os.makedirs(sub, exist_ok=True)
+        path = os.path.join(sub, f"doc{i:05d}.{fmt}")
+        title = f"資料 {i}: {rng.choice(_JA_WORDS)}と{rng.choice(_JA_WORDS)}"
+
+        if fmt == "pdf":
+            # 1ページ約 60 行。ページ数の多いパンフレットも混ぜる
+            n_pages = rng.randint(1, max_pdf_pages)
+            pages = [_wrap(" ".join(_paragraphs(rng, 3000, ja=False)))[:60]
+                     for _ in range(n_pages)]
+            write_pdf(path, pages)
+            continue
+
+        paras = _paragraphs(rng, rng.randint(min_chars, max_chars))
+        if fmt == "md":
+            body = f"# {title}\n\n" + "\n\n".join(
+                (f"## 節 {n}\n\n{p}" if n % 3 == 0 else p) for n, p in enumerate(paras)
+            )
+        elif fmt == "html":
+            body = (f"<html><head><title>{title}</title><style>p {{ margin: 0 }}</style>"
+                    f"<script>var x = 1;</script></head><body><h1>{title}</h1>"
+                    + "".join(f"<p>{p}</p>" for p in paras) + "</body></html>")
+        else:
+            body = "\n\n".join(paras)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(body)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic benchmark corpus")
+    parser.add_argument("out_dir")
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-pdf-pages", type=int, default=40)
+    args = parser.parse_args()
+    counts = generate_corpus(args.out_dir, args.docs, args.seed,
+                             max_pdf_pages=args.max_pdf_pages)
+    print(f"✓ {args.docs} documents -> {args.out_dir} {counts}")
+
+
+if __name__ == "__main__":
+    main()
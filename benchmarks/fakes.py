@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/fakes.py
+
+オフラインでベンチマークを回すための代替部品。
+- FakeEmbedder: SentenceTransformer 互換の決定的な埋め込み (文字 3-gram の feature hashing)
+  似た文字列は似たベクトルになるので、検索結果もそれらしくなる
+- StubGeminiServer: Gemini REST API のスタブ
+  (batchEmbedContents / generateContent / streamGenerateContent の SSE)
+  batchEmbedContents は error_rate の割合で 429 / 503 を返せる (再試行・バックオフの確認用)
+"""
+
+import json
+import time
+import zlib
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import numpy as np
+
+
+class FakeEmbedder:
+    """SentenceTransformer.encode と同じ呼び出し方ができる決定的な埋め込み"""
+
+    def __init__(self, dim: int = 1024, ngram: int = 3):
+        self.dim = dim
+        self.ngram = ngram
+
+    def _embed_one(self, text: str, out: np.ndarray):
+        n = self.ngram
+        grams = [text[i:i + n] for i in range(max(1, len(text) - n + 1))]
+        h = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams),
+                        dtype=np.uint32, count=len(grams))
+        # 下位ビットで次元、最上位ビットで符号を決める
+        signs = 1.0 - 2.0 * (h >> 31).astype(np.float32)
+        np.add.at(out, h % self.dim, signs)
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, show_progress_bar: bool = False, **_):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            self._embed_one(text, out[i])
+        if normalize_embeddings:
+            norms = np.linalg.norm(out, axis=1, keepdims=True)
+            out /= np.where(norms == 0, 1.0, norms)
+        return out[0] if single else out
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_StubHTTPServer"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer_tokens(self) -> List[str]:
+        return [f"回答{i} " for i in range(self.server.tokens)]
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?", 1)[0]
+        stub = self.server
+
+        if path.endswith(":batchEmbedContents"):
+            if stub.should_fail():
+                headers = {}
+                if stub.retry_after is not None:
+                    headers["Retry-After"] = str(stub.retry_after)
+                self._send_json({"error": {"code": stub.error_status, "message": "stub error"}},
+                                stub.error_status, headers)
+                return
+            texts = [r["content"]["parts"][0]["text"] for r in request.get("requests", [])]
+            time.sleep(stub.embed_latency)
+            vectors = stub.embedder.encode(texts, normalize_embeddings=True)
+            self._send_json({"embeddings": [{"values": v.tolist()} for v in vectors]})
+        elif path.endswith(":generateContent"):
+            time.sleep(stub.first_token_delay + stub.token_delay * stub.tokens)
+            text = "".join(self._answer_tokens())
+            self._send_json({"candidates": [{"content": {"parts": [{"text": text}]}}]})
+        elif path.endswith(":streamGenerateContent"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(stub.first_token_delay)
+            prompt = request["contents"][0]["parts"][0]["text"]
+            for i, token in enumerate(self._answer_tokens(), 1):
+                event = {
+                    "candidates": [{"content": {"parts": [{"text": token}]}}],
+                    # 本物と同じく累計のトークン数 (文字数で代用)
+                    "usageMetadata": {"promptTokenCount": len(prompt), "candidatesTokenCount": i},
+                }
+                data = f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+                time.sleep(stub.token_delay)
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self._send_json({"error": {"code": 404, "message": f"unknown path {path}"}}, 404)
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    embedder: FakeEmbedder
+    tokens: int
+    first_token_delay: float
+    token_delay: float
+    embed_latency: float
+    error_rate: float
+    error_status: int
+    retry_after: Optional[float]
+
+    def init_errors(self, seed: int):
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.embed_requests = 0
+        self.embed_errors = 0
+
+    def should_fail(self) -> bool:
+        """batchEmbedContents の受信を数え、エラーを返す番なら True (乱数は受信順に引く)"""
+        with self._lock:
+            self.embed_requests += 1
+            fail = self._rng.random() < self.error_rate
+            self.embed_errors += fail
+            return fail
+
+
+class StubGeminiServer:
+    """バックグラウンドスレッドで動く Gemini API スタブ (base_url をクライアントに渡す)"""
+
+    def __init__(self, tokens: int = 40, first_token_delay: float = 0.05,
+                 token_delay: float = 0.002, embed_latency: float = 0.0,
+                 embed_dim: int = 768, error_rate: float = 0.0, error_status: int = 429,
+                 retry_after: Optional[float] = None, seed: int = 0,
+                 host: str = "127.0.0.1", port: int = 0):
+        self._httpd = _StubHTTPServer((host, port), _StubHandler)
+        self._httpd.embedder = FakeEmbedder(embed_dim)
+        self._httpd.tokens = tokens
+        self._httpd.first_token_delay = first_token_delay
+        self._httpd.token_delay = token_delay
+        self._httpd.embed_latency = embed_latency
+        # batchEmbedContents のエラー応答 (Retry-After ヘッダーは retry_after 秒, None なら付けない)
+        self._httpd.error_rate = error_rate
+        self._httpd.error_status = error_status
+        self._httpd.retry_after = retry_after
+        self._httpd.init_errors(seed)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def embed_requests(self) -> int:
+        """受信した batchEmbedContents の数 (エラーを返したものを含む)"""
+        return self._httpd.embed_requests
+
+    @property
+    def embed_errors(self) -> int:
+        """エラーを返した batchEmbedContents の数"""
+        return self._httpd.embed_errors
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1beta"
+
+    def start(self) -> "StubGeminiServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "StubGeminiServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/run_benchmarks.py
+
+RAG パイプラインの性能計測 (オフライン・モデルのダウンロード不要)。
+- extraction: 合成コーパスのテキスト抽出 docs/sec (ワーカー数別)
+- build:      scripts/build_rag_index.py の build_index (FakeEmbedder) docs/sec
+- embedding:  ローカル生成器 / Gemini REST クライアント (スタブ) の passages/sec
+- store:      JSON / バイナリ形式の保存・読み込み時間とサイズ
+- search:     1k/10k/100k ベクトルでの各検索構造の p50/p99 レイテンシと recall@10
+- query:      RAGChatbot.search の検索モード別 p50/p99
+- answer:     スタブに対するストリーミング回答の TTFT
+
+結果は JSON で保存し、--compare で2回分を比較できる:
+    python benchmarks/run_benchmarks.py --quick
+    python benchmarks/run_benchmarks.py --compare results/a.json results/b.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import importlib.util
+import multiprocessing
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Sequence
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+from corpus import generate_corpus  # noqa: E402
+from fakes import FakeEmbedder, StubGeminiServer  # noqa: E402
+from rag_gemini import GeminiEmbeddingClient  # noqa: E402
+from rag_pipeline import iter_extracted  # noqa: E402
+from rag_store import dot_scores, load_index, save_index  # noqa: E402
+from rag_vector_index import build_vector_index, top_k_indices  # noqa: E402
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+QUICK_SIZES = (1000, 10000)
+DEFAULT_KINDS = ("brute", "ivf", "hnsw", "int8", "binary")
+# HNSW の構築は純 Python なので、これより大きい件数では計測しない
+HNSW_MAX = 10000
+# JSON 形式の保存・読み込みはこの件数まで (100k 件は数GBになる)
+JSON_MAX = 10000
+DIM = 1024
+QUERIES = 200
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+
+# === 共通 ===
+
+@lru_cache(maxsize=None)
+def _load_local_builder():
+    """scripts/build_rag_index.py を (ルートの同名モジュールと区別して) 読み込む"""
+    path = os.path.join(REPO_ROOT, "scripts", "build_rag_index.py")
+    spec = importlib.util.spec_from_file_location("local_build_rag_index", path)
+    module = importlib.util.module_from_spec(spec)
+    # ワーカープロセスへ関数を渡す (pickle) ために登録しておく
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@lru_cache(maxsize=None)
+def _load_root_builder():
+    import build_rag_index
+    # PDF ライブラリの警告対策で stderr を捨てているので元に戻す
+    sys.stderr = build_rag_index._stderr_backup
+    return build_rag_index
+
+
+def _quiet(verbose: bool):
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def _latency(fn: Callable[[Any], Any], inputs: Sequence[Any], warmup: int = 5) -> Dict[str, float]:
+    for x in inputs[:warmup]:
+        fn(x)
+    times = []
+    for x in inputs:
+        started = time.perf_counter()
+        fn(x)
+        times.append(time.perf_counter() - started)
+    ms = np.array(times) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+    }
+
+
+def _dir_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(path) for f in fs)
+
+
+def _synthetic_vectors(n: int, dim: int, seed: int = 0):
+    """クラスタ構造のある正規化済みベクトルと、その近傍のクエリ"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(8, n // 50), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), n)]
+    vectors += 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.integers(0, n, QUERIES)] + 0.3 * rng.standard_normal(
+        (QUERIES, dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return vectors, queries
+
+
+# === 各計測 ===
+
+def bench_extraction(corpus_dir: str, workers_list: Sequence[int]) -> Dict[str, Any]:
+    root_builder = _load_root_builder()
+    files = []
+    for dirpath, _, filenames in os.walk(corpus_dir):
+        for fn in filenames:
+            ext = os.path.splitext(fn)[1].lower()
+            files.append((os.path.join(dirpath, fn), ext, None))
+    out = {}
+    for workers in workers_list:
+        started = time.perf_counter()
+        chars = sum(len(r[1] or "") for _, r, err in
+                    iter_extracted(root_builder.extract_text, files, workers=workers)
+                    if err is None)
+        sec = time.perf_counter() - started
+        out[f"workers_{workers}"] = {
+            "sec": round(sec, 3),
+            "docs_per_sec": round(len(files) / sec, 2),
+            "chars": chars,
+        }
+    return out
+
+
+def bench_build(corpus_dir: str, work_dir: str, workers: int, verbose: bool) -> Dict[str, Any]:
+    builder = _load_local_builder()
+    n_docs = sum(len(fs) for _, _, fs in os.walk(corpus_dir))
+    # spawn 方式ではファイルパスから読み込んだモジュールを子プロセスで復元できないので、
+    # fork が使えれば fork で起動する (FakeEmbedder なので torch のスレッドは無い)
+    if "fork" in multiprocessing.get_all_start_methods():
+        builder.Config.EXTRACT_START_METHOD = "fork"
+    else:
+        workers = 0
+    builder.Config.EXTRACT_WORKERS = workers
+    out = {}
+    for fmt, name in (("json", "bench_index.json"), ("binary", "bench_index.idx")):
+        builder.Config.OUTPUT_FORMAT = fmt
+        path = os.path.join(work_dir, name)
+        generator = builder.LocalEmbeddingGenerator(model=FakeEmbedder(DIM))
+        started = time.perf_counter()
+        with _quiet(verbose):
+            builder.build_index(corpus_dir, path, generator=generator)
+        sec = time.perf_counter() - started
+        docs, _, _ = load_index(path)
+        out[fmt] = {
+            "sec": round(sec, 3),
+            "docs_per_sec": round(n_docs / sec, 2),
+            "passages": len(docs),
+            "passages_per_sec": round(len(docs) / sec, 2),
+            "bytes": _dir_size(path),
+            "workers": workers,
+            "path": path,
+        }
+    return out
+
+
+def bench_embedding(texts: List[str], stub: StubGeminiServer) -> Dict[str, Any]:
+    builder = _load_local_builder()
+    generator = builder.LocalEmbeddingGenerator(model=FakeEmbedder(DIM))
+    started = time.perf_counter()
+    generator.generate_batch(texts)
+    local_sec = time.perf_counter() - started
+
+    client = GeminiEmbeddingClient("bench", base_url=stub.base_url,
+                                   requests_per_minute=1e6, concurrency=4)
+    started = time.perf_counter()
+    vectors = client.embed(texts)
+    rest_sec = time.perf_counter() - started
+    return {
+        "local_fake": {"passages": len(texts),
+                       "passages_per_sec": round(len(texts) / local_sec, 2)},
+        "rest_stub": {"passages": len(texts),
+                      "passages_per_sec": round(len(texts) / rest_sec, 2),
+                      "requests": client.stats["requests"],
+                      "failed": sum(v is None for v in vectors)},
+    }
+
+
+def bench_store(sizes: Sequence[int], work_dir: str) -> Dict[str, Any]:
+    builder = _load_local_builder()
+    out = {}
+    for n in sizes:
+        vectors, queries = _synthetic_vectors(n, DIM)
+        docs = [{"id": f"d{i}", "title": "t", "source": f"s{i % 100}.md", "offset": 0,
+                 "text": "ゼロトラストブラウザ " * 20, "embedding": vectors[i]}
+                for i in range(n)]
+        row: Dict[str, Any] = {}
+
+        if n <= JSON_MAX:
+            path = os.path.join(work_dir, f"store_{n}.json")
+            started = time.perf_counter()
+            with _quiet(False):
+                builder.save_json({d["id"]: d for d in docs}, path)
+            row["json_save_sec"] = round(time.perf_counter() - started, 4)
+            started = time.perf_counter()
+            load_index(path)
+            row["json_load_sec"] = round(time.perf_counter() - started, 4)
+            row["json_bytes"] = _dir_size(path)
+
+        for dtype in ("float32", "float16"):
+            path = os.path.join(work_dir, f"store_{n}_{dtype}.idx")
+            started = time.perf_counter()
+            save_index(path, docs, "bench", dtype=dtype)
+            row[f"binary_{dtype}_save_sec"] = round(time.perf_counter() - started, 4)
+            started = time.perf_counter()
+            _, mat, _ = load_index(path)
+            row[f"binary_{dtype}_load_sec"] = round(time.perf_counter() - started, 4)
+            started = time.perf_counter()
+            dot_scores(mat, queries[0])
+            row[f"binary_{dtype}_first_scan_sec"] = round(time.perf_counter() - started, 4)
+            row[f"binary_{dtype}_bytes"] = _dir_size(path)
+            del mat
+        out[str(n)] = row
+    return out
+
+
+def bench_search(sizes: Sequence[int], kinds: Sequence[str], k: int = 10) -> Dict[str, Any]:
+    out = {}
+    for n in sizes:
+        vectors, queries = _synthetic_vectors(n, DIM)
+        exact = [set(top_k_indices(vectors @ q, k).tolist()) for q in queries]
+        row = {}
+        for kind in kinds:
+            if kind == "hnsw" and n > HNSW_MAX:
+                row[kind] = {"skipped": f"n > {HNSW_MAX}"}
+                continue
+            started = time.perf_counter()
+            index = build_vector_index(vectors, kind)
+            build_sec = time.perf_counter() - started
+            found = [set(index.search(q, k)[0].tolist()) for q in queries]
+            recall = np.mean([len(a & b) / k for a, b in zip(exact, found)])
+            row[kind] = {
+                "build_sec": round(build_sec, 3),
+                **_latency(lambda q: index.search(q, k), list(queries)),
+                "recall_at_10": round(float(recall), 4),
+                "index_bytes": int(sum(a.nbytes for a in index.to_arrays().values())),
+            }
+        out[str(n)] = row
+    return out
+
+
+def bench_query(index_path: str, stub: StubGeminiServer, verbose: bool) -> Dict[str, Any]:
+    from query_rag import RAGChatbot
+
+    rng = np.random.default_rng(1)
+    words = ["ゼロトラスト", "ブラウザ", "監査ログ", "Seraphic", "導入効果", "情報漏洩",
+             "アクセス制御", "運用コスト", "経営層", "拡張機能"]
+    questions = [f"{a}と{b}の関係は？" for a, b in rng.choice(words, (QUERIES, 2))]
+    with _quiet(verbose):
+        bot = RAGChatbot(index_path, "bench", cache_size=0, api_base=stub.base_url,
+                         embedder=FakeEmbedder(DIM))
+        bot.wait_until_ready()
+    out = {"passages": len(bot.documents)}
+    for mode in ("dense", "hybrid", "prefilter"):
+        out[mode] = _latency(lambda q: bot.search(q, mode=mode), questions)
+
+    started = time.perf_counter()
+    bot.search_batch(questions)
+    out["batch_queries_per_sec"] = round(len(questions) / (time.perf_counter() - started), 2)
+
+    # 回答生成 (ストリーミング) の TTFT と全体時間
+    results = bot.search(questions[0])
+    ttft, total = [], []
+    for q in questions[:20]:
+        timing: Dict[str, float] = {}
+        for _ in bot.generate_answer(q, results, timing):
+            pass
+        ttft.append(timing["ttft"] * 1000)
+        total.append(timing["total"] * 1000)
+    out["answer"] = {
+        "ttft_p50_ms": round(float(np.percentile(ttft, 50)), 3),
+        "total_p50_ms": round(float(np.percentile(total, 50)), 3),
+        **bot.generator.pool.stats,
+    }
+    return out
+
+
+# === 比較 ===
+
+def _flatten(data: Any, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            flat.update(_flatten(value, f"{prefix}.{key}" if prefix else key))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        flat[prefix] = float(data)
+    return flat
+
+
+def compare(old_path: str, new_path: str):
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = _flatten(json.load(f)["results"])
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = _flatten(json.load(f)["results"])
+    print(f"{'metric':<55} {'old':>12} {'new':>12} {'new/old':>8}")
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] else float("nan")
+        print(f"{key:<55} {old[key]:>12.4g} {new[key]:>12.4g} {ratio:>8.2f}")
+
+
+# === 実行 ===
+
+def run(args) -> Dict[str, Any]:
+    sizes = [int(s) for s in args.sizes.split(",")] if args.sizes else (
+        QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    n_docs = args.docs or (40 if args.quick else 200)
+    work_dir = tempfile.mkdtemp(prefix="rag_bench_")
+    results: Dict[str, Any] = {}
+    try:
+        corpus_dir = os.path.join(work_dir, "corpus")
+        counts = generate_corpus(corpus_dir, n_docs, args.seed)
+        results["corpus"] = {"docs": n_docs, "formats": counts, "bytes": _dir_size(corpus_dir)}
+        print(f"Corpus: {n_docs} docs {counts}")
+
+        with StubGeminiServer(first_token_delay=args.ttft_ms / 1000.0) as stub:
+            print("Extraction ...")
+            results["extraction"] = bench_extraction(corpus_dir, sorted({0, args.workers}))
+            print("Build ...")
+            results["build"] = bench_build(corpus_dir, work_dir, args.workers, args.verbose)
+            docs, _, _ = load_index(results["build"]["json"]["path"])
+            print("Embedding ...")
+            results["embedding"] = bench_embedding([d["text"] for d in docs][:2000], stub)
+            print("Query ...")
+            results["query"] = bench_query(results["build"]["json"]["path"], stub, args.verbose)
+        print("Store ...")
+        results["store"] = bench_store([n for n in sizes if n <= args.store_max], work_dir)
+        print("Search ...")
+        results["search"] = bench_search(sizes, args.kinds.split(","))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for fmt in results.get("build", {}).values():
+        fmt.pop("path", None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline RAG benchmarks")
+    parser.add_argument("--quick", action="store_true",
+                        help=f"small corpus and {QUICK_SIZES} vectors only")
+    parser.add_argument("--docs", type=int, default=None, help="synthetic corpus size")
+    parser.add_argument("--sizes", default=None,
+                        help=f"comma separated vector counts (default {DEFAULT_SIZES})")
+    parser.add_argument("--kinds", default=",".join(DEFAULT_KINDS),
+                        help="vector index kinds for the search benchmark")
+    parser.add_argument("--store-max", type=int, default=100000,
+                        help="largest vector count for the save/load benchmark")
+    parser.add_argument("--workers", "-j", type=int, default=max(1, min(4, os.cpu_count() or 1)))
+    parser.add_argument("--ttft-ms", type=float, default=50.0,
+                        help="first token delay of the stub generation endpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", "-o", default=None,
+                        help="result JSON (default: benchmarks/results/bench-<time>.json)")
+    parser.add_argument("--verbose", "-v", action="store_true", help="show builder output")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    started = time.time()
+    results = run(args)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+            "elapsed_sec": round(time.time() - started, 1),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k != "compare"},
+        },
+        "results": results,
+    }
+    out = args.out or os.path.join(
+        RESULTS_DIR, time.strftime("bench-%Y%m%d-%H%M%S.json", time.localtime(started))
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✓ Results written to {out} ({report['meta']['elapsed_sec']}s)")
+
+
+if __name__ == "__main__":
+    main()
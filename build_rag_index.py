@@ -3,26 +3,42 @@
 build_rag_index.py (Safe Mode - Fixed)
 
 ワークスペース内のMarkdown/HTML/TXTファイルを走査してテキストを抽出し、
-簡易RAGインデックス（rag_index.json）を生成します。
-APIレート制限（429エラー）を回避するため、処理ごとに待機時間を設けています。
+パッセージ単位に分割した簡易RAGインデックス（rag_index.json）を生成します。
+Embeddingは複数パッセージをまとめたバッチ要求を並列に送り、
+毎分リクエスト数の上限と429エラー時の指数バックオフでレート制限に対応します。
+抽出結果はファイル内容のハッシュごとにキャッシュし、作り直し時は解析を省略します。
+ほぼ同じ内容のパッセージ (資料の別バージョン等) は Embedding 前に除き、代表に出典だけを記録します。
 """
 
 import os
 import argparse
+import importlib.util
 import json
 import re
 import warnings
 import logging
 import sys
-import time  # 待機用ライブラリ
 from html.parser import HTMLParser  # 【修正】これがないとHTML処理時にクラッシュします
 
-try:
-    import google.generativeai as genai
-
-    HAS_GENAI = True
-except ImportError:
-    HAS_GENAI = False
+from rag_chunker import (
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_CHUNK_SIZE,
+    chunk_document,
+    clean_text,
+)
+from rag_pdf import extract_pdf_text
+from rag_metrics import METRICS
+from rag_pipeline import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, iter_extracted
+from rag_extract_cache import DEFAULT_CACHE_DIR, CachedExtractor, warm_cache
+from rag_dedup import DEFAULT_DEDUP_THRESHOLD, Deduplicator
+from rag_watch import publish
+from rag_gemini import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_REQUESTS_PER_MINUTE,
+    GEMINI_API_BASE,
+    GeminiEmbeddingClient,
+)
 
 warnings.filterwarnings("ignore")
 
@@ -36,15 +52,20 @@ logging.getLogger("pikepdf").setLevel(logging.ERROR)
 _stderr_backup = sys.stderr
 sys.stderr = open(os.devnull, "w")
 
-try:
-    import pdfplumber  # type: ignore
-
-    HAS_PDFPLUMBER = True
-except ImportError:
-    HAS_PDFPLUMBER = False
+# pdfplumber は抽出ワーカー (rag_pdf) が読み込むので、ここでは存在確認のみ
+HAS_PDFPLUMBER = importlib.util.find_spec("pdfplumber") is not None
 
 EXTS = {".md", ".markdown", ".html", ".htm", ".txt", ".pdf"}
 
+# Embeddingモデル
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# チャンク分割しない場合の最大文字数
+MAX_TEXT_LENGTH = 10000
+
+# new_index.html が読むブラウザ用バンドルの場所 (インデックスと同じディレクトリ)
+BUNDLE_DIR = "rag_bundle"
+
 
 class HTMLTextExtractor(HTMLParser):
     def __init__(self):
@@ -76,22 +97,6 @@ def slugify(s):
     return s or "doc"
 
 
-def get_embedding(text, api_key=None):
-    """Gemini Embeddings APIを使用して埋め込みを生成"""
-    if not HAS_GENAI or not api_key:
-        return None
-    try:
-        genai.configure(api_key=api_key)
-        # text-embedding-004 モデルを使用 (推奨)
-        result = genai.embed_content(model="models/text-embedding-004", content=text)
-        return result["embedding"]
-    except Exception as e:
-        sys.stderr = _stderr_backup
-        print(f"      [Error] Embedding failed: {e}")
-        sys.stderr = open(os.devnull, "w")
-        return None
-
-
 def extract_title_from_md(text):
     for line in text.splitlines():
         m = re.match(r"#{1,6}\s*(.+)", line)
@@ -113,30 +118,29 @@ def extract_title_from_html(text):
     return None
 
 
-def extract_text(path, ext):
+def extract_text(path, ext, max_chars=None):
+    """
+    (タイトル, テキスト, ページオフセット) を返す (ページオフセットは PDF のみ)
+    max_chars を指定すると PDF はその文字数が集まった時点で残りのページを読まない
+    """
+    pages = None
     if ext == ".pdf":
         if not HAS_PDFPLUMBER:
-            return None, None
+            return None, None, None
         try:
-            texts = []
-            with pdfplumber.open(path) as pdf:
-                for page_num, page in enumerate(pdf.pages, 1):
-                    t = page.extract_text()
-                    if t:
-                        texts.append(t)
-            if not texts:
-                return os.path.basename(path), None
-            text = " ".join(texts)
+            text, pages = extract_pdf_text(path, max_chars)
+            if not text:
+                return os.path.basename(path), None, None
             title = os.path.basename(path)
         except Exception as e:
             print(f"      PDF ERROR: {e}")
-            return None, None
+            return None, None, None
     else:
         try:
             with open(path, "r", encoding="utf-8", errors="ignore") as f:
                 raw = f.read()
         except Exception:
-            return None, None
+            return None, None, None
 
         if ext in (".html", ".htm"):
             title = extract_title_from_html(raw)
@@ -147,20 +151,47 @@ def extract_text(path, ext):
             title = extract_title_from_md(raw) if ext in (".md", ".markdown") else None
             text = raw
 
-    text = re.sub(r"\s+", " ", text).strip()
-    if len(text) > 10000:
-        text = text[:10000]
+    text = clean_text(text)
     if title:
         title = re.sub(r"\s+", " ", title).strip()
-    return title, text
-
-
-def build_index(root, api_key=None):
-    docs = []
-    root = os.path.abspath(root)
-    print(f"Scanning: {root}")
-    print(f"PDF support: {'enabled' if HAS_PDFPLUMBER else 'disabled'}")
-    print(f"Embedding support: {'enabled' if HAS_GENAI else 'disabled'}\n")
+    return title, text, pages
+
+
+def embed_pending(client, pending, dedup=None, duplicates=None):
+    """
+    溜まったファイルのパッセージをまとめてEmbeddingし、結果を表示
+    Embedding に失敗した代表は、除いていた重複パッセージ (duplicates) の1つに入れ替えて送り直す
+    (重複側の出典が、代表と一緒にインデックスから消えないように)
+    """
+    while pending:
+        texts = [chunk["text"][:2000] for _, _, chunks in pending for chunk in chunks]
+        with METRICS.span("embed"):
+            vectors = iter(client.embed(texts))
+        retry = []
+        for rel, summary, chunks in pending:
+            embedded = 0
+            for chunk in chunks:
+                embedding = next(vectors)
+                if embedding:
+                    chunk["embedding"] = embedding
+                    embedded += 1
+                elif duplicates and duplicates.get(id(chunk)):
+                    dedup.promote(chunk, duplicates[id(chunk)].pop(0))
+                    retry.append(chunk)
+            status = "embedded" if embedded == len(chunks) else "NO EMBEDDING - Error"
+            print(f"  ✓ {rel} ({summary}, {len(chunks)} passages, {status})")
+        METRICS.incr("promoted_duplicates", len(retry))
+        pending = [("(near-duplicates)", "promoted after failed passages", retry)] if retry else []
+
+
+def scan_files(root, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    抽出対象の (フルパス, 内容ハッシュ, 拡張子, 文字数の上限) の一覧
+    (常に全件を作り直すので指紋は取らず、内容ハッシュは None: 抽出キャッシュが1回だけ計算する)
+    """
+    files = []
+    # チャンク分割しない場合、PDF は先頭 MAX_TEXT_LENGTH 文字分のページだけ読む
+    text_budget = MAX_TEXT_LENGTH if chunk_size <= 0 else None
 
     for dirpath, dirnames, filenames in os.walk(root):
         rel_path = os.path.relpath(dirpath, root)
@@ -174,34 +205,91 @@ def build_index(root, api_key=None):
             if ext not in EXTS:
                 continue
 
-            full = os.path.join(dirpath, fn)
-            rel = os.path.relpath(full, root).replace("\\", "/")
+            files.append((os.path.join(dirpath, fn), None, ext, text_budget))
+    return files
 
-            # テキスト抽出
-            title, text = extract_text(full, ext)
-            if not text:
-                print(f"  ✗ {rel} (empty)")
-                continue
 
-            doc_id = slugify(rel)
-            doc = {"id": doc_id, "title": title or name, "source": rel, "text": text}
+def build_index(root, client=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                chunk_overlap=DEFAULT_CHUNK_OVERLAP, workers=DEFAULT_WORKERS,
+                extract_cache=DEFAULT_CACHE_DIR, dedup_threshold=DEFAULT_DEDUP_THRESHOLD):
+    docs = []
+    root = os.path.abspath(root)
+    print(f"Scanning: {root}")
+    print(f"PDF support: {'enabled' if HAS_PDFPLUMBER else 'disabled'}")
+    print(f"Embedding support: {'enabled' if client else 'disabled (no API key)'}")
+    print(f"Extract workers: {workers}")
+    print(f"Extraction cache: {extract_cache or 'disabled'}")
+    print(f"Near-duplicate removal: "
+          f"{f'Jaccard >= {dedup_threshold}' if dedup_threshold else 'disabled'}\n")
+    dedup = Deduplicator(dedup_threshold) if dedup_threshold else None
+    # 代表の id() -> 除いた重複パッセージ (代表の Embedding に失敗したら繰り上げる)
+    duplicates = {}
+
+    # Embedding待ちのファイル (rel, 文字数などの表示, パッセージ)
+    pending = []
+    pending_count = 0
+    flush_size = client.batch_size * client.concurrency if client else 0
+
+    # テキスト抽出 (プロセスプールで並列実行、完了順に処理、解析済みの内容はキャッシュから読む)
+    extractor = CachedExtractor(extract_text, extract_cache, "build_rag_index")
+    for (full, _, ext, _), result, error in iter_extracted(
+        extractor, scan_files(root, chunk_size), workers=workers, queue_size=DEFAULT_QUEUE_SIZE
+    ):
+        rel = os.path.relpath(full, root).replace("\\", "/")
+        name = os.path.splitext(os.path.basename(full))[0]
+        if error is not None:
+            print(f"  ✗ {rel} (extract failed: {error})")
+            continue
+        (title, text, pages), cached = result
+        if cached:
+            METRICS.incr("extract_cache_hits")
+        if not text:
+            print(f"  ✗ {rel} (empty)")
+            continue
+        METRICS.incr("documents")
+        METRICS.incr("bytes", os.path.getsize(full))
+        METRICS.incr("chars", len(text))
 
-            # Embedding生成（APIキーがある場合）
-            if api_key and HAS_GENAI:
-                # ★修正ポイント: レート制限回避のため10秒待機
-                print(f"  ... Generating embedding for {rel} (waiting 10s)...")
-                time.sleep(10)
+        doc_id = slugify(rel)
+        doc = {"id": doc_id, "title": title or name, "source": rel, "text": text}
 
-                embedding = get_embedding(text[:2000], api_key)
-                if embedding:
-                    doc["embedding"] = embedding
-                    print(f"  ✓ {rel} ({len(text)} chars, embedded)")
-                else:
-                    print(f"  ✓ {rel} ({len(text)} chars, NO EMBEDDING - Error)")
-            else:
-                print(f"  ✓ {rel} ({len(text)} chars)")
+        if chunk_size > 0:
+            chunks = chunk_document(doc, chunk_size, chunk_overlap, pages)
+        else:
+            doc["text"] = text[:MAX_TEXT_LENGTH]
+            if pages:
+                doc["page"] = pages[0][1]
+            chunks = [doc]
+
+        METRICS.incr("passages", len(chunks))
+        n_passages = len(chunks)
+        if dedup:
+            # 既出のパッセージとほぼ同じものは Embedding せず、代表の alternates に出典を記録
+            with METRICS.span("dedup"):
+                chunks = dedup.filter(chunks, duplicates if client else None)
+            METRICS.incr("duplicates", n_passages - len(chunks))
+        skipped = f", {n_passages - len(chunks)} duplicates" if len(chunks) < n_passages else ""
+        # Embedding生成（APIキーがある場合）: 並列バッチ1回分が溜まったら送信
+        if client:
+            pending.append((rel, f"{len(text)} chars{skipped}", chunks))
+            pending_count += len(chunks)
+            if pending_count >= flush_size:
+                embed_pending(client, pending, dedup, duplicates)
+                pending, pending_count = [], 0
+        else:
+            print(f"  ✓ {rel} ({len(text)} chars{skipped}, {len(chunks)} passages)")
 
-            docs.append(doc)
+        docs.extend(chunks)
+
+    if pending:
+        embed_pending(client, pending, dedup, duplicates)
+    if dedup:
+        print(f"\nNear-duplicates: {dedup.duplicates} of {dedup.passages} passages "
+              f"kept only as alternate sources")
+    if client:
+        stats = client.stats
+        print(f"\nEmbedding requests: {stats['requests']} "
+              f"(rate limited: {stats['rate_limited']}, failed batches: {stats['failed_batches']})")
 
     return docs
 
@@ -210,15 +298,185 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--root", "-r", default=".", help="root path to scan")
     parser.add_argument(
-        "--out", "-o", default="rag_index.json", help="output json file"
+        "--out", "-o", default="rag_index.json",
+        help="output json file (or .idx directory for binary format)"
     )
     parser.add_argument("--api-key", "-k", default=None, help="Gemini API key")
+    parser.add_argument(
+        "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+        help="passage size in chars (0 = one entry per file)"
+    )
+    parser.add_argument(
+        "--chunk-overlap", type=int, default=DEFAULT_CHUNK_OVERLAP,
+        help="overlap between passages in chars"
+    )
+    parser.add_argument(
+        "--format", choices=["json", "binary"], default=None,
+        help="index format (default: binary if --out ends with .idx)"
+    )
+    parser.add_argument(
+        "--dtype", choices=["float32", "float16"], default="float32",
+        help="vector dtype for binary format"
+    )
+    parser.add_argument(
+        "--shards", type=int, default=1,
+        help="binary format: split the index into N shards searched in parallel"
+    )
+    parser.add_argument(
+        "--workers", "-j", type=int, default=DEFAULT_WORKERS,
+        help="extraction worker processes (0 = main process only)"
+    )
+    parser.add_argument(
+        "--extract-cache", default=DEFAULT_CACHE_DIR,
+        help="directory for cached extracted text, keyed by file content hash"
+    )
+    parser.add_argument(
+        "--no-extract-cache", action="store_true",
+        help="always re-extract text (do not read or write the extraction cache)"
+    )
+    parser.add_argument(
+        "--extract-only", action="store_true",
+        help="only extract text into the cache (no embedding, no index written)"
+    )
+    parser.add_argument(
+        "--dedup-threshold", type=float, default=DEFAULT_DEDUP_THRESHOLD,
+        help="drop passages whose character 5-gram Jaccard similarity to an earlier one "
+             "is at least this (recorded as alternate sources)"
+    )
+    parser.add_argument(
+        "--no-dedup", action="store_true",
+        help="embed every passage, including near-duplicates"
+    )
+    parser.add_argument(
+        "--rpm", type=float, default=DEFAULT_REQUESTS_PER_MINUTE,
+        help="max embedding requests per minute"
+    )
+    parser.add_argument(
+        "--embed-batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="passages per embedding request (max 100)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+        help="max concurrent embedding requests"
+    )
+    parser.add_argument(
+        "--api-base", default=GEMINI_API_BASE,
+        help="Gemini API base URL (e.g. a local stub server for testing)"
+    )
+    parser.add_argument(
+        "--ann", choices=["auto", "none", "brute", "ivf", "hnsw", "int8", "binary"], default="auto",
+        help="vector search structure saved next to the index"
+    )
+    parser.add_argument(
+        "--no-lexical", action="store_true",
+        help="do not build the character n-gram (BM25) index"
+    )
+    parser.add_argument(
+        "--bundle", default=None, metavar="DIR",
+        help="also export a browser search bundle for new_index.html (e.g. rag_bundle); "
+             "an existing rag_bundle next to --out is refreshed on every build"
+    )
+    parser.add_argument(
+        "--bundle-dtype", choices=["int8", "float16"], default="int8",
+        help="vector dtype of the browser bundle"
+    )
+    parser.add_argument(
+        "--metrics", default=None, metavar="FILE",
+        help="write a JSON summary of stage timings and counters ('-' = stderr)"
+    )
     args = parser.parse_args()
-
-    docs = build_index(args.root, args.api_key)
-    with open(args.out, "w", encoding="utf-8") as f:
-        json.dump(docs, f, ensure_ascii=False, indent=2)
-    print(f"\n✓ Found {len(docs)} documents, writing {args.out}")
+    if args.metrics:
+        METRICS.enable()
+    try:
+        run(args)
+    finally:
+        # ライブラリの警告用に抑制していた標準エラー出力を戻してから書き出す
+        sys.stderr = _stderr_backup
+        METRICS.dump(args.metrics)
+
+
+def run(args):
+    extract_cache = None if args.no_extract_cache else args.extract_cache
+    if args.extract_only:
+        if not extract_cache:
+            print("Error: --extract-only needs the extraction cache")
+            sys.exit(1)
+        extractor = CachedExtractor(extract_text, extract_cache, "build_rag_index")
+        counts = warm_cache(extractor, scan_files(os.path.abspath(args.root), args.chunk_size),
+                            args.workers)
+        print(f"\n✓ Extraction cache {extract_cache}: {counts['extracted']} extracted, "
+              f"{counts['cached']} already cached, {counts['empty']} empty, "
+              f"{counts['failed']} failed")
+        return
+
+    client = None
+    if args.api_key:
+        client = GeminiEmbeddingClient(
+            args.api_key,
+            model=EMBEDDING_MODEL,
+            base_url=args.api_base,
+            batch_size=args.embed_batch_size,
+            requests_per_minute=args.rpm,
+            concurrency=args.concurrency,
+        )
+
+    docs = build_index(
+        args.root, client, args.chunk_size, args.chunk_overlap, args.workers, extract_cache,
+        None if args.no_dedup else args.dedup_threshold,
+    )
+    out_format = args.format or ("binary" if args.out.endswith(".idx") else "json")
+    # ANN などを書き足す保存先 (バイナリ形式は新しい版ディレクトリ、公開は最後)
+    saved, version = args.out, None
+    if out_format == "binary":
+        from rag_store import save_index  # numpy が必要なため遅延インポート
+
+        with METRICS.span("save"):
+            manifest = save_index(args.out, docs, EMBEDDING_MODEL, dtype=args.dtype,
+                                  shards=args.shards, publish=False)
+        version = manifest["build"]
+        saved = os.path.join(args.out, version)
+        print(f"\n✓ Found {len(docs)} passages, wrote {manifest['count']} vectors to {saved}")
+    else:
+        with METRICS.span("save"), open(args.out, "w", encoding="utf-8") as f:
+            json.dump(docs, f, ensure_ascii=False, indent=2)
+        print(f"\n✓ Found {len(docs)} passages, writing {args.out}")
+
+    if args.ann == "none" or any("embedding" in d for d in docs):
+        from rag_vector_index import build_ann_for_index
+
+        with METRICS.span("build_ann"):
+            ann_path = build_ann_for_index(saved, args.ann)
+        if ann_path:
+            print(f"✓ ANN index ({args.ann}) written to {ann_path}")
+
+    if not args.no_lexical and any("embedding" in d for d in docs):
+        from rag_lexical import build_lexical_for_index
+
+        with METRICS.span("build_lexical"):
+            lex_path = build_lexical_for_index(saved)
+        if lex_path:
+            print(f"✓ Lexical index written to {lex_path}")
+
+    # --bundle が無くても new_index.html が読む場所に前回のバンドルがあれば作り直す
+    # (古いバンドルをページが使い続けないように。ベクトルが無くなったら削除)
+    bundle_dir = args.bundle or os.path.join(os.path.dirname(args.out.rstrip("/\\")), BUNDLE_DIR)
+    if args.bundle or os.path.isdir(bundle_dir):
+        from rag_bundle import export_bundle, read_bundle_manifest, remove_bundle
+
+        previous = read_bundle_manifest(bundle_dir)
+        if not any("embedding" in d for d in docs):
+            if previous is not None:
+                remove_bundle(bundle_dir)
+                print(f"✓ Removed browser bundle {bundle_dir} (index has no vectors)")
+        elif args.bundle or previous is not None:
+            dtype = args.bundle_dtype if args.bundle else previous.get("dtype", args.bundle_dtype)
+            with METRICS.span("export_bundle"):
+                bundle = export_bundle(saved, bundle_dir, dtype)
+            print(f"✓ Browser bundle ({bundle['count']} vectors, {bundle['dtype']}) "
+                  f"written to {bundle_dir}")
+
+    # 起動中の検索プロセス (query_rag.py / rag_server.py) に読み込み直させる
+    publish(args.out, version)
 
 
 if __name__ == "__main__":
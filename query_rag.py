@@ -4,14 +4,59 @@
 query_rag.py (Hybrid RAG)
 
 1. ユーザーの質問をローカルモデル(E5)でベクトル化
-2. ローカルのrag_index_local.jsonから関連文書を検索 (Retrieve)
+2. ローカルのrag_index_local.jsonから関連パッセージを検索 (Retrieve)
 3. Gemini APIに検索結果を渡して回答を生成 (Generate)
+
+ビルダー (scripts/build_rag_index.py --watch など) が新しいインデックスを公開すると、
+次の質問の前に読み込み直す (再起動は不要)。
 """
 
+import time
+
+# 起動時間の計測用 (--profile-startup)
+_T0 = time.perf_counter()
+
+import os
+import sys
 import json
 import argparse
+import threading
+import importlib.util
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import numpy as np
 
+from rag_cache import (
+    DEFAULT_ANSWER_CACHE_SIZE,
+    DEFAULT_ANSWER_SIMILARITY,
+    DEFAULT_ANSWER_TTL,
+    DEFAULT_QUERY_CACHE_SIZE,
+    AnswerCache,
+    QueryCache,
+)
+from rag_context import DEFAULT_CONTEXT_TOKENS, pack_context
+from rag_gemini import GEMINI_API_BASE, GeminiGenerationClient
+from rag_lexical import load_lexical_index, rrf_fuse
+from rag_metrics import METRICS
+from rag_shard import ShardedIndex
+from rag_store import (
+    batch_dot_scores,
+    index_version,
+    is_sharded_index,
+    load_index,
+    resolve_index,
+)
+from rag_vector_index import (
+    BruteForceIndex,
+    load_vector_index,
+    normalized_vectors,
+    top_k_indices,
+)
+from rag_watch import published_token
+
+_IMPORT_SEC = time.perf_counter() - _T0
+
 # === 設定 ===
 # 検索用ローカルモデル (インデックス作成時と同じものを使用)
 EMBEDDING_MODEL_NAME = "intfloat/multilingual-e5-large"
@@ -21,78 +66,470 @@ QUERY_PREFIX = "query: "
 # 回答生成用クラウドモデル
 GENERATION_MODEL_NAME = "gemini-1.5-flash"
 
-try:
-    import google.generativeai as genai
-    from sentence_transformers import SentenceTransformer # type: ignore
-    from sklearn.metrics.pairwise import cosine_similarity
-except ImportError:
+# プロンプトに渡すパッセージ数と1件あたりの上限文字数
+# (実際に入れるパッセージは rag_context で重複を除きトークン数の上限内で選ぶ)
+TOP_K = 5
+MAX_PASSAGE_CHARS = 2000
+
+# 検索モード: dense (ベクトルのみ) / hybrid (BM25とRRF統合) / prefilter (BM25候補のみベクトル採点)
+RETRIEVAL_MODES = ("dense", "hybrid", "prefilter")
+DEFAULT_RETRIEVAL_MODE = "hybrid"
+# RRF で統合する各リストの長さ (top_k の倍数) と事前絞り込みの候補数
+FUSION_DEPTH = 4
+PREFILTER_CANDIDATES = 200
+
+# バッチモード: 同時に実行する回答生成の数
+DEFAULT_BATCH_PARALLEL = 4
+
+# 常駐サービスがインデックスの公開を確認する間隔 (秒)
+DEFAULT_RELOAD_INTERVAL = 5.0
+
+# sentence_transformers (torch) の読み込みは数秒かかるため、ここでは存在確認だけ行い
+# 実際のインポートはバックグラウンドのモデル読み込み時に行う
+if importlib.util.find_spec("sentence_transformers") is None:
     print("Error: 必要なライブラリが見つかりません。")
-    print("pip install google-generativeai sentence-transformers scikit-learn")
+    print("pip install sentence-transformers")
     exit(1)
 
 
-class RAGChatbot:
-    def __init__(self, index_path, api_key):
-        # 1. ローカル検索モデルの準備
-        print(f"Loading local search model: {EMBEDDING_MODEL_NAME}...")
-        self.embedder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+class _SwapLock:
+    """検索 (同時に複数) とインデックスの差し替え (排他) の同期。差し替えを待つ間は新しい検索を止める"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._swapping = False
 
-        # 2. インデックスの読み込み
-        print(f"Loading index from {index_path}...")
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._swapping:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            while self._swapping:
+                self._cond.wait()
+            self._swapping = True
+            while self._readers:
+                self._cond.wait()
         try:
-            with open(index_path, "r", encoding="utf-8") as f:
-                self.documents = json.load(f)
+            yield
+        finally:
+            with self._cond:
+                self._swapping = False
+                self._cond.notify_all()
+
+
+def cite(doc):
+    """出典の表示 (PDF はページ番号、それ以外は文字オフセット)"""
+    if doc.get("page"):
+        return f"{doc['source']}, p.{doc['page']}"
+    return f"{doc['source']}, offset {doc.get('offset', 0)}"
 
-            # 検索を高速化するためにベクトルだけ抽出してnumpy配列にする
-            self.doc_vectors = np.array([doc["embedding"] for doc in self.documents])
-            print(f"Loaded {len(self.documents)} documents.")
 
-        except FileNotFoundError:
+def score_fields(result):
+    """
+    出力用のスコア: "score" は常にコサイン類似度
+    hybrid / prefilter では順位付けに使った RRF スコア (0.01-0.03 程度) を "rrf" に分けて出す
+    """
+    fields = {"score": round(result["similarity"], 6)}
+    if result["rrf"] is not None:
+        fields["rrf"] = round(result["rrf"], 6)
+    return fields
+
+
+class RAGChatbot:
+    def __init__(self, index_path, api_key, nprobe=None, ef=None, rescore=None,
+                 cache_size=DEFAULT_QUERY_CACHE_SIZE, cache_path=None,
+                 mode=DEFAULT_RETRIEVAL_MODE, api_base=GEMINI_API_BASE, embedder=None,
+                 shard_workers=None, context_tokens=DEFAULT_CONTEXT_TOKENS,
+                 answer_cache_size=DEFAULT_ANSWER_CACHE_SIZE, answer_cache_path=None,
+                 answer_similarity=DEFAULT_ANSWER_SIMILARITY, answer_ttl=DEFAULT_ANSWER_TTL):
+        if not os.path.exists(index_path):
             print(
                 f"Error: {index_path} が見つかりません。先に build_rag_index_final.py を実行してください。"
             )
             exit(1)
 
+        self.index_path = index_path
+        self.nprobe = nprobe
+        self.ef = ef
+        self.rescore = rescore
+        self.shard_workers = shard_workers
+        self.context_tokens = context_tokens
+        self._requested_mode = mode
+        self._cache_size = cache_size
+        self._cache_path = cache_path
+        self._answer_cache_args = (answer_cache_size, answer_cache_path,
+                                   answer_similarity, answer_ttl)
+        # フェーズ名 -> 所要時間 (秒)
+        self.startup_profile = {}
+        self._ready = False
+        # 質問文 -> クエリベクトル の関数 (HTTP サービスがバッチ化したものに差し替える)
+        self.query_encoder = None
+        # 読み込んだインデックスの公開番号 (ビルダーが公開していなければ None)
+        self.published = None
+        self._swap = _SwapLock()
+
+        # 1. ローカル検索モデル と 2. インデックス をバックグラウンドで並行して読み込む
+        # (プロンプトはすぐに表示し、最初の検索時に完了を待つ)
+        # (embedder に読み込み済みのモデルを渡した場合はそれを使う)
+        loader = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rag-load")
+        self._model_future = loader.submit(lambda: embedder or self._load_model())
+        self._index_future = loader.submit(self._load_index)
+        loader.shutdown(wait=False)
+
         # 3. Gemini APIの準備 (回答生成用)
-        genai.configure(api_key=api_key)
-        self.generator = genai.GenerativeModel(GENERATION_MODEL_NAME)
-
-    def search(self, query, top_k=3):
-        """質問に関連するドキュメントを検索する (Retrieve)"""
-        # E5モデル用にプレフィックスを付与してベクトル化
-        query_text = QUERY_PREFIX + query
-        query_vector = self.embedder.encode(query_text, convert_to_numpy=True).reshape(
-            1, -1
+        self.generator = GeminiGenerationClient(
+            api_key, model=GENERATION_MODEL_NAME, base_url=api_base
         )
 
-        # コサイン類似度で検索
-        similarities = cosine_similarity(query_vector, self.doc_vectors)[0]
-
-        # スコアが高い順にインデックスを取得
-        top_indices = similarities.argsort()[-top_k:][::-1]
+    @contextmanager
+    def _phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_profile[name] = time.perf_counter() - started
+
+    def _load_model(self):
+        with METRICS.span("load_model"):
+            return self._load_model_phases()
+
+    def _load_model_phases(self):
+        with self._phase("import sentence_transformers"):
+            from sentence_transformers import SentenceTransformer  # type: ignore
+        with self._phase("load model"):
+            model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        # ユーザーが質問を入力している間に1回エンコードして初回の遅延を消す
+        with self._phase("warm-up encode"):
+            model.encode(QUERY_PREFIX + "warm-up", convert_to_numpy=True,
+                         normalize_embeddings=True)
+        return model
+
+    def _load_index(self):
+        with METRICS.span("load"):
+            state = self._open_index()
+            # 質問文 -> クエリベクトル・検索結果のキャッシュ
+            # (読み込み直しでは作り直さず、版が変わったら invalidate で空にする)
+            with self._phase("load query cache"):
+                state["query_cache"] = QueryCache(self._cache_size, state["version"],
+                                                  self._cache_path)
+                # 言い回しだけ違う質問の回答 (同じ参考資料の場合のみ再利用)
+                size, path, similarity, ttl = self._answer_cache_args
+                state["answer_cache"] = AnswerCache(size, state["version"], path, similarity, ttl)
+            vars(self).update(state)
+
+    def _open_index(self):
+        """インデックス一式を読み込んで属性名 -> 値 を返す (読み込み直しでは一度に差し替える)"""
+        state = {"published": published_token(self.index_path)}
+        # 公開中の版のディレクトリ (読み込みの途中で次の版が公開されても混ざらない)
+        index_dir = resolve_index(self.index_path)
+        with self._phase("load index"):
+            # バイナリ形式 (.idx) ならベクトルはメモリマップのまま使う
+            documents, vectors, manifest = load_index(index_dir)
+            doc_vectors = normalized_vectors(vectors, manifest)
+            state.update(documents=documents, manifest=manifest, doc_vectors=doc_vectors)
+
+        # 検索構造 (ビルダーが保存したANN、無ければ全件走査)
+        # シャード分割されていればシャードごとの検索をワーカープロセスに振り分ける
+        with self._phase("load vector index"):
+            if is_sharded_index(index_dir):
+                state["vector_index"] = ShardedIndex(index_dir, self.shard_workers)
+            else:
+                state["vector_index"] = load_vector_index(
+                    index_dir, doc_vectors
+                ) or BruteForceIndex(doc_vectors)
+
+        # 文字 n-gram の転置インデックス (無ければベクトル検索のみ)
+        with self._phase("load lexical index"):
+            lexical_index = load_lexical_index(index_dir, len(documents))
+            state["lexical_index"] = lexical_index
+            state["mode"] = self._requested_mode if lexical_index is not None else "dense"
+
+        # キャッシュの照合に使う版
+        state["version"] = index_version(index_dir)
+        return state
+
+    def reload_if_published(self):
+        """
+        ビルダーが新しいインデックスを公開していれば読み込み直す (読み込み直したら True)
+        読み込みの間は今のインデックスで検索を続け、差し替えの瞬間だけ検索と排他にする
+        """
+        if not self.is_ready:
+            return False
+        token = published_token(self.index_path)
+        if token is None or token == self.published:
+            return False
+        old_index = self.vector_index
+        try:
+            with METRICS.span("reload"):
+                state = self._open_index()
+        except Exception as e:
+            # 書き込みと重なった場合などは、次の確認で再試行する
+            print(f"Warning: failed to reload {self.index_path}: {e}", file=sys.stderr)
+            return False
+        with self._swap.exclusive():
+            vars(self).update(state)
+            # 前の版の検索結果・回答を返さないよう空にする (ヒット数などの統計は引き継ぐ)
+            self.query_cache.invalidate(self.version)
+            self.answer_cache.invalidate(self.version)
+        if isinstance(old_index, ShardedIndex):
+            old_index.close()
+        METRICS.incr("index_reloads")
+        print(f"Reloaded {len(self.documents)} passages from {self.index_path}.",
+              file=sys.stderr)
+        return True
+
+    @property
+    def embedder(self):
+        return self._model_future.result()
+
+    def wait_until_ready(self):
+        """バックグラウンドの読み込み完了を待つ (初回のみ概要を表示)"""
+        if self._ready:
+            return
+        self._index_future.result()
+        self._model_future.result()
+        self._ready = True
+
+        print(f"Loaded {len(self.documents)} passages. "
+              f"Vector search: {self.vector_index.kind}, retrieval mode: {self.mode}")
+        if self.manifest["model"] != EMBEDDING_MODEL_NAME:
+            print(
+                f"Warning: index was built with {self.manifest['model']}, "
+                f"but queries use {EMBEDDING_MODEL_NAME}."
+            )
+        if len(self.query_cache):
+            print(f"Query cache: {len(self.query_cache)} entries restored.")
+        if len(self.answer_cache):
+            print(f"Answer cache: {len(self.answer_cache)} entries restored.")
+
+    @property
+    def is_ready(self):
+        return self._model_future.done() and self._index_future.done()
+
+    def print_startup_profile(self):
+        print("Startup profile:")
+        print(f"  {'module imports':<30} {_IMPORT_SEC:8.3f}s")
+        for name, sec in self.startup_profile.items():
+            print(f"  {name:<30} {sec:8.3f}s")
+
+    def encode_queries(self, queries):
+        """E5モデル用にプレフィックスを付けて複数の質問をまとめてベクトル化"""
+        with METRICS.span("encode"):
+            return self.embedder.encode(
+                [QUERY_PREFIX + q for q in queries],
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
 
+    def _encode_one(self, query):
+        """1件の質問をベクトル化 (HTTP サービスではバッチ化したエンコーダを使う)"""
+        if self.query_encoder is not None:
+            with METRICS.span("encode"):
+                return self.query_encoder(query)
+        return self.encode_queries([query])[0]
+
+    def _retrieve(self, query, query_vector, top_k, mode, dense_scores=None, **params):
+        """
+        検索モードに応じて (ID, スコア) を返す
+        dense_scores (全パッセージとの類似度) が渡された場合はそれを使う (バッチモード)
+        """
+        def dense_search(k):
+            if dense_scores is None:
+                return self.vector_index.search(query_vector, k, **params)
+            ids = top_k_indices(dense_scores, k)
+            return ids, dense_scores[ids]
+
+        if mode == "dense" or self.lexical_index is None:
+            return dense_search(top_k)
+
+        depth = top_k * FUSION_DEPTH
+        if mode == "prefilter":
+            lex_ids, _ = self.lexical_index.search(query, PREFILTER_CANDIDATES)
+            if not len(lex_ids):
+                # 文字列が一致しない質問はベクトル検索の順位だけで返す (スコアは他と同じく RRF)
+                dense_ids, _ = dense_search(top_k)
+                ids, scores = rrf_fuse([dense_ids])
+                return ids, scores
+            cand = np.sort(lex_ids)
+            if dense_scores is None:
+                cand_scores = np.asarray(self.doc_vectors[cand], dtype=np.float32) @ query_vector
+            else:
+                cand_scores = dense_scores[cand]
+            dense_ids = cand[np.argsort(-cand_scores)]
+        else:
+            lex_ids, _ = self.lexical_index.search(query, depth)
+            dense_ids, _ = dense_search(depth)
+
+        ids, scores = rrf_fuse([dense_ids[:depth], lex_ids[:depth]])
+        return ids[:top_k], scores[:top_k]
+
+    def search(self, query, top_k=TOP_K, nprobe=None, ef=None, rescore=None, mode=None):
+        """
+        質問に関連するパッセージを検索する (Retrieve)
+        nprobe (IVF) / ef (HNSW) / rescore (int8, binary) を大きくすると再現率が上がり、遅くなる
+        hybrid / prefilter モードのスコアは RRF スコア
+        """
+        self.wait_until_ready()
+        mode = mode or self.mode
+        params = {
+            "nprobe": nprobe or self.nprobe,
+            "ef": ef or self.ef,
+            "rescore": rescore or self.rescore,
+            "mode": mode,
+        }
+        with self._swap.shared():
+            return self._search(query, top_k, params)
+
+    def _search(self, query, top_k, params):
+        query_vector, cached = self.query_cache.lookup(query, top_k, **params)
+        METRICS.incr("queries")
+
+        if cached is not None:
+            # 同じ質問: エンコードも検索も不要
+            METRICS.incr("cache_hits")
+            top_indices, scores = cached
+        else:
+            if query_vector is None:
+                METRICS.incr("cache_misses")
+                query_vector = self._encode_one(query)
+            else:
+                METRICS.incr("cache_vector_hits")
+
+            # 正規化済みベクトルの内積 = コサイン類似度 (スコアが高い順)
+            with METRICS.span("search"):
+                top_indices, scores = self._retrieve(query, query_vector, top_k, **params)
+            self.query_cache.store(query, query_vector, top_k, top_indices, scores, **params)
+
+        return self._make_results(top_indices, scores, query_vector, self._fused(params["mode"]))
+
+    def search_batch(self, queries, top_k=TOP_K, mode=None, with_vectors=False):
+        """
+        複数の質問をまとめて検索する (オフライン評価・一括回答用)
+        エンコードは1回のバッチ呼び出し、類似度は1回の行列積で計算する
+        with_vectors=True なら (検索結果, クエリベクトル) を返す (回答キャッシュの照合に使い回す)
+        """
+        self.wait_until_ready()
+        mode = mode or self.mode
+        METRICS.incr("queries", len(queries))
+        query_vectors = self.encode_queries(queries)
+        with self._swap.shared(), METRICS.span("search"):
+            all_scores = batch_dot_scores(self.doc_vectors, query_vectors)
+            fused = self._fused(mode)
+            results = [
+                self._make_results(*self._retrieve(q, vec, top_k, mode, dense_scores=row),
+                                   vec, fused)
+                for q, vec, row in zip(queries, query_vectors, all_scores)
+            ]
+        return (results, query_vectors) if with_vectors else results
+
+    def _fused(self, mode):
+        """検索スコアが RRF スコアになるモードか"""
+        return mode != "dense" and self.lexical_index is not None
+
+    def _make_results(self, top_indices, scores, query_vector, fused=False):
+        """
+        検索結果の文書リスト
+        "score" は順位付けに使ったスコア (fused なら RRF)、"similarity" はクエリとのコサイン類似度
+        "rrf" は RRF スコア (ベクトル検索のみなら None)
+        """
         results = []
-        for idx in top_indices:
-            score = similarities[idx]
+        # 参考資料の重複判定用のベクトル (回答生成までにインデックスが差し替わっても使える)
+        vectors = np.asarray(
+            self.doc_vectors[np.asarray(top_indices, dtype=np.int64)], dtype=np.float32
+        )
+        similarities = vectors @ np.asarray(query_vector, dtype=np.float32).ravel()
+        for idx, score, vector, sim in zip(top_indices, scores, vectors, similarities):
             doc = self.documents[idx]
             results.append(
                 {
+                    "vector": vector,
                     "score": score,
+                    "similarity": float(sim),
+                    "rrf": float(score) if fused else None,
+                    "id": doc["id"],
                     "source": doc["source"],
+                    "offset": doc.get("offset", 0),
+                    "page": doc.get("page"),
                     "text": doc["text"],
                     "title": doc["title"],
+                    # 同じ内容の別の出典 (ビルド時に重複として除いたパッセージ)
+                    "alternates": doc.get("alternates", []),
                 }
             )
         return results
 
-    def generate_answer(self, query, context_docs):
-        """検索結果を元にGeminiで回答を作成する (Generate)"""
+    def pack_context(self, context_docs):
+        """
+        検索結果から重複を除き、トークン数の上限内で参考資料を選ぶ
+        (選んだ文書, {"passages", "tokens", "duplicates", "over_budget"}) を返す
+        """
+        vectors = None
+        if context_docs and all("vector" in d for d in context_docs):
+            vectors = np.stack([d["vector"] for d in context_docs])
+        packed, stats = pack_context(
+            context_docs, vectors, self.context_tokens, MAX_PASSAGE_CHARS
+        )
+        METRICS.incr("context_passages", stats["passages"])
+        METRICS.incr("context_tokens", stats["tokens"])
+        METRICS.incr("context_duplicates", stats["duplicates"])
+        return packed, stats
+
+    def generate_answer(self, query, context_docs, timing=None, context=None,
+                        query_vector=None):
+        """
+        検索結果を元にGeminiで回答を作成する (Generate)
+        回答はストリーミングで届いた順にテキスト片を yield する
+        timing (dict) を渡すと最初のトークンまでの時間 "ttft" と全体時間 "total" (秒) を記録
+        context (dict) を渡すと参考資料の選択結果 (passages / tokens / duplicates / over_budget) を記録
+        以前の質問とベクトルが近く参考資料が同じなら、Gemini を呼ばずに保存済みの回答を返す
+        (context の "cached" が True になる)
+        query_vector: 検索時に計算済みのクエリベクトル (無ければキャッシュを見るかエンコードする)
+        """
+        started = time.perf_counter()
+        context_ids = [d["id"] for d in context_docs]
+        # 生成中にインデックスが読み込み直されたら、前の版の資料による回答は保存しない
+        version = self.version
+        if self.answer_cache.capacity <= 0:
+            query_vector = None
+        else:
+            if query_vector is None:
+                query_vector = self.query_cache.peek_vector(query)
+            if query_vector is None:
+                query_vector = self._encode_one(query)
+            hit = self.answer_cache.lookup(query_vector, context_ids)
+            if hit is not None:
+                METRICS.incr("answer_cache_hits")
+                answer, stats = hit
+                if context is not None:
+                    context.update(stats, cached=True)
+                if timing is not None:
+                    timing["ttft"] = timing["total"] = time.perf_counter() - started
+                yield answer
+                return
+            METRICS.incr("answer_cache_misses")
 
         # コンテキスト（参考資料）テキストを作成
+        packed, stats = self.pack_context(context_docs)
+        if context is not None:
+            context.update(stats)
         context_text = ""
-        for i, doc in enumerate(context_docs, 1):
+        for i, doc in enumerate(packed, 1):
             context_text += (
-                f"\n--- 資料 {i} (Source: {doc['source']}) ---\n{doc['text'][:2000]}\n"
+                f"\n--- 資料 {i} (Source: {cite(doc)}) ---\n"
+                f"{doc['text']}\n"
             )
 
         # プロンプト（AIへの指示書）
@@ -109,9 +546,85 @@ class RAGChatbot:
 
 【回答】
 """
-        # Geminiに生成させる
-        response = self.generator.generate_content(prompt)
-        return response.text
+        # Geminiに生成させる (ストリーミング)
+        started = time.perf_counter()
+        ttft = None
+        parts = []
+        for token in self.generator.stream_generate(prompt):
+            if ttft is None:
+                ttft = time.perf_counter() - started
+            METRICS.incr("stream_chunks")
+            parts.append(token)
+            yield token
+        total = time.perf_counter() - started
+        # 最後まで生成できた回答だけを保存する (途中で切断・エラーになったものは保存しない)
+        if query_vector is not None:
+            self.answer_cache.store(query, query_vector, context_ids, "".join(parts), stats,
+                                    version=version)
+        if ttft is None:
+            ttft = total
+        METRICS.observe("generate_ttft", ttft)
+        METRICS.observe("generate", total)
+        if timing is not None:
+            timing["ttft"] = ttft
+            timing["total"] = total
+
+    def run_batch(self, questions, out, parallel=DEFAULT_BATCH_PARALLEL,
+                  top_k=TOP_K, generate=True):
+        """
+        質問リストを一括処理し、完了した順に1行1件のJSONLで out に書き出す
+        questions: [{"id": ..., "question": ...}]
+        """
+        t0 = time.perf_counter()
+        all_results, query_vectors = self.search_batch(
+            [q["question"] for q in questions], top_k, with_vectors=True
+        )
+        print(f"Retrieved {len(questions)} questions in {time.perf_counter() - t0:.2f}s",
+              file=sys.stderr)
+
+        def answer(i):
+            q, results = questions[i], all_results[i]
+            record = {
+                "id": q.get("id", i),
+                "question": q["question"],
+                "sources": [
+                    {"id": r["id"], "source": r["source"], "offset": r["offset"],
+                     "page": r["page"],
+                     **score_fields(r)}
+                    for r in results
+                ],
+            }
+            if generate:
+                timing = {}
+                context = {}
+                try:
+                    record["answer"] = "".join(
+                        self.generate_answer(q["question"], results, timing, context,
+                                             query_vector=query_vectors[i])
+                    )
+                except Exception as e:
+                    record["error"] = str(e)
+                for key, sec in timing.items():
+                    record[f"{key}_sec"] = round(sec, 3)
+                if context:
+                    record["context_tokens"] = context["tokens"]
+                if context.get("cached"):
+                    record["cached"] = True
+            return record
+
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+            futures = [pool.submit(answer, i) for i in range(len(questions))]
+            for fut in as_completed(futures):
+                out.write(json.dumps(fut.result(), ensure_ascii=False) + "\n")
+                out.flush()
+                done += 1
+                print(f"  {done}/{len(questions)}", end="\r", file=sys.stderr)
+        elapsed = time.perf_counter() - t0
+        print(f"\nAnswered {done} questions in {elapsed:.1f}s "
+              f"({done / max(elapsed, 1e-9):.2f} q/s)", file=sys.stderr)
+        if generate:
+            self.answer_cache.save()
 
     def chat_loop(self):
         print("\n" + "=" * 50)
@@ -122,36 +635,191 @@ class RAGChatbot:
         while True:
             user_input = input("\nあなた: ")
             if user_input.lower() in ["exit", "quit"]:
+                self.wait_until_ready()
+                self.query_cache.save()
+                stats = self.query_cache.stats
+                print(f"Query cache: {stats['hits']} hits, {stats['vector_hits']} vector-only hits, "
+                      f"{stats['misses']} misses")
+                self.answer_cache.save()
+                stats = self.answer_cache.stats
+                print(f"Answer cache: {stats['hits']} hits, {stats['misses']} misses")
                 break
 
             if not user_input.strip():
                 continue
 
+            if not self.is_ready:
+                print(" (検索モデルを読み込み中...)")
+            else:
+                # ビルダーが公開した新しいインデックスがあれば読み込み直す
+                self.reload_if_published()
             print(" (検索中...)")
             # 1. 検索
-            results = self.search(user_input, top_k=3)
+            results = self.search(user_input)
 
             # 検索結果のソースを表示（デバッグ用）
-            print(f" [参照] {results[0]['source']} (Score: {results[0]['score']:.4f})")
+            top = results[0]
+            if top["rrf"] is not None:
+                score = f"RRF: {top['rrf']:.4f}, similarity: {top['similarity']:.4f}"
+            else:
+                score = f"Score: {top['similarity']:.4f}"
+            print(f" [参照] {cite(top)} ({score})")
 
             print(" (Geminiが回答を生成中...)")
             # 2. 生成
             try:
-                answer = self.generate_answer(user_input, results)
-                print(f"\nAI: {answer}")
+                timing = {}
+                context = {}
+                print("\nAI: ", end="", flush=True)
+                for token in self.generate_answer(user_input, results, timing, context):
+                    print(token, end="", flush=True)
+                source = "answer cache" if context.get("cached") else (
+                    f"context {context['passages']} passages ~{context['tokens']} tokens"
+                )
+                print(f"\n (TTFT {timing['ttft']:.2f}s / total {timing['total']:.2f}s, {source})")
             except Exception as e:
                 print(f"\nError: Gemini APIのエラーが発生しました。\n{e}")
 
 
+def load_questions(path):
+    """質問JSONLを読み込む ("question" または "query" キー)"""
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            item.setdefault("id", n)
+            item["question"] = item.get("question") or item.get("query", "")
+            questions.append(item)
+    return questions
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "--index", default="rag_index_local.json", help="Path to the index file"
+        "--index", default="rag_index_local.json",
+        help="Path to the index file (.json or binary .idx directory)"
+    )
+    parser.add_argument("--api-key", default=None, help="Google Gemini API Key")
+    parser.add_argument(
+        "--nprobe", type=int, default=None, help="IVF clusters to scan (recall vs. speed)"
+    )
+    parser.add_argument(
+        "--ef", type=int, default=None, help="HNSW search width (recall vs. speed)"
+    )
+    parser.add_argument(
+        "--rescore", type=int, default=None,
+        help="int8/binary index: rescore top_k * N candidates at full precision"
+    )
+    parser.add_argument(
+        "--shard-workers", type=int, default=None,
+        help="Sharded index: search processes (default: one per CPU, 0 = in-process)"
+    )
+    parser.add_argument(
+        "--context-tokens", type=int, default=DEFAULT_CONTEXT_TOKENS,
+        help="Token budget for retrieved passages in the Gemini prompt"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=DEFAULT_QUERY_CACHE_SIZE,
+        help="Query cache entries (0 = disabled)"
+    )
+    parser.add_argument(
+        "--query-cache", default=None,
+        help="Persist the query cache to this file (e.g. rag_index.qcache.json)"
+    )
+    parser.add_argument(
+        "--answer-cache-size", type=int, default=DEFAULT_ANSWER_CACHE_SIZE,
+        help="Answer cache entries (0 = always call Gemini)"
+    )
+    parser.add_argument(
+        "--answer-cache", default=None,
+        help="Persist the answer cache to this file (e.g. rag_index.acache.json)"
+    )
+    parser.add_argument(
+        "--answer-similarity", type=float, default=DEFAULT_ANSWER_SIMILARITY,
+        help="Reuse an answer when the query vectors' cosine similarity is at least this"
+    )
+    parser.add_argument(
+        "--answer-ttl", type=float, default=DEFAULT_ANSWER_TTL,
+        help="Answer cache lifetime in seconds (0 = no expiry)"
+    )
+    parser.add_argument(
+        "--mode", choices=RETRIEVAL_MODES, default=DEFAULT_RETRIEVAL_MODE,
+        help="dense, hybrid (BM25 + vectors, RRF) or prefilter (BM25 candidates only)"
+    )
+    parser.add_argument(
+        "--batch", default=None,
+        help='JSONL file of questions ({"id": ..., "question": ...} per line)'
+    )
+    parser.add_argument(
+        "--output", "-o", default=None,
+        help="Batch results JSONL (default: <batch>.results.jsonl, '-' for stdout)"
+    )
+    parser.add_argument(
+        "--parallel", type=int, default=DEFAULT_BATCH_PARALLEL,
+        help="Concurrent Gemini calls in batch mode"
+    )
+    parser.add_argument(
+        "--retrieve-only", action="store_true",
+        help="Batch mode: only retrieve passages, do not call Gemini"
+    )
+    parser.add_argument(
+        "--api-base", default=GEMINI_API_BASE,
+        help="Gemini API base URL (e.g. a local fake endpoint for testing)"
+    )
+    parser.add_argument(
+        "--profile-startup", action="store_true",
+        help="Print time-to-prompt and per-phase load times, then exit"
+    )
+    parser.add_argument(
+        "--metrics", default=None, metavar="FILE",
+        help="Record stage timings and counters, write a JSON summary on exit ('-' = stderr)"
     )
-    parser.add_argument("--api-key", required=True, help="Google Gemini API Key")
     args = parser.parse_args()
+    if not args.api_key and not (args.batch and args.retrieve_only):
+        parser.error("--api-key is required (except for --batch --retrieve-only)")
+    if args.metrics:
+        # バックグラウンド読み込みも計測するため、RAGChatbot 生成前に有効化
+        METRICS.enable()
+
+    try:
+        run(args)
+    finally:
+        METRICS.dump(args.metrics)
+
+
+def run(args):
+    bot = RAGChatbot(
+        args.index, args.api_key, nprobe=args.nprobe, ef=args.ef, rescore=args.rescore,
+        cache_size=args.cache_size, cache_path=args.query_cache, mode=args.mode,
+        api_base=args.api_base, shard_workers=args.shard_workers,
+        context_tokens=args.context_tokens, answer_cache_size=args.answer_cache_size,
+        answer_cache_path=args.answer_cache, answer_similarity=args.answer_similarity,
+        answer_ttl=args.answer_ttl,
+    )
+    if args.profile_startup:
+        # プロンプトを表示できるまでの時間と、バックグラウンド読み込みの内訳
+        print(f"Time to prompt: {time.perf_counter() - _T0:.3f}s")
+        bot.wait_until_ready()
+        print(f"Time to first search: {time.perf_counter() - _T0:.3f}s")
+        bot.print_startup_profile()
+        return
+
+    if args.batch:
+        questions = load_questions(args.batch)
+        output = args.output or os.path.splitext(args.batch)[0] + ".results.jsonl"
+        out = sys.stdout if output == "-" else open(output, "w", encoding="utf-8")
+        try:
+            bot.run_batch(questions, out, parallel=args.parallel,
+                          generate=not args.retrieve_only)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return
 
-    bot = RAGChatbot(args.index, args.api_key)
     bot.chat_loop()
 
 
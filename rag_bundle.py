@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_bundle.py
+
+ブラウザ (new_index.html + rag_search_worker.js) 用の検索バンドルを書き出す。
+JSON の浮動小数点数をメインスレッドで解析する代わりに、Web Worker が型付き配列のまま走査する。
+
+    rag_bundle/
+      manifest.json   モデル名・次元数・件数・ベクトル型 (int8 ならスケール) など
+      vectors.bin     正規化済みベクトルの行列 (int8 または float16, リトルエンディアン, 行優先)
+      meta/0.json     メタデータと本文 (META_CHUNK 件ごとのファイル、上位 k 件の分だけ読む)
+      meta/1.json ...
+
+- int8 は次元ごとのスケール (rag_vector_index.Int8Index と同じ量子化) でサイズ 1/4
+- 生のバイト列なので、HTTP サーバー側の gzip / brotli 圧縮がそのまま効く
+- ページ読み込み時に取得するのは manifest.json と vectors.bin だけ
+
+使い方 (入力は JSON でもバイナリ形式の .idx でもよい):
+    python rag_bundle.py rag_index.json rag_bundle --dtype int8
+
+build_rag_index.py (Gemini 版・scripts/ のローカル版とも) はインデックスの隣に rag_bundle/ があれば
+ビルドのたびに作り直す
+(インデックスだけ新しくなって、ページが古いバンドルを読み続けることがない)
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from rag_store import load_index
+from rag_vector_index import Int8Index, normalized_vectors
+
+BUNDLE_FORMAT = "rag-bundle"
+BUNDLE_VERSION = 1
+BUNDLE_DTYPES = ("int8", "float16")
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.bin"
+# メタデータのファイル名 ({chunk} = 行番号 // META_CHUNK)
+META_PATTERN = "meta/{chunk}.json"
+META_CHUNK = 64
+
+META_FIELDS = ("id", "title", "source", "offset", "page", "text")
+
+
+def export_bundle(index_path: str, out_dir: str, dtype: str = "int8",
+                  meta_chunk: int = META_CHUNK) -> Dict[str, Any]:
+    """インデックスからブラウザ用バンドルを書き出す (一時ディレクトリ経由)"""
+    if dtype not in BUNDLE_DTYPES:
+        raise ValueError(f"dtype must be one of {BUNDLE_DTYPES}")
+    docs, vectors, manifest = load_index(index_path)
+    vectors = normalized_vectors(vectors, manifest)
+    count, dim = (len(docs), vectors.shape[1]) if len(docs) else (0, 0)
+
+    bundle = {
+        "format": BUNDLE_FORMAT,
+        "version": BUNDLE_VERSION,
+        "model": manifest["model"],
+        "dim": dim,
+        "count": count,
+        "dtype": dtype,
+        "vectors": VECTORS_FILE,
+        "meta": META_PATTERN,
+        "meta_chunk": meta_chunk,
+    }
+
+    tmp_dir = out_dir.rstrip("/\\") + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(os.path.join(tmp_dir, os.path.dirname(META_PATTERN)))
+
+    if dtype == "int8" and count:
+        quantized = Int8Index.build(vectors)
+        quantized.codes.tofile(os.path.join(tmp_dir, VECTORS_FILE))
+        bundle["scale"] = [float(s) for s in quantized.scale]
+    else:
+        with open(os.path.join(tmp_dir, VECTORS_FILE), "wb") as f:
+            for start in range(0, count, 65536):
+                part = np.asarray(vectors[start:start + 65536], dtype="<f2")
+                f.write(part.tobytes())
+
+    for chunk, start in enumerate(range(0, count, meta_chunk)):
+        rows = [
+            {k: d.get(k) for k in META_FIELDS if d.get(k) is not None}
+            for d in docs[start:start + meta_chunk]
+        ]
+        path = os.path.join(tmp_dir, META_PATTERN.format(chunk=chunk))
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, separators=(",", ":"))
+
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(bundle, f, ensure_ascii=False, separators=(",", ":"))
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    return bundle
+
+
+def read_bundle_manifest(out_dir: str) -> Optional[Dict[str, Any]]:
+    """書き出し済みのバンドルのマニフェスト (バンドルでなければ None)"""
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            bundle = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return bundle if isinstance(bundle, dict) and bundle.get("format") == BUNDLE_FORMAT else None
+
+
+def remove_bundle(out_dir: str):
+    """バンドルを削除 (元のインデックスにベクトルが無くなった場合など)"""
+    if read_bundle_manifest(out_dir) is not None:
+        shutil.rmtree(out_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a browser search bundle")
+    parser.add_argument("src", help="index (rag_index.json or binary .idx directory)")
+    parser.add_argument("dst", help="output directory (e.g. rag_bundle)")
+    parser.add_argument("--dtype", choices=BUNDLE_DTYPES, default="int8")
+    parser.add_argument("--meta-chunk", type=int, default=META_CHUNK,
+                        help="passages per metadata file")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.src):
+        print(f"Error: {args.src} not found")
+        sys.exit(1)
+    bundle = export_bundle(args.src, args.dst, args.dtype, args.meta_chunk)
+    size = os.path.getsize(os.path.join(args.dst, VECTORS_FILE))
+    print(f"✓ {bundle['count']} vectors ({bundle['dim']} dim, {bundle['dtype']}, "
+          f"{size / 1024:.0f} KiB) -> {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
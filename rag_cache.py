@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_cache.py
+
+検索用のキャッシュ。
+- QueryCache: 正規化した質問文 -> (クエリベクトル, 上位k件のID/スコア) のLRU
+  インデックスを読み込み直して版が変わったら invalidate で破棄し、任意でディスクに保存する
+  (HTTP サービスから複数スレッドで使えるようにロックで保護する)
+- AnswerCache: クエリベクトルが近く、検索された参考資料のIDの集合が同じ質問には
+  以前の回答を返す (言い回しだけ違う質問で Gemini を呼ばない)。LRU と有効期限で破棄する
+"""
+
+import os
+import json
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_QUERY_CACHE_SIZE = 256
+DEFAULT_ANSWER_CACHE_SIZE = 256
+# 回答を再利用するクエリベクトルのコサイン類似度の下限と有効期限 (秒)
+DEFAULT_ANSWER_SIMILARITY = 0.95
+DEFAULT_ANSWER_TTL = 24 * 3600
+
+
+def normalize_query(text: str) -> str:
+    """キャッシュキー用に質問文を正規化 (NFKC・小文字化・空白の統一)"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def _atomic_write_json(path: str, data: Any):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+class QueryCache:
+    """クエリベクトルと検索結果のLRUキャッシュ"""
+
+    def __init__(self, capacity: int = DEFAULT_QUERY_CACHE_SIZE,
+                 version: str = "", path: Optional[str] = None):
+        self.capacity = capacity
+        self.version = version
+        self.path = path
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.stats = {"hits": 0, "vector_hits": 0, "misses": 0}
+        if path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _result_key(top_k: int, params: Dict[str, Any]) -> str:
+        extra = ",".join(f"{k}={params[k]}" for k in sorted(params) if params[k] is not None)
+        return f"{top_k}|{extra}"
+
+    def lookup(self, query: str, top_k: int, **params) -> Tuple[
+        Optional[np.ndarray], Optional[Tuple[List[int], List[float]]]
+    ]:
+        """(クエリベクトル, (ID, スコア)) を返す。無いものは None"""
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None, None
+            self._entries.move_to_end(key)
+            results = entry["results"].get(self._result_key(top_k, params))
+            if results is not None:
+                self.stats["hits"] += 1
+            else:
+                self.stats["vector_hits"] += 1
+            return entry["vector"], results
+
+    def peek_vector(self, query: str) -> Optional[np.ndarray]:
+        """保存済みのクエリベクトル (統計・LRUの順番は変えない)"""
+        with self._lock:
+            entry = self._entries.get(normalize_query(query))
+            return None if entry is None else entry["vector"]
+
+    def store(self, query: str, vector: np.ndarray, top_k: int,
+              ids, scores, **params):
+        if self.capacity <= 0:
+            return
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"vector": np.asarray(vector, dtype=np.float32), "results": {}}
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            entry["results"][self._result_key(top_k, params)] = (
+                [int(i) for i in ids], [float(s) for s in scores]
+            )
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, version: str):
+        """インデックスの版が変わったら全件破棄"""
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != self.version:
+            return
+        for key, entry in data.get("entries", []):
+            self._entries[key] = {
+                "vector": np.asarray(entry["vector"], dtype=np.float32),
+                "results": {k: tuple(v) for k, v in entry["results"].items()},
+            }
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = [
+                [key, {"vector": e["vector"].tolist(), "results": dict(e["results"])}]
+                for key, e in self._entries.items()
+            ]
+        try:
+            _atomic_write_json(self.path, {"version": self.version, "entries": entries})
+        except OSError as e:
+            print(f"Warning: failed to save query cache: {e}")
+
+
+class AnswerCache:
+    """
+    回答のキャッシュ (質問文ごと、LRU + 有効期限)
+    クエリベクトルのコサイン類似度が threshold 以上で、参考資料のIDの集合が同じなら一致とみなす
+    インデックスの版が変わったら invalidate で破棄し、任意でディスクに保存する
+    """
+
+    def __init__(self, capacity: int = DEFAULT_ANSWER_CACHE_SIZE, version: str = "",
+                 path: Optional[str] = None, threshold: float = DEFAULT_ANSWER_SIMILARITY,
+                 ttl: float = DEFAULT_ANSWER_TTL):
+        self.capacity = capacity
+        self.version = version
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0}
+        if path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _context_key(context_ids) -> str:
+        return "\n".join(sorted(set(context_ids)))
+
+    def _expire(self):
+        if self.ttl <= 0:
+            return
+        limit = time.time() - self.ttl
+        for key in [k for k, e in self._entries.items() if e["created"] < limit]:
+            del self._entries[key]
+            self.stats["expired"] += 1
+
+    def lookup(self, vector: np.ndarray, context_ids) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """(回答, 参考資料の情報) を返す。一致するものが無ければ None"""
+        if self.capacity <= 0:
+            return None
+        context = self._context_key(context_ids)
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._expire()
+            best_key, best_sim = None, self.threshold
+            for key, entry in self._entries.items():
+                if entry["context"] != context:
+                    continue
+                sim = float(entry["vector"] @ vector)
+                if sim >= best_sim:
+                    best_key, best_sim = key, sim
+            if best_key is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.stats["hits"] += 1
+            entry = self._entries[best_key]
+            return entry["answer"], entry["info"]
+
+    def store(self, query: str, vector: np.ndarray, context_ids, answer: str,
+              info: Optional[Dict[str, Any]] = None, version: Optional[str] = None):
+        """version を渡すと、生成中に invalidate された (版が変わった) 回答は保存しない"""
+        if self.capacity <= 0 or not answer:
+            return
+        key = normalize_query(query)
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = {
+                "vector": np.asarray(vector, dtype=np.float32),
+                "context": self._context_key(context_ids),
+                "answer": answer,
+                "info": dict(info or {}),
+                "created": time.time(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, version: str):
+        """インデックスの版が変わったら全件破棄"""
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != self.version:
+            return
+        for key, entry in data.get("entries", []):
+            entry["vector"] = np.asarray(entry["vector"], dtype=np.float32)
+            self._entries[key] = entry
+        self._expire()
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            self._expire()
+            entries = [
+                [key, dict(e, vector=e["vector"].tolist())]
+                for key, e in self._entries.items()
+            ]
+        try:
+            _atomic_write_json(self.path, {"version": self.version, "entries": entries})
+        except OSError as e:
+            print(f"Warning: failed to save answer cache: {e}")
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_chunker.py
+
+文書テキストをパッセージ (チャンク) に分割するユーティリティ。
+- 段落 (空行) と文末 (。！？.!?) の境界を優先して分割
+- チャンクサイズ・オーバーラップは文字数で指定
+- 各チャンクは元テキスト内の文字オフセットを保持
+- ページオフセット (PDF) があれば各チャンクに開始ページ番号を付ける
+"""
+
+import re
+import bisect
+from typing import List, Dict, Optional, Sequence, Tuple
+
+DEFAULT_CHUNK_SIZE: int = 800
+DEFAULT_CHUNK_OVERLAP: int = 100
+
+# 段落 = 空行を含まない連続領域
+_PARAGRAPH_RE = re.compile(r"(?:(?!\n[ \t]*\n).)+", re.S)
+# 文末記号 (日本語の「。」を含む) + 閉じ括弧
+_SENTENCE_END_RE = re.compile(r"(?:[。．！？!?]+[」』）)\"']*|\.(?=\s))")
+
+
+def clean_text(text: str) -> str:
+    """空白を正規化する (段落区切りの空行だけは残す)"""
+    text = re.sub(r"[ \t\r\f\v]+", " ", text)
+    text = re.sub(r" ?\n[ \n]*\n ?", "\n\n", text)
+    text = re.sub(r" ?(?<!\n)\n(?!\n) ?", " ", text)
+    return text.strip()
+
+
+def _split_units(text: str, max_len: int) -> List[Tuple[int, int, bool]]:
+    """テキストを (開始, 終了, 段落末か) の文単位に分割"""
+    units: List[Tuple[int, int, bool]] = []
+    for para in _PARAGRAPH_RE.finditer(text):
+        p_start, p_end = para.span()
+        cuts = [m.end() for m in _SENTENCE_END_RE.finditer(text, p_start, p_end)]
+        if not cuts or cuts[-1] != p_end:
+            cuts.append(p_end)
+
+        spans = []
+        prev = p_start
+        for cut in cuts:
+            s, e = prev, cut
+            while s < e and text[s].isspace():
+                s += 1
+            while e > s and text[e - 1].isspace():
+                e -= 1
+            prev = cut
+            if s >= e:
+                continue
+            # 長すぎる文は強制分割
+            while e - s > max_len:
+                spans.append((s, s + max_len))
+                s += max_len
+            spans.append((s, e))
+
+        for i, (s, e) in enumerate(spans):
+            units.append((s, e, i == len(spans) - 1))
+    return units
+
+
+def chunk_text(
+    text: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    overlap: int = DEFAULT_CHUNK_OVERLAP,
+) -> List[Dict[str, object]]:
+    """
+    テキストをチャンクに分割して [{"text", "offset"}] を返す
+    オーバーラップは直前チャンク末尾の文単位で確保する
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    overlap = max(0, min(overlap, chunk_size // 2))
+
+    units = _split_units(text, chunk_size)
+    chunks: List[Dict[str, object]] = []
+    i = 0
+    while i < len(units):
+        start = units[i][0]
+        j = i
+        # 文単位で詰め込む (段落末で半分以上埋まっていればそこで切る)
+        while j + 1 < len(units) and units[j + 1][1] - start <= chunk_size:
+            if units[j][2] and units[j][1] - start >= chunk_size // 2:
+                break
+            j += 1
+        end = units[j][1]
+        chunks.append({"text": text[start:end], "offset": start})
+
+        if j + 1 >= len(units):
+            break
+        # 次チャンクの開始位置 (オーバーラップ分だけ戻る)
+        k = j + 1
+        nxt_end = units[k][1]
+        while (
+            k - 1 > i
+            and end - units[k - 1][0] <= overlap
+            and nxt_end - units[k - 1][0] <= chunk_size
+        ):
+            k -= 1
+        i = k
+    return chunks
+
+
+def page_at(pages: Optional[Sequence[Sequence[int]]], offset: int) -> Optional[int]:
+    """[(開始オフセット, ページ番号)] から offset を含むページ番号を返す"""
+    if not pages:
+        return None
+    i = bisect.bisect_right([p[0] for p in pages], offset) - 1
+    return int(pages[max(i, 0)][1])
+
+
+def chunk_document(
+    doc: Dict[str, object],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    overlap: int = DEFAULT_CHUNK_OVERLAP,
+    pages: Optional[Sequence[Sequence[int]]] = None,
+) -> List[Dict[str, object]]:
+    """
+    {"id", "title", "source", "text"} の文書をチャンク文書のリストに展開
+    チャンクIDは "<文書ID>#<連番>"、pages を渡すと開始ページ番号 "page" を付ける
+    """
+    out = []
+    for n, c in enumerate(chunk_text(str(doc["text"]), chunk_size, overlap)):
+        chunk = {
+            "id": f"{doc['id']}#{n}",
+            "title": doc["title"],
+            "source": doc["source"],
+            "offset": c["offset"],
+            "text": c["text"],
+        }
+        if pages:
+            chunk["page"] = page_at(pages, int(c["offset"]))
+        out.append(chunk)
+    return out
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_context.py
+
+回答生成プロンプトに入れる参考資料を、トークン数の上限内で選ぶ。
+- 検索結果を Maximal Marginal Relevance (MMR) の順に見ていき、既に選んだパッセージと
+  ほぼ同じ内容 (ベクトルのコサイン類似度が閾値以上) のものは入れない
+- 残りの上限に収まらないパッセージは飛ばし、後続の短いパッセージで埋める
+- 選んだパッセージは元の検索スコア順に並べ直す
+
+トークン数は Gemini のトークナイザを呼ばずに概算する
+(ASCII は約4文字で1トークン、日本語などそれ以外は1文字で1トークン)。
+"""
+
+import math
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_CONTEXT_TOKENS = 3000
+# MMR の関連度の重み (1.0 でスコア順のまま、小さいほど多様性を優先)
+DEFAULT_MMR_LAMBDA = 0.7
+# 選択済みのパッセージとこれ以上似ていれば重複として除く
+DUPLICATE_SIMILARITY = 0.95
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのトークン数の概算"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def truncate_to_tokens(text: str, limit: int) -> str:
+    """概算トークン数が limit 以内になるよう先頭から切り詰める"""
+    cost = 0.0
+    for i, c in enumerate(text):
+        cost += 0.25 if c < "\x80" else 1.0
+        if cost > limit:
+            return text[:i]
+    return text
+
+
+def pack_context(
+    docs: Sequence[Dict[str, Any]],
+    vectors: Optional[np.ndarray] = None,
+    token_budget: int = DEFAULT_CONTEXT_TOKENS,
+    max_chars: Optional[int] = None,
+    mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+    duplicate_similarity: float = DUPLICATE_SIMILARITY,
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    スコア順の検索結果から参考資料を選ぶ
+    vectors: docs と同じ順の正規化済みベクトル (None なら重複判定せずスコア順に詰める)
+    max_chars: 1パッセージあたりの上限文字数
+    (選んだ文書 (text は切り詰め済み), {"passages", "tokens", "duplicates", "over_budget"}) を返す
+    """
+    n = len(docs)
+    texts = [d["text"][:max_chars] if max_chars else d["text"] for d in docs]
+    tokens = [estimate_tokens(t) for t in texts]
+
+    # 関連度はスコアを 0-1 に揃えて使う (コサイン類似度でも RRF スコアでも同じ尺度になる)
+    scores = np.array([float(d["score"]) for d in docs], dtype=np.float64)
+    span = float(scores.max() - scores.min()) if n else 0.0
+    relevance = (scores - scores.min()) / span if span > 0 else np.ones(n)
+
+    sims = None
+    if vectors is not None and n:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        sims = vectors @ vectors.T
+    # 各候補と選択済みパッセージとの最大類似度
+    nearest = np.full(n, -1.0)
+
+    selected: List[int] = []
+    used = duplicates = over_budget = 0
+    remaining = list(range(n))
+    while remaining:
+        if sims is None:
+            best = remaining[0]
+        else:
+            best = max(remaining, key=lambda i: mmr_lambda * relevance[i]
+                       - (1.0 - mmr_lambda) * max(nearest[i], 0.0))
+        remaining.remove(best)
+        if selected and nearest[best] >= duplicate_similarity:
+            duplicates += 1
+            continue
+        if used + tokens[best] > token_budget:
+            if selected:
+                over_budget += 1
+                continue
+            # 最上位でも上限を超える場合は収まる長さに切り詰めて入れる
+            texts[best] = truncate_to_tokens(texts[best], token_budget)
+            tokens[best] = estimate_tokens(texts[best])
+        selected.append(best)
+        used += tokens[best]
+        if sims is not None:
+            np.maximum(nearest, sims[best], out=nearest)
+
+    # 検索結果はスコア順なので、位置の順に戻せばスコア順になる
+    selected.sort()
+    packed = [dict(docs[i], text=texts[i]) for i in selected]
+    stats = {
+        "passages": len(packed),
+        "tokens": used,
+        "duplicates": duplicates,
+        "over_budget": over_budget,
+    }
+    return packed, stats
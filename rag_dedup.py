@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_dedup.py
+
+Embedding の前に、ほぼ同じ内容のパッセージ (同じ資料の別バージョンやコピー) を除く。
+文字 5-gram の集合の MinHash 署名を LSH (バンド分割) のバケットに入れて候補を絞り、
+候補とは n-gram 集合の Jaccard 係数を実際に計算して、閾値以上なら重複とする。
+
+- 最初に見たパッセージを代表として残し、重複側の出典を代表の "alternates" に記録する
+    {"id": ..., "source": "a.pdf", "page": 3,
+     "alternates": [{"source": "a_v2.pdf", "page": 3, "offset": 1200}]}
+- 重複はモデルに渡さないので、Embedding 時間とインデックスのサイズが重複の分だけ減る
+- 署名は1回のハッシュを 64 個のビンに振り分ける One Permutation Hashing
+  (パッセージあたり n-gram 数に比例する計算量で、置換を 64 回行う MinHash と同じ使い方ができる)
+- numpy を使わない (Gemini 版のビルダーは numpy なしでも動く)
+"""
+
+import zlib
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+# n-gram の文字数 (日本語・英語とも文字単位)
+SHINGLE_SIZE = 5
+# n-gram 集合の Jaccard 係数がこれ以上なら重複
+DEFAULT_DEDUP_THRESHOLD = 0.8
+
+# 署名のビン数 = 2 ** BIN_BITS (ハッシュの上位ビットでビン、残りのビットが値)
+BIN_BITS = 6
+NUM_BINS = 1 << BIN_BITS
+_VALUE_MASK = (1 << (32 - BIN_BITS)) - 1
+# n-gram が1つも入らなかったビン (どの値よりも大きい)
+_EMPTY = 1 << 32
+_MIX = 0x9E3779B1
+
+# 閾値ちょうどの重複を LSH の候補に入れる確率の下限 (バンドの行数を決める)
+_LSH_RECALL = 0.99
+
+# 代表に記録する重複側の項目
+ALTERNATE_FIELDS = ("source", "page", "offset", "fingerprint")
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> Set[int]:
+    """正規化したテキストの文字 n-gram のハッシュ集合"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = " ".join(text.split())
+    grams = {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+    return {zlib.crc32(g.encode("utf-8")) for g in grams}
+
+
+def signature(hashes: Iterable[int]) -> List[int]:
+    """MinHash 署名 (ビンごとの最小値、空のビンは _EMPTY)"""
+    sig = [_EMPTY] * NUM_BINS
+    for h in hashes:
+        h = (h * _MIX) & 0xFFFFFFFF
+        b, v = h >> (32 - BIN_BITS), h & _VALUE_MASK
+        if v < sig[b]:
+            sig[b] = v
+    return sig
+
+
+def jaccard(a: Set[int], b: Set[int]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def lsh_rows(threshold: float) -> int:
+    """
+    バンドあたりの行数 (NUM_BINS の約数のうち、閾値ちょうどの重複を
+    _LSH_RECALL 以上の確率で候補に入れる最大のもの。大きいほど余分な候補が減る)
+    """
+    rows = 1
+    for r in (2 ** i for i in range(1, BIN_BITS + 1)):
+        if 1.0 - (1.0 - threshold ** r) ** (NUM_BINS // r) >= _LSH_RECALL:
+            rows = r
+    return rows
+
+
+def alternate_of(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: doc[k] for k in ALTERNATE_FIELDS if doc.get(k) is not None}
+
+
+class Deduplicator:
+    """
+    パッセージを順に受け取り、登録済みの代表とほぼ同じものを見つける
+    代表は文書 (dict) への参照で持つので、後から alternates を追記すればそのまま保存される
+    """
+
+    def __init__(self, threshold: float = DEFAULT_DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.rows = lsh_rows(threshold)
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], List[Dict[str, Any]]] = {}
+        self.passages = 0
+        self.duplicates = 0
+
+    def _keys(self, sig: List[int]) -> List[Tuple[int, Tuple[int, ...]]]:
+        keys = []
+        for start in range(0, NUM_BINS, self.rows):
+            band = tuple(sig[start:start + self.rows])
+            # 全て空のバンドは短いパッセージ同士を無差別に候補にするので使わない
+            if any(v != _EMPTY for v in band):
+                keys.append((start, band))
+        return keys
+
+    def find(self, doc: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """登録済みの代表のうち doc とほぼ同じものを返す (無ければ None)"""
+        hashes = shingles(doc["text"])
+        checked = set()
+        for key in self._keys(signature(hashes)):
+            for candidate in self._buckets.get(key, ()):
+                if id(candidate) in checked:
+                    continue
+                checked.add(id(candidate))
+                if jaccard(hashes, shingles(candidate["text"])) >= self.threshold:
+                    return candidate
+        return None
+
+    def register(self, doc: Dict[str, Any]):
+        """doc を代表として登録 (差分更新では既存のパッセージを先に登録する)"""
+        for key in self._keys(signature(shingles(doc["text"]))):
+            self._buckets.setdefault(key, []).append(doc)
+
+    def remove(self, doc: Dict[str, Any]):
+        """登録した代表を外す (監視モードで作り直すファイルのパッセージ)"""
+        for key in self._keys(signature(shingles(doc["text"]))):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            bucket[:] = [d for d in bucket if d is not doc]
+            if not bucket:
+                del self._buckets[key]
+
+    def promote(self, canonical: Dict[str, Any], duplicate: Dict[str, Any]):
+        """
+        代表の中身を重複側のパッセージに入れ替える (代表の Embedding に失敗した場合)
+        文書 (dict) は同じものを使い続け、元の代表の出典は alternates に移す
+        """
+        self.remove(canonical)
+        moved = alternate_of(duplicate)
+        alternates = [a for a in canonical.get("alternates", []) if a != moved]
+        alternates.append(alternate_of(canonical))
+        canonical.clear()
+        canonical.update(duplicate, alternates=alternates)
+        self.register(canonical)
+
+    def filter(self, chunks: Iterable[Dict[str, Any]],
+               duplicates: Optional[Dict[int, List[Dict[str, Any]]]] = None
+               ) -> List[Dict[str, Any]]:
+        """
+        重複を除いたパッセージ (重複側の出典は代表の alternates に記録)
+        duplicates を渡すと、除いたパッセージ自体を代表の id() ごとに残す (promote 用)
+        """
+        kept = []
+        for chunk in chunks:
+            self.passages += 1
+            canonical = self.find(chunk)
+            if canonical is None:
+                self.register(chunk)
+                kept.append(chunk)
+            else:
+                canonical.setdefault("alternates", []).append(alternate_of(chunk))
+                if duplicates is not None:
+                    duplicates.setdefault(id(canonical), []).append(chunk)
+                self.duplicates += 1
+        return kept
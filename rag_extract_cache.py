@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_extract_cache.py
+
+抽出結果 (クリーニング済みテキスト・タイトル・ページオフセット) のディスクキャッシュ。
+ファイル内容のハッシュと抽出時の引数をキーにするので、Embeddingモデルやチャンク設定を変えて
+インデックスを作り直すときに PDF などを再び解析しない (かかるのはモデルの時間だけ)。
+
+    .rag_extract_cache/
+      3f/3fa9...e1.json   {"title": ..., "text": ..., "pages": [[offset, page], ...]}
+
+- 抽出ワーカー (プロセスプール) の中で参照・保存する (CachedExtractor は pickle できる)
+- 書き込みは一時ファイル経由の置き換えなので、複数のプロセスが同時に書いても壊れない
+- 空の結果 (抽出失敗・PDF非対応の環境) は保存しない
+- 抽出処理の中身を変えたら EXTRACTOR_VERSION を上げる (古いエントリは使われなくなる)
+- 不要になったら、ディレクトリごと削除してよい
+"""
+
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+from rag_fingerprint import file_hash
+from rag_pipeline import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, iter_extracted
+
+DEFAULT_CACHE_DIR = ".rag_extract_cache"
+EXTRACTOR_VERSION = 1
+
+
+class CachedExtractor:
+    """
+    抽出関数 fn(path, *args) -> (タイトル, テキスト, ページオフセット) を包み、
+    (path, 内容ハッシュ, *args) で呼ぶと ((タイトル, テキスト, ページオフセット), キャッシュから読んだか) を返す
+    内容ハッシュは差分更新の指紋で計算済みなら渡す (None ならここでファイルを読んで計算する)
+    cache_dir が None なら毎回 fn を呼ぶ
+    namespace はビルダーごとの抽出処理の違いを区別する (同じファイルでも結果が異なるため)
+    """
+
+    def __init__(self, fn: Callable, cache_dir: Optional[str], namespace: str):
+        self.fn = fn
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+
+    def _entry_path(self, path: Any, content_hash: Optional[str], args: Sequence[Any]) -> str:
+        # タイトルにファイル名を使う抽出処理があるので、内容が同じでも名前が違えば別のエントリ
+        path = Path(path)
+        content_hash = content_hash or file_hash(path)
+        key = f"{self.namespace}|{EXTRACTOR_VERSION}|{args!r}|{path.name}|{content_hash}"
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".json")
+
+    def __call__(self, path: Any, content_hash: Optional[str],
+                 *args) -> Tuple[Tuple[Any, ...], bool]:
+        if not self.cache_dir:
+            return self.fn(path, *args), False
+        entry_path = self._entry_path(path, content_hash, args)
+        try:
+            with open(entry_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            return (entry["title"], entry["text"], entry["pages"]), True
+        except (OSError, ValueError, KeyError):
+            pass
+
+        title, text, pages = self.fn(path, *args)
+        if text:
+            _write_entry(entry_path, {"title": title, "text": text, "pages": pages})
+        return (title, text, pages), False
+
+
+def _write_entry(path: str, entry: Dict[str, Any]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # キャッシュに書けなくても抽出結果はそのまま使う
+        print(f"Warning: failed to write extraction cache {path}: {e}")
+
+
+def warm_cache(
+    extractor: CachedExtractor,
+    items: Sequence[Sequence[Any]],
+    workers: int = DEFAULT_WORKERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+) -> Dict[str, int]:
+    """
+    Embedding を行わずに抽出だけを実行してキャッシュを埋める (--extract-only)
+    items は extractor の引数 (path, 内容ハッシュ, *args)
+    {"cached", "extracted", "empty", "failed"} の件数を返す
+    """
+    counts = {"cached": 0, "extracted": 0, "empty": 0, "failed": 0}
+    for args, result, error in iter_extracted(extractor, items, workers, queue_size):
+        if error is not None:
+            print(f"  ✗ {args[0]} (extract failed: {error})")
+            counts["failed"] += 1
+            continue
+        (_, text, _), cached = result
+        if not text:
+            counts["empty"] += 1
+        elif cached:
+            counts["cached"] += 1
+        else:
+            counts["extracted"] += 1
+    return counts
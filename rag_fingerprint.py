@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_fingerprint.py
+
+差分更新用のファイル指紋 (サイズ, 更新時刻, 内容ハッシュ)。
+サイズと更新時刻が一致すればハッシュ計算を省略し、
+異なる場合のみ内容ハッシュ (BLAKE2b) で本当に変更されたかを判定する。
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
+
+_READ_SIZE = 1 << 20
+
+
+def file_hash(path: Path) -> str:
+    """ファイル内容のハッシュ (BLAKE2b, 128bit)"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(_READ_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_fingerprint(path: Path, content_hash: Optional[str] = None) -> Dict[str, Any]:
+    st = path.stat()
+    return {
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "hash": content_hash or file_hash(path),
+    }
+
+
+def check_fingerprint(
+    old: Optional[Dict[str, Any]], path: Path
+) -> Tuple[bool, Dict[str, Any]]:
+    """
+    保存済みの指紋と現在のファイルを比較して (変更ありか, 現在の指紋) を返す
+    指紋が無い (旧形式のインデックス) 場合は変更ありとみなす
+    """
+    if old:
+        st = path.stat()
+        if old.get("size") == st.st_size and old.get("mtime") == st.st_mtime_ns:
+            return False, old
+        if old.get("size") == st.st_size:
+            current = file_fingerprint(path)
+            return current["hash"] != old.get("hash"), current
+    return True, file_fingerprint(path)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_gemini.py
+
+Gemini REST API クライアント (標準ライブラリのみ)。
+- streamGenerateContent (SSE) で回答をトークン単位に受け取る
+- batchEmbedContents で複数テキストを1リクエストにまとめる
+- トークンバケットで毎分リクエスト数を制限
+- asyncio + セマフォで同時リクエスト数を制限
+- 429 (レート制限) を受けた時だけ指数バックオフ (ジッター付き) で再試行
+- 回答生成は keep-alive 接続をプールして使い回す (TLS ハンドシェイクを毎回しない)
+- base_url を差し替えればローカルのスタブサーバーに対して動作確認できる
+"""
+
+import json
+import time
+import random
+import asyncio
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from rag_metrics import METRICS
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+DEFAULT_EMBEDDING_MODEL = "models/text-embedding-004"
+DEFAULT_GENERATION_MODEL = "models/gemini-1.5-flash"
+
+# batchEmbedContents の1リクエストあたり上限は100件
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_TIMEOUT = 60.0
+# プールに残しておく空き接続の数
+DEFAULT_POOL_SIZE = 8
+
+# 再試行する HTTP ステータス
+_RETRY_STATUS = {429, 500, 503}
+
+
+class GeminiAPIError(Exception):
+    """Gemini API のエラー応答"""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    毎分 rate 回までのリクエストを許可するトークンバケット (asyncio 用)
+    トークン不足時は残高をマイナスにして予約し、順番が来るまで待つ
+    (await を挟まずに残高を更新するのでロック不要、イベントループをまたいで再利用可)
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int = 1):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(max(1, burst))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        self._refill()
+        self._tokens -= 1.0
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """指数バックオフ (full jitter)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def post_json(url: str, payload: Dict[str, Any], timeout: float = DEFAULT_TIMEOUT) -> Dict[str, Any]:
+    """JSON を POST してレスポンスの JSON を返す (エラー時は GeminiAPIError)"""
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return json.loads(res.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        retry_after = _retry_after(e.headers)
+        try:
+            body = json.loads(e.read().decode("utf-8"))
+            message = body.get("error", {}).get("message", e.reason)
+        except Exception:
+            message = str(e.reason)
+        raise GeminiAPIError(e.code, message, retry_after) from None
+
+
+def _retry_after(headers) -> Optional[float]:
+    try:
+        return float(headers.get("Retry-After")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
+class ConnectionPool:
+    """
+    1つのホストへの keep-alive 接続を使い回すプール (スレッドセーフ)
+    同時に使える接続数は制限しない (呼び出し側で並列数を制限する)
+    """
+
+    def __init__(self, base_url: str, size: int = DEFAULT_POOL_SIZE,
+                 timeout: float = DEFAULT_TIMEOUT):
+        parts = urllib.parse.urlsplit(base_url)
+        self.scheme = parts.scheme or "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip("/")
+        self.size = max(0, size)
+        self.timeout = timeout
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+        self.stats = {"connections": 0, "reused": 0}
+
+    def _connect(self) -> http.client.HTTPConnection:
+        self.stats["connections"] += 1
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _release(self, conn: http.client.HTTPConnection, res: http.client.HTTPResponse):
+        # 応答を読み切っていて、サーバーが接続を閉じない場合だけプールに戻す
+        if res.isclosed() and not res.will_close:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    @contextmanager
+    def request(self, method: str, path: str, body: bytes,
+                headers: Dict[str, str]) -> Iterator[http.client.HTTPResponse]:
+        """path は base_url からの相対パス。応答は with の中で読み切ること"""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        reused = conn is not None
+        if conn is None:
+            conn = self._connect()
+        try:
+            try:
+                conn.request(method, self.prefix + path, body=body, headers=headers)
+                res = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                if not reused:
+                    raise
+                # 空いている間にサーバーが閉じた接続: 新しい接続で1回だけやり直す
+                conn.close()
+                conn = self._connect()
+                conn.request(method, self.prefix + path, body=body, headers=headers)
+                res = conn.getresponse()
+            if reused:
+                self.stats["reused"] += 1
+        except BaseException:
+            conn.close()
+            raise
+        try:
+            yield res
+        except BaseException:
+            conn.close()
+            raise
+        self._release(conn, res)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def _raise_for_status(res: http.client.HTTPResponse):
+    if res.status < 400:
+        return
+    try:
+        body = json.loads(res.read().decode("utf-8"))
+        message = body.get("error", {}).get("message", res.reason)
+    except Exception:
+        message = str(res.reason)
+    raise GeminiAPIError(res.status, message, _retry_after(res.headers))
+
+
+class GeminiEmbeddingClient:
+    """バッチ・並列・レート制限付きの Embedding クライアント"""
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str = DEFAULT_EMBEDDING_MODEL,
+        base_url: str = GEMINI_API_BASE,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.batch_size = max(1, min(batch_size, 100))
+        self.requests_per_minute = requests_per_minute
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.stats = {"requests": 0, "rate_limited": 0, "failed_batches": 0}
+        self._bucket = TokenBucket(requests_per_minute, burst=self.concurrency)
+
+    def _batch_url(self) -> str:
+        return f"{self.base_url}/{self.model}:batchEmbedContents?key={self.api_key}"
+
+    def _request_batch(self, texts: List[str]) -> List[List[float]]:
+        payload = {
+            "requests": [
+                {"model": self.model, "content": {"parts": [{"text": t}]}}
+                for t in texts
+            ]
+        }
+        data = post_json(self._batch_url(), payload, self.timeout)
+        embeddings = data.get("embeddings", [])
+        if len(embeddings) != len(texts):
+            raise GeminiAPIError(200, f"expected {len(texts)} embeddings, got {len(embeddings)}")
+        return [e["values"] for e in embeddings]
+
+    async def _embed_one_batch(
+        self, texts: List[str], sem: asyncio.Semaphore
+    ) -> List[Optional[List[float]]]:
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            try:
+                async with sem:
+                    self.stats["requests"] += 1
+                    return await asyncio.to_thread(self._request_batch, texts)
+            except GeminiAPIError as e:
+                if e.status not in _RETRY_STATUS or attempt == self.max_retries:
+                    print(f"      [Error] Embedding batch failed: {e}")
+                    break
+                if e.status == 429:
+                    self.stats["rate_limited"] += 1
+                delay = e.retry_after if e.retry_after is not None else backoff_delay(attempt)
+                await asyncio.sleep(delay)
+            except (urllib.error.URLError, OSError) as e:
+                print(f"      [Error] Embedding batch failed: {e}")
+                break
+        self.stats["failed_batches"] += 1
+        return [None] * len(texts)
+
+    async def embed_async(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """texts の Embedding を返す (失敗したバッチの要素は None)"""
+        sem = asyncio.Semaphore(self.concurrency)
+        batches = [
+            texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)
+        ]
+        results = await asyncio.gather(
+            *(self._embed_one_batch(b, sem) for b in batches)
+        )
+        return [vec for batch in results for vec in batch]
+
+    def embed(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """同期版 embed_async"""
+        if not texts:
+            return []
+        return asyncio.run(self.embed_async(texts))
+
+
+class GeminiGenerationClient:
+    """回答生成クライアント (streamGenerateContent の SSE を逐次読み出す)"""
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str = DEFAULT_GENERATION_MODEL,
+        base_url: str = GEMINI_API_BASE,
+        timeout: float = DEFAULT_TIMEOUT,
+        pool_size: int = DEFAULT_POOL_SIZE,
+    ):
+        self.api_key = api_key
+        self.model = model if model.startswith("models/") else f"models/{model}"
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.pool = ConnectionPool(self.base_url, pool_size, timeout)
+
+    def _payload(self, prompt: str) -> bytes:
+        return json.dumps(
+            {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        ).encode("utf-8")
+
+    def _path(self, method: str, **query) -> str:
+        query["key"] = self.api_key
+        return f"/{self.model}:{method}?{urllib.parse.urlencode(query)}"
+
+    def generate(self, prompt: str) -> str:
+        """回答全体を一度に取得"""
+        with self.pool.request(
+            "POST", self._path("generateContent"), self._payload(prompt),
+            {"Content-Type": "application/json"},
+        ) as res:
+            _raise_for_status(res)
+            response = json.loads(res.read().decode("utf-8"))
+        return "".join(_candidate_texts(response))
+
+    def stream_generate(self, prompt: str) -> Iterator[str]:
+        """生成されたテキスト片を届いた順に返す"""
+        with self.pool.request(
+            "POST", self._path("streamGenerateContent", alt="sse"), self._payload(prompt),
+            {"Content-Type": "application/json", "Accept": "text/event-stream"},
+        ) as res:
+            _raise_for_status(res)
+            usage: Dict[str, Any] = {}
+            for raw in res:
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if not data or data == "[DONE]":
+                    continue
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    err = chunk["error"]
+                    raise GeminiAPIError(err.get("code", 500), err.get("message", "stream error"))
+                # 使用トークン数は各チャンクに累計で入る (最後の値を記録)
+                usage = chunk.get("usageMetadata") or usage
+                for text in _candidate_texts(chunk):
+                    yield text
+            if usage:
+                METRICS.incr("prompt_tokens", usage.get("promptTokenCount", 0))
+                METRICS.incr("output_tokens", usage.get("candidatesTokenCount", 0))
+
+
+def _candidate_texts(response: Dict[str, Any]) -> List[str]:
+    """generateContent 応答から最初の候補のテキスト部分を取り出す"""
+    candidates = response.get("candidates") or []
+    if not candidates:
+        return []
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return [p["text"] for p in parts if "text" in p]
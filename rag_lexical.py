@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_lexical.py
+
+文字 n-gram (2-gram/3-gram) の転置インデックスと BM25 スコアリング。
+形態素解析なしで日本語の社名・製品名 ("Seraphic", "日立ソリューションズ" 等) を拾う。
+- ベクトル検索とは Reciprocal Rank Fusion (RRF) で統合
+- BM25 の上位候補だけをベクトルで採点する事前絞り込みにも使う
+
+インデックスファイルの隣に保存する (構築元のインデックスの版も記録して読み込み時に照合):
+    rag_index.json -> rag_index.lex.npz
+    rag_index.idx/ -> rag_index.idx/v-<番号>/lexical.npz (公開中の版のディレクトリ)
+"""
+
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from rag_store import data_version, is_binary_index, load_index, resolve_index
+
+NGRAM_SIZES = (2, 3)
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+
+def lexical_path_for(index_path: str) -> str:
+    """インデックスに対応する転置インデックスファイルのパス"""
+    if is_binary_index(index_path):
+        return os.path.join(resolve_index(index_path), "lexical.npz")
+    return os.path.splitext(index_path)[0] + ".lex.npz"
+
+
+def char_ngrams(text: str, sizes: Sequence[int] = NGRAM_SIZES) -> Counter:
+    """正規化したテキストの文字 n-gram の出現回数"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    grams: Counter = Counter()
+    for n in sizes:
+        grams.update(text[i:i + n] for i in range(len(text) - n + 1))
+    # 前後が空白の n-gram (語の境界) は除外
+    for g in [g for g in grams if g.strip() != g]:
+        del grams[g]
+    return grams
+
+
+class LexicalIndex:
+    """CSR 形式の転置インデックス (term -> [(文書, 出現回数)])"""
+
+    def __init__(self, terms: np.ndarray, offsets: np.ndarray, doc_ids: np.ndarray,
+                 tfs: np.ndarray, doc_len: np.ndarray):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.vocab: Dict[str, int] = {str(t): i for i, t in enumerate(terms)}
+        self.n_docs = len(doc_len)
+        self.avgdl = float(doc_len.mean()) if self.n_docs else 0.0
+
+    @classmethod
+    def build(cls, texts: Iterable[str]) -> "LexicalIndex":
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        doc_len = []
+        for doc_id, text in enumerate(texts):
+            grams = char_ngrams(text)
+            doc_len.append(sum(grams.values()))
+            for g, tf in grams.items():
+                postings.setdefault(g, []).append((doc_id, tf))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(postings[t]) for t in terms], out=offsets[1:])
+        doc_ids = np.empty(offsets[-1], dtype=np.int32)
+        tfs = np.empty(offsets[-1], dtype=np.float32)
+        for i, t in enumerate(terms):
+            plist = postings[t]
+            doc_ids[offsets[i]:offsets[i + 1]] = [d for d, _ in plist]
+            tfs[offsets[i]:offsets[i + 1]] = [tf for _, tf in plist]
+        return cls(np.array(terms, dtype=str), offsets, doc_ids, tfs,
+                   np.array(doc_len, dtype=np.float32))
+
+    def scores(self, query: str) -> np.ndarray:
+        """全文書の BM25 スコア (一致しない文書は 0)"""
+        out = np.zeros(self.n_docs, dtype=np.float32)
+        if not self.n_docs:
+            return out
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len / max(self.avgdl, 1e-9))
+        for g, qtf in char_ngrams(query).items():
+            t = self.vocab.get(g)
+            if t is None:
+                continue
+            ids = self.doc_ids[self.offsets[t]:self.offsets[t + 1]]
+            tf = self.tfs[self.offsets[t]:self.offsets[t + 1]]
+            idf = np.log1p((self.n_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            # 同じ term 内では文書IDは重複しないので直接加算できる
+            out[ids] += qtf * idf * tf * (BM25_K1 + 1) / (tf + norm[ids])
+        return out
+
+    def search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 上位 k 件 (スコア 0 の文書は返さない)"""
+        scores = self.scores(query)
+        hits = np.flatnonzero(scores > 0)
+        if not len(hits):
+            return hits.astype(np.int64), scores[hits]
+        k = min(k, len(hits))
+        top = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return top.astype(np.int64), scores[top]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "terms": self.terms,
+            "offsets": self.offsets,
+            "doc_ids": self.doc_ids,
+            "tfs": self.tfs,
+            "doc_len": self.doc_len,
+        }
+
+
+def rrf_fuse(rankings: Sequence[Sequence[int]], k: int = RRF_K) -> Tuple[List[int], List[float]]:
+    """Reciprocal Rank Fusion: 複数の順位リストを 1/(k + 順位) の和で統合"""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            fused[int(doc)] = fused.get(int(doc), 0.0) + 1.0 / (k + rank + 1)
+    order = sorted(fused, key=fused.get, reverse=True)
+    return order, [fused[d] for d in order]
+
+
+def save_lexical_index(index: LexicalIndex, path: str, source: str = ""):
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, source=np.array(source), **index.to_arrays())
+    os.replace(tmp_path, path)
+
+
+def load_lexical_index(index_path: str, n_docs: int) -> Optional[LexicalIndex]:
+    """
+    インデックスの隣の転置インデックスを読み込む
+    無い・構築元の版 (古いファイルは件数) が合わなければ None
+    """
+    path = lexical_path_for(index_path)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        source = str(data["source"]) if "source" in data.files else ""
+        index = LexicalIndex(data["terms"], data["offsets"], data["doc_ids"],
+                             data["tfs"], data["doc_len"])
+    if (source and source != data_version(index_path)) or index.n_docs != n_docs:
+        print(f"Warning: {path} is stale (built from another version). Lexical search disabled.")
+        return None
+    return index
+
+
+def build_lexical_for_index(index_path: str) -> Optional[str]:
+    """保存済みインデックスのパッセージ本文から転置インデックスを構築して保存"""
+    docs, _, _ = load_index(index_path)
+    if not docs:
+        return None
+    path = lexical_path_for(index_path)
+    save_lexical_index(LexicalIndex.build(d["text"] for d in docs), path, data_version(index_path))
+    return path
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_metrics.py
+
+軽量な計測レイヤー (スパン = 処理時間、カウンタ = 件数・バイト数・トークン数など)。
+- 無効時 (既定) は span() が共有の何もしないコンテキストを返すだけなので、ほぼコストなし
+- 有効化は METRICS.enable() (各スクリプトの --metrics)
+- summary() で JSON 用の要約、to_prometheus() で Prometheus のテキスト形式を返す
+
+    from rag_metrics import METRICS
+    with METRICS.span("encode"):
+        vec = model.encode(...)
+    METRICS.incr("documents")
+"""
+
+import sys
+import json
+import time
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+# パーセンタイル計算用に保持する直近の計測数 (スパンごと)
+SAMPLE_SIZE = 2048
+
+
+class _NullSpan:
+    """無効時に返す何もしないコンテキスト"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("_metrics", "_name", "_started")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe(self._name, time.perf_counter() - self._started)
+        return False
+
+
+class _SpanStats:
+    __slots__ = ("count", "total", "max", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples: Deque[float] = deque(maxlen=SAMPLE_SIZE)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Metrics:
+    """スパンとカウンタの集計 (スレッドセーフ)"""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._spans: Dict[str, _SpanStats] = {}
+        self._counters: Dict[str, float] = {}
+        self._started = time.time()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+            self._counters.clear()
+            self._started = time.time()
+
+    def span(self, name: str):
+        """with METRICS.span("search"): ... で処理時間を記録"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def observe(self, name: str, seconds: float):
+        """計測済みの処理時間 (秒) を記録 (別プロセスで測った時間など)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._spans.get(name)
+            if stats is None:
+                stats = self._spans[name] = _SpanStats()
+            stats.add(seconds)
+
+    def incr(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = {
+                name: {
+                    "count": s.count,
+                    "total_sec": round(s.total, 6),
+                    "mean_ms": round(s.total / s.count * 1000, 3),
+                    "p50_ms": round(s.quantile(0.5) * 1000, 3),
+                    "p99_ms": round(s.quantile(0.99) * 1000, 3),
+                    "max_ms": round(s.max * 1000, 3),
+                }
+                for name, s in sorted(self._spans.items())
+            }
+            counters = dict(sorted(self._counters.items()))
+        return {
+            "uptime_sec": round(time.time() - self._started, 3),
+            "spans": spans,
+            "counters": counters,
+        }
+
+    def to_prometheus(self, prefix: str = "rag") -> str:
+        """Prometheus のテキスト形式 (スパンは summary、カウンタは counter)"""
+        lines = [
+            f"# HELP {prefix}_span_seconds Time spent in each pipeline stage.",
+            f"# TYPE {prefix}_span_seconds summary",
+        ]
+        with self._lock:
+            for name, s in sorted(self._spans.items()):
+                for q in (0.5, 0.99):
+                    lines.append(f'{prefix}_span_seconds{{span="{name}",quantile="{q}"}} '
+                                 f"{s.quantile(q):.6f}")
+                lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {s.total:.6f}')
+                lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {s.count}')
+            for name, value in sorted(self._counters.items()):
+                metric = f"{prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: Optional[str]):
+        """JSON 要約を path に書き出す ("-" なら標準エラー出力)"""
+        if not path:
+            return
+        data = json.dumps(self.summary(), ensure_ascii=False, indent=2)
+        if path == "-":
+            print(data, file=sys.stderr)
+            return
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(data + "\n")
+        print(f"Metrics written to {path}", file=sys.stderr)
+
+
+# プロセス全体で共有する既定インスタンス
+METRICS = Metrics()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_pdf.py
+
+PDF のテキスト抽出 (pdfplumber)。
+- ページを1枚ずつ取り出すジェネレーターで、必要な文字数が集まったら残りのページは解析しない
+- 各ページが抽出テキストのどこから始まるか [(文字オフセット, ページ番号)] を記録し、
+  パッセージにページ番号を付けられるようにする
+"""
+
+from typing import Iterator, List, Optional, Tuple
+
+from rag_chunker import clean_text
+
+# (抽出テキスト内の開始オフセット, ページ番号) のリスト (オフセット昇順)
+PageOffsets = List[Tuple[int, int]]
+
+PAGE_SEPARATOR = "\n\n"
+
+
+def iter_pdf_pages(path) -> Iterator[Tuple[int, str]]:
+    """(ページ番号, テキスト) を1ページずつ返す (途中で止めれば残りは読まない)"""
+    import pdfplumber  # type: ignore
+
+    with pdfplumber.open(path) as pdf:
+        for page_num, page in enumerate(pdf.pages, 1):
+            try:
+                text = page.extract_text() or ""
+            finally:
+                # 解析済みのレイアウト情報を解放 (大きなPDFでメモリが増え続けない)
+                page.close()
+            yield page_num, text
+
+
+def extract_pdf_text(path, max_chars: Optional[int] = None) -> Tuple[str, PageOffsets]:
+    """
+    PDF の本文 (ページごとに clean_text し空行で連結) とページオフセットを返す
+    max_chars を指定すると、その文字数に達した時点で以降のページを読まない
+    """
+    parts: List[str] = []
+    pages: PageOffsets = []
+    length = 0
+    for page_num, raw in iter_pdf_pages(path):
+        text = clean_text(raw)
+        if not text:
+            continue
+        if parts:
+            length += len(PAGE_SEPARATOR)
+        pages.append((length, page_num))
+        parts.append(text)
+        length += len(text)
+        if max_chars and length >= max_chars:
+            break
+    return PAGE_SEPARATOR.join(parts), pages
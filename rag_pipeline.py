@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_pipeline.py
+
+インデックス構築用の抽出パイプライン (producer/consumer)。
+- テキスト抽出 (pdfplumber等, CPU律速) をプロセスプールで並列実行
+- 結果は上限付きキューに流し、呼び出し側 (Embedding生成) が順次消費
+- ファイル単位で例外を隔離 (ワーカーが落ちた場合は単独で再試行)
+- 計測が有効ならワーカー内での処理時間を "extract" スパンとして記録
+- 呼び出し側が torch などのスレッドを起動済みなら start_method="spawn" を渡す
+  (fork した子プロセスが親のロックを引き継いで止まるのを避ける)
+"""
+
+import os
+import time
+import multiprocessing
+import queue
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Tuple
+
+from rag_metrics import METRICS
+
+# 既定ワーカー数 (Embedding用に1コア残す)
+DEFAULT_WORKERS: int = max(1, (os.cpu_count() or 2) - 1)
+# 抽出済みでEmbedding待ちの最大件数
+DEFAULT_QUEUE_SIZE: int = 16
+
+_DONE = object()
+
+
+class ExtractionError(Exception):
+    """ファイル単位の抽出失敗"""
+
+
+def _timed_call(fn: Callable, *args) -> Tuple[float, Any]:
+    """ワーカー側で fn の処理時間を測って (秒, 結果) を返す"""
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def _put(out_q: "queue.Queue", item: Any, stop: threading.Event) -> bool:
+    """停止要求を確認しながらキューに投入 (満杯なら待機 = バックプレッシャー)"""
+    while not stop.is_set():
+        try:
+            out_q.put(item, timeout=0.2)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _run_pool(
+    fn: Callable,
+    jobs: List[Tuple[int, Sequence[Any]]],
+    workers: int,
+    max_inflight: int,
+    out_q: "queue.Queue",
+    stop: threading.Event,
+    start_method: Optional[str] = None,
+) -> List[Tuple[int, Sequence[Any]]]:
+    """プールで jobs を処理し、プール破損で失われたジョブを返す"""
+    broken: List[Tuple[int, Sequence[Any]]] = []
+    todo = iter(jobs)
+    ctx = multiprocessing.get_context(start_method)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+        inflight = {}
+
+        def submit_next() -> bool:
+            for job in todo:
+                try:
+                    inflight[executor.submit(fn, *job[1])] = job
+                except BrokenProcessPool:
+                    broken.append(job)
+                    continue
+                return True
+            return False
+
+        for _ in range(max_inflight):
+            if not submit_next():
+                break
+
+        while inflight and not stop.is_set():
+            done, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+            for fut in done:
+                job = inflight.pop(fut)
+                try:
+                    item = (job[1], fut.result(), None)
+                except BrokenProcessPool:
+                    broken.append(job)
+                    continue
+                except Exception as e:
+                    item = (job[1], None, ExtractionError(f"{type(e).__name__}: {e}"))
+                if not _put(out_q, item, stop):
+                    return []
+                submit_next()
+
+        if stop.is_set():
+            for fut in inflight:
+                fut.cancel()
+    return broken
+
+
+def _produce(
+    fn: Callable,
+    items: Sequence[Sequence[Any]],
+    workers: int,
+    queue_size: int,
+    out_q: "queue.Queue",
+    stop: threading.Event,
+    start_method: Optional[str] = None,
+):
+    try:
+        if workers <= 0:
+            # プールを使わずに逐次実行 (デバッグ用)
+            for args in items:
+                try:
+                    item = (args, fn(*args), None)
+                except Exception as e:
+                    item = (args, None, ExtractionError(f"{type(e).__name__}: {e}"))
+                if not _put(out_q, item, stop):
+                    return
+        else:
+            jobs = list(enumerate(items))
+            broken = _run_pool(fn, jobs, workers, workers + queue_size, out_q, stop,
+                               start_method)
+            # ワーカーが異常終了した場合: 巻き添えになったファイルを1件ずつ再試行
+            for job in broken:
+                if stop.is_set():
+                    break
+                if _run_pool(fn, [job], 1, 1, out_q, stop, start_method):
+                    err = ExtractionError("worker process crashed")
+                    if not _put(out_q, (job[1], None, err), stop):
+                        return
+    except BaseException as e:  # 呼び出し側で再送出
+        _put(out_q, e, stop)
+    finally:
+        _put(out_q, _DONE, stop)
+
+
+def iter_extracted(
+    fn: Callable,
+    items: Sequence[Sequence[Any]],
+    workers: int = DEFAULT_WORKERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    start_method: Optional[str] = None,
+) -> Iterator[Tuple[Sequence[Any], Any, Optional[ExtractionError]]]:
+    """
+    items の各引数タプルで fn を並列実行し、完了順に (引数, 結果, エラー) を返す
+    fn はプロセス間で受け渡せるようモジュールのトップレベル関数であること
+    start_method: ワーカーの起動方式 ("spawn" など, None ならプラットフォームの既定)
+    """
+    out_q: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+    stop = threading.Event()
+    timed = METRICS.enabled
+    producer = threading.Thread(
+        target=_produce,
+        args=(partial(_timed_call, fn) if timed else fn, items, workers, queue_size,
+              out_q, stop, start_method),
+        daemon=True,
+    )
+    producer.start()
+    try:
+        while True:
+            item = out_q.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            if timed and item[2] is None:
+                elapsed, result = item[1]
+                METRICS.observe("extract", elapsed)
+                item = (item[0], result, None)
+            yield item
+    finally:
+        stop.set()
+        producer.join()
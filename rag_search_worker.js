@@ -0,0 +1,156 @@
+// rag_search_worker.js
+//
+// new_index.html の検索を Web Worker で行う (スライドのアニメーションを止めない)。
+// - rag_bundle/ (python rag_bundle.py で作成) があれば型付き配列のまま読み込む
+//   (int8 または float16 のベクトル、メタデータは上位 k 件のファイルだけ取得)
+// - 無ければ従来の rag_index.json を読み込み、ワーカー内で型付き配列に変換する
+//
+// メッセージ:
+//   {type: "load", bundle: "rag_bundle/", fallback: "rag_index.json"}
+//       -> {type: "ready", count, dim, source} / {type: "error", message}
+//   {type: "search", id, vector, k, minScore}
+//       -> {type: "results", id, results: [{score, id, title, source, page, offset, text}]}
+
+let index = null;
+
+// float16 (IEEE 754 半精度) -> float32
+function halfToFloat(h) {
+    const sign = h & 0x8000 ? -1 : 1;
+    const exp = (h >> 10) & 0x1f;
+    const frac = h & 0x3ff;
+    if (exp === 0) return sign * frac * 2 ** -24;
+    if (exp === 31) return frac ? NaN : sign * Infinity;
+    return sign * (1 + frac / 1024) * 2 ** (exp - 15);
+}
+
+function normalize(vec) {
+    let norm = 0;
+    for (let i = 0; i < vec.length; i++) norm += vec[i] * vec[i];
+    norm = Math.sqrt(norm) || 1;
+    const out = new Float32Array(vec.length);
+    for (let i = 0; i < vec.length; i++) out[i] = vec[i] / norm;
+    return out;
+}
+
+async function loadBundle(base) {
+    const manifestRes = await fetch(base + "manifest.json");
+    if (!manifestRes.ok) throw new Error(`HTTP ${manifestRes.status}: ${base}manifest.json`);
+    const manifest = await manifestRes.json();
+    const vecRes = await fetch(base + manifest.vectors);
+    if (!vecRes.ok) throw new Error(`HTTP ${vecRes.status}: ${base}${manifest.vectors}`);
+    const buf = await vecRes.arrayBuffer();
+
+    let vectors;
+    if (manifest.dtype === "int8") {
+        vectors = new Int8Array(buf);
+    } else {
+        // float16 は読み込み時に一度だけ float32 に展開する
+        const half = new Uint16Array(buf);
+        vectors = new Float32Array(half.length);
+        for (let i = 0; i < half.length; i++) vectors[i] = halfToFloat(half[i]);
+    }
+    const metaCache = new Map();
+    return {
+        count: manifest.count,
+        dim: manifest.dim,
+        vectors,
+        scale: manifest.scale ? Float32Array.from(manifest.scale) : null,
+        source: base,
+        // 行番号 -> メタデータ (必要なファイルだけ取得してキャッシュ)
+        async meta(row) {
+            const chunk = Math.floor(row / manifest.meta_chunk);
+            if (!metaCache.has(chunk)) {
+                const url = base + manifest.meta.replace("{chunk}", String(chunk));
+                metaCache.set(chunk, fetch(url).then(r => {
+                    if (!r.ok) throw new Error(`HTTP ${r.status}: ${url}`);
+                    return r.json();
+                }));
+            }
+            return (await metaCache.get(chunk))[row % manifest.meta_chunk];
+        },
+    };
+}
+
+async function loadJson(url) {
+    const r = await fetch(url);
+    if (!r.ok) throw new Error(`HTTP ${r.status}: ${url}`);
+    const data = await r.json();
+    const docs = (Array.isArray(data) ? data : []).filter(d => d.embedding && d.embedding.length);
+    const dim = docs.length ? docs[0].embedding.length : 0;
+    const vectors = new Float32Array(docs.length * dim);
+    docs.forEach((d, i) => {
+        vectors.set(normalize(d.embedding), i * dim);
+        delete d.embedding;
+    });
+    return {
+        count: docs.length, dim, vectors, scale: null, source: url,
+        async meta(row) { return docs[row]; },
+    };
+}
+
+// 上位 k 件 (全件の sort はしない: k 件の降順バッファに挿入する)
+function topK(query, k) {
+    const { count, dim, vectors, scale } = index;
+    let q = query;
+    if (scale) {
+        // int8: sum(code * scale * q) = code . (scale * q)
+        q = new Float32Array(dim);
+        for (let j = 0; j < dim; j++) q[j] = query[j] * scale[j];
+    }
+    const ids = new Int32Array(k).fill(-1);
+    const scores = new Float32Array(k).fill(-Infinity);
+    for (let row = 0, base = 0; row < count; row++, base += dim) {
+        let s = 0;
+        for (let j = 0; j < dim; j++) s += vectors[base + j] * q[j];
+        if (s <= scores[k - 1]) continue;
+        let pos = k - 1;
+        while (pos > 0 && scores[pos - 1] < s) {
+            scores[pos] = scores[pos - 1];
+            ids[pos] = ids[pos - 1];
+            pos--;
+        }
+        scores[pos] = s;
+        ids[pos] = row;
+    }
+    const hits = [];
+    for (let i = 0; i < k; i++) if (ids[i] >= 0) hits.push({ row: ids[i], score: scores[i] });
+    return hits;
+}
+
+async function search({ id, vector, k = 3, minScore = -Infinity }) {
+    if (!index || !index.count) {
+        postMessage({ type: "results", id, results: [] });
+        return;
+    }
+    if (vector.length !== index.dim) {
+        throw new Error(`query has ${vector.length} dims, index has ${index.dim}`);
+    }
+    const hits = topK(normalize(vector), Math.max(1, k)).filter(h => h.score > minScore);
+    const results = await Promise.all(hits.map(async h => {
+        const m = await index.meta(h.row);
+        return {
+            score: h.score, id: m.id, title: m.title, source: m.source,
+            page: m.page, offset: m.offset, text: m.text,
+        };
+    }));
+    postMessage({ type: "results", id, results });
+}
+
+self.onmessage = async (e) => {
+    const msg = e.data;
+    try {
+        if (msg.type === "load") {
+            try {
+                index = await loadBundle(msg.bundle);
+            } catch (err) {
+                if (!msg.fallback) throw err;
+                index = await loadJson(msg.fallback);
+            }
+            postMessage({ type: "ready", count: index.count, dim: index.dim, source: index.source });
+        } else if (msg.type === "search") {
+            await search(msg);
+        }
+    } catch (err) {
+        postMessage({ type: "error", id: msg.id, message: String(err && err.message || err) });
+    }
+};
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_server.py
+
+RAGChatbot を常駐させるローカル HTTP サービス (asyncio・標準ライブラリのみ)。
+複数のプレゼン用PCやキオスク端末のブラウザから、読み込み済みの E5 モデルを共有する。
+
+    python rag_server.py --index rag_index_local.json --api-key YOUR_KEY --port 8765
+
+    POST /search  {"query": "...", "top_k": 5, "mode": "hybrid"}
+        -> {"results": [{"score", "rrf", "id", "source", "offset", "page", "title", "text"}, ...]}
+        score はクエリとのコサイン類似度、rrf は hybrid / prefilter の順位付けに使った RRF スコア
+    POST /answer  {"query": "...", "top_k": 5, "stream": false}
+        -> {"answer": "...", "sources": [...], "context_tokens": ..., "ttft_sec": ..., "total_sec": ...}
+        stream=true の場合は SSE (data: {"text": "..."}) で逐次返す
+    GET  /health  -> 読み込み状況とカウンタ
+    GET  /metrics -> 各段階の処理時間・カウンタ (Prometheus のテキスト形式)
+
+- 短い時間窓 (--batch-window-ms) に届いた質問は1回の embedder.encode にまとめる
+- 処理中のリクエストが --max-pending を超えたら 503 (Retry-After) で即座に断る
+- 回答生成の同時実行数は --max-answers、Gemini への接続はプールして使い回す
+- ビルダーが新しいインデックスを公開したら --reload-interval 秒以内に読み込み直す (再起動は不要)
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+from query_rag import (
+    DEFAULT_RELOAD_INTERVAL,
+    DEFAULT_RETRIEVAL_MODE,
+    GENERATION_MODEL_NAME,
+    RETRIEVAL_MODES,
+    TOP_K,
+    RAGChatbot,
+    score_fields,
+)
+from rag_cache import (
+    DEFAULT_ANSWER_CACHE_SIZE,
+    DEFAULT_ANSWER_SIMILARITY,
+    DEFAULT_ANSWER_TTL,
+    DEFAULT_QUERY_CACHE_SIZE,
+)
+from rag_context import DEFAULT_CONTEXT_TOKENS
+from rag_gemini import GEMINI_API_BASE, GeminiGenerationClient
+from rag_metrics import METRICS
+
+# === 設定 ===
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# 質問をまとめる時間窓と1回の encode の最大件数
+DEFAULT_BATCH_WINDOW_MS = 5.0
+DEFAULT_MAX_BATCH = 32
+# 同時に受け付けるリクエスト数 (これを超えたら 503) と同時に生成する回答数
+DEFAULT_MAX_PENDING = 64
+DEFAULT_MAX_ANSWERS = 8
+MAX_TOP_K = 50
+MAX_BODY_BYTES = 64 * 1024
+MAX_HEADERS = 64
+KEEPALIVE_TIMEOUT = 30.0
+
+_REASONS = {
+    200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class QueryEncodeBatcher:
+    """
+    複数スレッドから届いた質問を短い時間窓でまとめ、1回の encode で処理する
+    encode(query) は呼び出し元スレッドをブロックしてベクトルを返す
+    """
+
+    def __init__(self, encode_batch, window=DEFAULT_BATCH_WINDOW_MS / 1000.0,
+                 max_batch=DEFAULT_MAX_BATCH):
+        self._encode_batch = encode_batch
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self._pending = []
+        self._cond = threading.Condition()
+        self.stats = {"batches": 0, "queries": 0}
+        threading.Thread(target=self._run, name="rag-encode", daemon=True).start()
+
+    def encode(self, query):
+        fut = Future()
+        with self._cond:
+            self._pending.append((query, fut))
+            self._cond.notify()
+        return fut.result()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            # 最初の質問から window 秒だけ後続を待つ (max_batch 件そろえば即実行)
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                vectors = self._encode_batch([q for q, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            self.stats["batches"] += 1
+            self.stats["queries"] += len(batch)
+            for (_, fut), vec in zip(batch, vectors):
+                fut.set_result(vec)
+
+
+def _result_json(r, with_text=True):
+    item = {
+        **score_fields(r),
+        "id": r["id"],
+        "source": r["source"],
+        "offset": r["offset"],
+        "page": r["page"],
+        "title": r["title"],
+    }
+    if r.get("alternates"):
+        item["alternates"] = [
+            {k: a[k] for k in ("source", "page", "offset") if k in a} for a in r["alternates"]
+        ]
+    if with_text:
+        item["text"] = r["text"]
+    return item
+
+
+async def _read_request(reader):
+    """HTTP/1.1 リクエストを1件読む (接続が閉じられたら None)"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPError(400, "too many headers")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPError(400, "invalid Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, "request body too large")
+    body = await reader.readexactly(length) if length > 0 else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+class RAGServer:
+    def __init__(self, bot, max_pending=DEFAULT_MAX_PENDING,
+                 max_answers=DEFAULT_MAX_ANSWERS, max_batch=DEFAULT_MAX_BATCH,
+                 batch_window_ms=DEFAULT_BATCH_WINDOW_MS):
+        self.bot = bot
+        self.max_pending = max_pending
+        self.batcher = QueryEncodeBatcher(
+            bot.encode_queries, batch_window_ms / 1000.0, max_batch
+        )
+        bot.query_encoder = self.batcher.encode
+        # 検索スレッドは encode 待ちでブロックするので、まとめたい件数分だけ用意する
+        self._search_pool = ThreadPoolExecutor(max_batch, thread_name_prefix="rag-search")
+        self._answer_pool = ThreadPoolExecutor(max_answers, thread_name_prefix="rag-answer")
+        self._answer_slots = asyncio.Semaphore(max_answers)
+        self._pending = 0
+        self.stats = {"search": 0, "answer": 0, "rejected": 0, "errors": 0}
+
+    # === HTTP ===
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader), KEEPALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HTTPError as e:
+                    await self._send_json(writer, e.status, {"error": str(e)}, close=True)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                close = headers.get("connection", "").lower() == "close"
+                keep_open = await self._dispatch(method, path, body, writer, close)
+                if close or not keep_open:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body, writer, close):
+        """応答を書き、接続を維持できるなら True を返す"""
+        routes = {"/search": self.search, "/answer": self.answer}
+        try:
+            if method == "OPTIONS":
+                await self._send(writer, 204, b"", close=close)
+                return True
+            if path == "/health":
+                await self._send_json(writer, 200, self.health(), close)
+                return True
+            if path == "/metrics":
+                body = self.prometheus().encode("utf-8")
+                await self._send(writer, 200, body, "text/plain; version=0.0.4", close)
+                return True
+            if path not in routes:
+                raise HTTPError(404, f"unknown path: {path}")
+            if method != "POST":
+                raise HTTPError(405, "use POST")
+            if self._pending >= self.max_pending:
+                self.stats["rejected"] += 1
+                raise HTTPError(503, "server busy", {"Retry-After": "1"})
+            try:
+                request = json.loads(body or b"{}")
+                query = str(request["query"]).strip()
+            except (ValueError, KeyError, TypeError):
+                raise HTTPError(400, 'body must be JSON with a "query" field')
+            if not query:
+                raise HTTPError(400, "empty query")
+            self._pending += 1
+            try:
+                with METRICS.span("request" + path.replace("/", "_")):
+                    return await routes[path](query, request, writer, close)
+            finally:
+                self._pending -= 1
+        except HTTPError as e:
+            await self._send_json(writer, e.status, {"error": str(e)}, close, e.headers)
+            return True
+        except Exception as e:
+            self.stats["errors"] += 1
+            await self._send_json(writer, 500, {"error": str(e)}, close)
+            return True
+
+    async def _send(self, writer, status, body, content_type="application/json",
+                    close=False, headers=None):
+        lines = [
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            "Access-Control-Allow-Origin: *",
+            "Access-Control-Allow-Headers: Content-Type",
+            "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+            f"Connection: {'close' if close else 'keep-alive'}",
+        ]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _send_json(self, writer, status, data, close=False, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        await self._send(writer, status, body, "application/json; charset=utf-8",
+                         close, headers)
+
+    # === エンドポイント ===
+
+    def health(self):
+        return {
+            "ready": self.bot.is_ready,
+            "published": self.bot.published,
+            "pending": self._pending,
+            "stats": self.stats,
+            "encode_batches": self.batcher.stats,
+            "generation_pool": self.bot.generator.pool.stats,
+        }
+
+    def prometheus(self):
+        """METRICS の内容にサーバー固有のゲージ・カウンタを加えたもの"""
+        lines = [
+            "# TYPE rag_server_ready gauge",
+            f"rag_server_ready {int(self.bot.is_ready)}",
+            "# TYPE rag_server_pending_requests gauge",
+            f"rag_server_pending_requests {self._pending}",
+            "# TYPE rag_server_requests_total counter",
+        ]
+        lines += [f'rag_server_requests_total{{kind="{k}"}} {v}' for k, v in self.stats.items()]
+        lines += [
+            "# TYPE rag_server_encode_batches_total counter",
+            f"rag_server_encode_batches_total {self.batcher.stats['batches']}",
+        ]
+        return METRICS.to_prometheus() + "\n".join(lines) + "\n"
+
+    async def _search(self, query, request):
+        top_k = max(1, min(int(request.get("top_k") or TOP_K), MAX_TOP_K))
+        mode = request.get("mode")
+        if mode is not None and mode not in RETRIEVAL_MODES:
+            raise HTTPError(400, f"mode must be one of {list(RETRIEVAL_MODES)}")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._search_pool, partial(self.bot.search, query, top_k, mode=mode)
+        )
+
+    async def search(self, query, request, writer, close):
+        results = await self._search(query, request)
+        self.stats["search"] += 1
+        await self._send_json(writer, 200, {"results": [_result_json(r) for r in results]}, close)
+        return True
+
+    async def answer(self, query, request, writer, close):
+        results = await self._search(query, request)
+        sources = [_result_json(r, with_text=False) for r in results]
+        loop = asyncio.get_running_loop()
+        timing = {}
+        context = {}
+        async with self._answer_slots:
+            self.stats["answer"] += 1
+            if not request.get("stream"):
+                answer = await loop.run_in_executor(
+                    self._answer_pool,
+                    lambda: "".join(self.bot.generate_answer(query, results, timing, context)),
+                )
+                data = {"answer": answer, "sources": sources,
+                        "context_tokens": context.get("tokens")}
+                data.update({f"{k}_sec": round(v, 3) for k, v in timing.items()})
+                await self._send_json(writer, 200, data, close)
+                return True
+            await self._stream_answer(query, results, sources, timing, context, writer)
+            return False
+
+    async def _stream_answer(self, query, results, sources, timing, context, writer):
+        """回答を SSE で逐次送る (長さが決まらないので送信後に接続を閉じる)"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for token in self.bot.generate_answer(query, results, timing, context):
+                    if cancelled.is_set():
+                        # 途中で切断された: 生成を打ち切って Gemini への接続も閉じる
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, token)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        def event(data):
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n"
+            b"Cache-Control: no-cache\r\nAccess-Control-Allow-Origin: *\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        writer.write(event({"sources": sources}))
+        producer = loop.run_in_executor(self._answer_pool, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    final = {k + "_sec": round(v, 3) for k, v in timing.items()}
+                    final["context_tokens"] = context.get("tokens")
+                    writer.write(event(final))
+                    break
+                if isinstance(item, Exception):
+                    self.stats["errors"] += 1
+                    writer.write(event({"error": str(item)}))
+                    break
+                writer.write(event({"text": item}))
+                await writer.drain()
+            await writer.drain()
+        finally:
+            cancelled.set()
+            await producer
+
+
+async def watch_index(bot, interval):
+    """公開されたインデックスを定期的に確認して読み込み直す (読み込みはスレッドで行う)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(None, bot.reload_if_published)
+
+
+async def serve(server, host, port, reload_interval=DEFAULT_RELOAD_INTERVAL):
+    loop = asyncio.get_running_loop()
+    # モデルとインデックスの読み込み完了を待ってから受け付ける
+    await loop.run_in_executor(None, server.bot.wait_until_ready)
+    tcp = await asyncio.start_server(server.handle, host, port)
+    print(f"RAG server listening on http://{host}:{port} "
+          f"(POST /search, POST /answer, GET /health, GET /metrics)")
+    watcher = None
+    if reload_interval > 0:
+        watcher = asyncio.create_task(watch_index(server.bot, reload_interval))
+    try:
+        async with tcp:
+            await tcp.serve_forever()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve RAG search/answer over HTTP")
+    parser.add_argument("--index", default="rag_index_local.json",
+                        help="Path to the index file (.json or binary .idx directory)")
+    parser.add_argument("--api-key", required=True, help="Google Gemini API Key")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--mode", choices=RETRIEVAL_MODES, default=DEFAULT_RETRIEVAL_MODE)
+    parser.add_argument("--nprobe", type=int, default=None)
+    parser.add_argument("--ef", type=int, default=None)
+    parser.add_argument("--rescore", type=int, default=None)
+    parser.add_argument("--shard-workers", type=int, default=None,
+                        help="Sharded index: search processes (default: one per CPU)")
+    parser.add_argument("--context-tokens", type=int, default=DEFAULT_CONTEXT_TOKENS,
+                        help="Token budget for retrieved passages in the Gemini prompt")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_QUERY_CACHE_SIZE)
+    parser.add_argument("--answer-cache-size", type=int, default=DEFAULT_ANSWER_CACHE_SIZE,
+                        help="Answer cache entries (0 = always call Gemini)")
+    parser.add_argument("--answer-cache", default=None,
+                        help="Persist the answer cache to this file on shutdown")
+    parser.add_argument("--answer-similarity", type=float, default=DEFAULT_ANSWER_SIMILARITY,
+                        help="Reuse an answer at or above this query cosine similarity")
+    parser.add_argument("--answer-ttl", type=float, default=DEFAULT_ANSWER_TTL,
+                        help="Answer cache lifetime in seconds (0 = no expiry)")
+    parser.add_argument(
+        "--batch-window-ms", type=float, default=DEFAULT_BATCH_WINDOW_MS,
+        help="Coalesce queries arriving within this window into one encode call"
+    )
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH,
+                        help="Maximum queries per encode call")
+    parser.add_argument("--max-pending", type=int, default=DEFAULT_MAX_PENDING,
+                        help="Reject requests with 503 beyond this many in flight")
+    parser.add_argument("--max-answers", type=int, default=DEFAULT_MAX_ANSWERS,
+                        help="Concurrent Gemini generations (and pooled connections)")
+    parser.add_argument("--api-base", default=GEMINI_API_BASE,
+                        help="Gemini API base URL (e.g. a local fake endpoint for testing)")
+    parser.add_argument("--reload-interval", type=float, default=DEFAULT_RELOAD_INTERVAL,
+                        help="Seconds between checks for a newly published index (0 = never)")
+    parser.add_argument("--metrics", default=None, metavar="FILE",
+                        help="Also write a JSON metrics summary here on shutdown")
+    args = parser.parse_args()
+    # 常駐モードでは常に計測し、GET /metrics で公開する
+    METRICS.enable()
+
+    bot = RAGChatbot(
+        args.index, args.api_key, nprobe=args.nprobe, ef=args.ef, rescore=args.rescore,
+        cache_size=args.cache_size, mode=args.mode, api_base=args.api_base,
+        shard_workers=args.shard_workers, context_tokens=args.context_tokens,
+        answer_cache_size=args.answer_cache_size, answer_cache_path=args.answer_cache,
+        answer_similarity=args.answer_similarity, answer_ttl=args.answer_ttl,
+    )
+    bot.generator = GeminiGenerationClient(
+        args.api_key, model=GENERATION_MODEL_NAME, base_url=args.api_base,
+        pool_size=args.max_answers,
+    )
+    server = RAGServer(bot, args.max_pending, args.max_answers, args.max_batch,
+                       args.batch_window_ms)
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.reload_interval))
+    except KeyboardInterrupt:
+        print("\nStopped.", file=sys.stderr)
+    finally:
+        if bot.is_ready:
+            bot.answer_cache.save()
+        METRICS.dump(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
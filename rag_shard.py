@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_shard.py
+
+シャード分割されたインデックス (rag_store.save_index(..., shards=N)) の並列検索。
+シャードをワーカープロセスに固定で割り当て、各ワーカーが担当シャードの部分 top-k を返し、
+親プロセスでそれらをまとめて全体の top-k にする。
+
+- ベクトル本体は各ワーカーが vectors.npy をメモリマップで開く
+  (OS のページキャッシュを全プロセスで共有するので、ワーカーを増やしてもコピーは増えない)
+- プロセス間で受け渡すのはクエリベクトルと k 件の (通し番号, スコア) だけ
+- 各シャードの ANN 構造 (shard-000/ann.npz ...) は担当ワーカーだけが読み込む
+- ワーカーは spawn で起動する (読み込み済みの検索モデルやスレッドを引き継がない)
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from rag_store import load_index, read_manifest, shard_paths
+from rag_vector_index import (
+    BruteForceIndex,
+    load_vector_index,
+    normalized_vectors,
+    top_k_indices,
+)
+
+# ワーカープロセス内: 担当シャードの (先頭の通し番号, 検索インデックス)
+_WORKER_SHARDS: List[Tuple[int, Any]] = []
+
+
+def open_shard(path: str):
+    """1シャードの検索インデックス (ANN 構造が無ければ全件走査)"""
+    _, vectors, manifest = load_index(path)
+    vectors = normalized_vectors(vectors, manifest)
+    return load_vector_index(path, vectors) or BruteForceIndex(vectors)
+
+
+def merge_top_k(ids_list: Sequence[np.ndarray], scores_list: Sequence[np.ndarray],
+                k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """複数の部分 top-k をスコア順にまとめて上位 k 件にする"""
+    if not ids_list:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    ids = np.concatenate(ids_list)
+    scores = np.concatenate(scores_list)
+    top = top_k_indices(scores, k)
+    return ids[top], scores[top]
+
+
+def _search_shards(shards: Sequence[Tuple[int, Any]], query: np.ndarray, k: int,
+                   params: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    ids_list, scores_list = [], []
+    for offset, index in shards:
+        ids, scores = index.search(query, k, **params)
+        ids_list.append(np.asarray(ids, dtype=np.int64) + offset)
+        scores_list.append(np.asarray(scores, dtype=np.float32))
+    return merge_top_k(ids_list, scores_list, k)
+
+
+def _init_worker(shards: Sequence[Tuple[int, str]]):
+    _WORKER_SHARDS[:] = [(offset, open_shard(path)) for offset, path in shards]
+
+
+def _worker_ready() -> int:
+    return len(_WORKER_SHARDS)
+
+
+def _worker_search(query: np.ndarray, k: int,
+                   params: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    return _search_shards(_WORKER_SHARDS, query, k, params)
+
+
+class ShardedIndex:
+    """
+    シャードごとの検索をワーカープロセスに振り分ける (他の検索インデックスと同じ search())
+    workers: ワーカー数 (None = min(シャード数, CPU数), 0 = 同じプロセスで順に検索)
+    """
+
+    def __init__(self, index_path: str, workers: Optional[int] = None):
+        paths = shard_paths(index_path)
+        counts = [read_manifest(p)["count"] for p in paths]
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        shards = [(int(o), p) for o, p in zip(offsets, paths)]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = max(0, min(workers, len(paths)))
+        self.kind = f"sharded ({len(paths)} shards, {self.workers} workers)"
+        self._local: List[Tuple[int, Any]] = []
+        self._pools: List[ProcessPoolExecutor] = []
+
+        if not self.workers:
+            self._local = [(offset, open_shard(path)) for offset, path in shards]
+            return
+        # ワーカーごとに担当シャードを固定する (ANN 構造を複数のプロセスで重複して持たない)
+        ctx = multiprocessing.get_context("spawn")
+        self._pools = [
+            ProcessPoolExecutor(max_workers=1, mp_context=ctx, initializer=_init_worker,
+                                initargs=(shards[w::self.workers],))
+            for w in range(self.workers)
+        ]
+        # 最初の検索を待たせないよう、ここでワーカーを起動してシャードを開かせる
+        for fut in [pool.submit(_worker_ready) for pool in self._pools]:
+            fut.result()
+
+    def search(self, query: np.ndarray, k: int, **params) -> Tuple[np.ndarray, np.ndarray]:
+        query = np.asarray(query, dtype=np.float32).ravel()
+        if not self._pools:
+            return _search_shards(self._local, query, k, params)
+        futures = [pool.submit(_worker_search, query, k, params) for pool in self._pools]
+        parts = [fut.result() for fut in futures]
+        return merge_top_k([ids for ids, _ in parts], [scores for _, scores in parts], k)
+
+    def close(self):
+        """ワーカープロセスを終了する (インデックスを読み込み直したとき)"""
+        for pool in self._pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._pools = []
+
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_store.py
+
+バイナリ形式のRAGインデックス (ディレクトリ) の読み書き。
+
+    <name>.idx/
+      v-<番号>/         保存ごとの版 (公開マーカー <name>.idx.published.json が今の版を指す)
+        manifest.json   モデル名・次元数・正規化の有無・版 ("build") などのメタ情報
+        vectors.npy     float32/float16 の連続行列 (np.load(mmap_mode="r") で開く)
+        meta.jsonl      1行1パッセージのメタデータ (id, title, source, offset, text)
+
+保存は新しい版ディレクトリに書いてからマーカーを切り替えるので、検索プロセスが
+メモリマップしている古い版を消したり上書きしたりしない (古い版の削除は rag_watch.publish)。
+版に分かれる前の形式 (<name>.idx/ の直下に manifest.json) もそのまま読める。
+
+大規模なコーパスは N 個のシャードに分割して保存できる (save_index(..., shards=N)):
+
+    <name>.idx/v-<番号>/
+      manifest.json   全体の情報と "shards": ["shard-000", ...]
+      shard-000/      上と同じ構成の独立したインデックス (通し番号順に連続した範囲)
+      ...
+
+従来の rag_index.json (インデント付きJSON) からの変換も可能:
+    python rag_store.py rag_index.json rag_index.idx --dtype float16
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+from rag_watch import VERSION_PREFIX, new_version, published_version
+from rag_watch import publish as publish_version
+
+FORMAT_NAME = "rag-index"
+FORMAT_VERSION = 2
+# シャード分割 (manifest の "shards") は version 2 から。分割しない場合は 1 のまま書く
+SHARDED_VERSION = 2
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "meta.jsonl"
+SHARD_DIR = "shard-{:03d}"
+
+DTYPES = {"float32": np.float32, "float16": np.float16}
+
+# 次元数から推定するモデル名 (JSONにはモデル名が記録されていないため)
+KNOWN_MODELS = {
+    1024: "intfloat/multilingual-e5-large",
+    768: "models/text-embedding-004",
+}
+
+
+def _has_manifest(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def resolve_index(path: str) -> str:
+    """
+    読み込む版のディレクトリ
+    公開マーカーの指す版 -> 版に分かれていない .idx -> 最新の版 の順に探す
+    (JSON や版のディレクトリ自体はそのまま返す)
+    """
+    version = published_version(path)
+    if version and _has_manifest(os.path.join(path, version)):
+        return os.path.normpath(os.path.join(path, version))
+    if _has_manifest(path) or not os.path.isdir(path):
+        return path
+    # マーカーが無い (公開前に中断した等) 場合は保存済みの最新の版
+    versions = sorted(
+        name for name in os.listdir(path)
+        if name.startswith(VERSION_PREFIX) and _has_manifest(os.path.join(path, name))
+    )
+    return os.path.join(path, versions[-1]) if versions else path
+
+
+def is_binary_index(path: str) -> bool:
+    """path がバイナリ形式のインデックスか"""
+    return _has_manifest(resolve_index(path))
+
+
+def read_manifest(path: str) -> Dict[str, Any]:
+    path = resolve_index(path)
+    with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT_NAME:
+        raise ValueError(f"{path}: not a {FORMAT_NAME} directory")
+    if manifest.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(f"{path}: unsupported index version {manifest['version']}")
+    return manifest
+
+
+def is_sharded_index(path: str) -> bool:
+    """path がシャード分割されたバイナリ形式のインデックスか"""
+    return is_binary_index(path) and bool(read_manifest(path).get("shards"))
+
+
+def shard_paths(path: str) -> List[str]:
+    """シャードのディレクトリ一覧 (分割されていなければ path 自身のみ)"""
+    path = resolve_index(path)
+    names = read_manifest(path).get("shards") or []
+    return [os.path.join(path, name) for name in names] or [path]
+
+
+def _write_index_dir(path: str, matrix: np.ndarray, docs: List[Dict[str, Any]],
+                     manifest: Dict[str, Any], dtype: str):
+    os.makedirs(path)
+    np.save(os.path.join(path, VECTORS_FILE), matrix.astype(DTYPES[dtype]))
+    with open(os.path.join(path, METADATA_FILE), "w", encoding="utf-8") as f:
+        for d in docs:
+            meta = {k: v for k, v in d.items() if k != "embedding"}
+            f.write(json.dumps(meta, ensure_ascii=False, separators=(",", ":")) + "\n")
+    with open(os.path.join(path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def save_index(
+    path: str,
+    docs: List[Dict[str, Any]],
+    model: str,
+    dtype: str = "float32",
+    normalize: bool = True,
+    shards: int = 1,
+    publish: bool = True,
+) -> Dict[str, Any]:
+    """
+    Embedding付きの文書リストをバイナリ形式で新しい版ディレクトリに保存 (一時ディレクトリ経由)
+    Embeddingの無い文書は保存しない
+    shards > 1 なら文書の順番のまま件数がほぼ均等な shards 個のシャードに分ける
+    publish=False なら公開しない (ANN などを版ディレクトリ os.path.join(path, manifest["build"])
+    に書き足してから rag_watch.publish(path, manifest["build"]) で公開する)
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {sorted(DTYPES)}")
+
+    embedded = [d for d in docs if d.get("embedding") is not None]
+    dim = len(embedded[0]["embedding"]) if embedded else 0
+    matrix = np.zeros((len(embedded), dim), dtype=np.float32)
+    for i, d in enumerate(embedded):
+        matrix[i] = d["embedding"]
+    if normalize and len(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1.0, norms)
+
+    build = new_version()
+    manifest = {
+        "format": FORMAT_NAME,
+        "version": 1,
+        "build": build,
+        "model": model,
+        "dim": dim,
+        "count": len(embedded),
+        "dtype": dtype,
+        "normalized": bool(normalize),
+        "vectors": VECTORS_FILE,
+        "metadata": METADATA_FILE,
+    }
+
+    os.makedirs(path, exist_ok=True)
+    tmp_path = os.path.join(path, build + ".tmp")
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    shards = max(1, min(shards, len(embedded)))
+    if shards == 1:
+        _write_index_dir(tmp_path, matrix, embedded, manifest, dtype)
+    else:
+        os.makedirs(tmp_path)
+        bounds = np.linspace(0, len(embedded), shards + 1).astype(np.int64)
+        names = []
+        for i in range(shards):
+            lo, hi = int(bounds[i]), int(bounds[i + 1])
+            names.append(SHARD_DIR.format(i))
+            _write_index_dir(os.path.join(tmp_path, names[-1]), matrix[lo:hi],
+                             embedded[lo:hi], dict(manifest, count=hi - lo), dtype)
+        manifest = {k: v for k, v in manifest.items() if k not in ("vectors", "metadata")}
+        manifest.update(version=SHARDED_VERSION, shards=names)
+        with open(os.path.join(tmp_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # 新しい名前のディレクトリへの rename なので、読み込み中の版には触れない
+    os.rename(tmp_path, os.path.join(path, build))
+    if publish:
+        publish_version(path, build)
+    return manifest
+
+
+def _index_files(path: str) -> List[str]:
+    """版ディレクトリ内のファイル (シャードのディレクトリも含める)"""
+    return sorted(
+        os.path.join(dirpath, name)
+        for dirpath, dirnames, names in os.walk(path)
+        for name in names if not name.endswith(".tmp")
+    )
+
+
+def index_version(path: str) -> str:
+    """
+    インデックスの版を表す文字列 (キャッシュ無効化用)
+    マニフェスト内容と各ファイルのサイズ・更新時刻から作る
+    """
+    path = resolve_index(path)
+    if is_binary_index(path):
+        files = _index_files(path)
+    else:
+        base = os.path.splitext(path)[0]
+        files = [
+            f for f in (path, base + ".ann.npz", base + ".lex.npz") if os.path.exists(f)
+        ]
+    return _files_digest(files)
+
+
+def data_version(path: str) -> str:
+    """
+    ベクトルと本文の版 (ANN・転置インデックスが元のインデックスと合っているかの確認用)
+    バイナリ形式は保存ごとの "build"、無ければ (古い形式・JSON) ANN などを除くファイルから作る
+    """
+    path = resolve_index(path)
+    if is_binary_index(path):
+        build = read_manifest(path).get("build")
+        if build:
+            return build
+        files = [f for f in _index_files(path) if not f.endswith(".npz")]
+    else:
+        files = [path]
+    return _files_digest(files)
+
+
+def _files_digest(files: List[str]) -> str:
+    h = hashlib.blake2b(digest_size=12)
+    for f in files:
+        st = os.stat(f)
+        h.update(f"{os.path.basename(f)}:{st.st_size}:{st.st_mtime_ns};".encode())
+        if f.endswith(MANIFEST_FILE):
+            with open(f, "rb") as mf:
+                h.update(mf.read())
+    return h.hexdigest()
+
+
+def load_index(
+    path: str, mmap: bool = True
+) -> Tuple[List[Dict[str, Any]], np.ndarray, Dict[str, Any]]:
+    """
+    インデックスを読み込んで (メタデータ, ベクトル行列, マニフェスト) を返す
+    バイナリ形式なら行列はメモリマップ、JSONなら従来通り全件読み込み
+    シャード分割されていればメタデータは通し番号順に連結し、行列は ShardedVectors
+    (mmap=False なら連結した行列)
+    """
+    path = resolve_index(path)
+    if not is_binary_index(path):
+        return load_json_index(path)
+
+    manifest = read_manifest(path)
+    if manifest.get("shards"):
+        parts = [load_index(p, mmap) for p in shard_paths(path)]
+        docs = [d for part_docs, _, _ in parts for d in part_docs]
+        matrices = [vectors for _, vectors, _ in parts]
+        vectors = ShardedVectors(matrices) if mmap else np.concatenate(matrices)
+        return docs, vectors, manifest
+
+    vectors = np.load(
+        os.path.join(path, manifest.get("vectors", VECTORS_FILE)),
+        mmap_mode="r" if mmap else None,
+    )
+    docs = []
+    with open(os.path.join(path, manifest.get("metadata", METADATA_FILE)),
+              "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                docs.append(json.loads(line))
+    if len(docs) != vectors.shape[0]:
+        raise ValueError(
+            f"{path}: metadata has {len(docs)} rows but vectors has {vectors.shape[0]}"
+        )
+    return docs, vectors, manifest
+
+
+def load_json_index(
+    path: str, model: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], np.ndarray, Dict[str, Any]]:
+    """従来のJSONインデックスを (メタデータ, ベクトル行列, マニフェスト) として読み込む"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    embedded = [d for d in data if d.get("embedding")]
+    vectors = np.array([d.pop("embedding") for d in embedded], dtype=np.float32)
+    dim = vectors.shape[1] if vectors.ndim == 2 else 0
+    manifest = {
+        "format": "json",
+        "model": model or KNOWN_MODELS.get(dim, "unknown"),
+        "dim": dim,
+        "count": len(embedded),
+        "dtype": "float32",
+        "normalized": False,
+    }
+    return embedded, vectors, manifest
+
+
+def load_docs_with_embeddings(path: str) -> List[Dict[str, Any]]:
+    """差分更新用: 形式を問わず embedding 付きの文書リストとして読み込む"""
+    if not is_binary_index(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    docs, vectors, _ = load_index(path, mmap=False)
+    for d, vec in zip(docs, vectors.astype(np.float32)):
+        d["embedding"] = vec
+    return docs
+
+
+class ShardedVectors:
+    """
+    シャードごとのメモリマップ行列を1つの行列として読む (連結したコピーは作らない)
+    範囲スライスと行番号の配列による取り出しに対応する
+    """
+
+    def __init__(self, parts: List[np.ndarray]):
+        self.parts = parts
+        self.offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([p.shape[0] for p in parts], out=self.offsets[1:])
+        self.shape = (int(self.offsets[-1]), parts[0].shape[1])
+        self.dtype = parts[0].dtype
+        self.ndim = 2
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+            pieces = []
+            for part, lo in zip(self.parts, self.offsets):
+                a, b = max(start - lo, 0), min(stop - lo, part.shape[0])
+                if a < b:
+                    pieces.append(part[a:b])
+            if len(pieces) == 1:
+                return pieces[0]
+            if not pieces:
+                return np.empty((0, self.shape[1]), dtype=self.dtype)
+            return np.concatenate(pieces)
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(len(self)))
+        ids = np.asarray(key, dtype=np.int64)
+        shard = np.searchsorted(self.offsets, ids, side="right") - 1
+        if ids.ndim == 0:
+            return self.parts[shard][ids - self.offsets[shard]]
+        out = np.empty((len(ids), self.shape[1]), dtype=self.dtype)
+        for s in np.unique(shard):
+            mask = shard == s
+            out[mask] = self.parts[s][ids[mask] - self.offsets[s]]
+        return out
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        out = np.concatenate(self.parts)
+        return out if dtype is None else out.astype(dtype)
+
+
+def dot_scores(vectors: np.ndarray, query: np.ndarray, block: int = 65536) -> np.ndarray:
+    """
+    行列とクエリベクトルの内積をブロック単位で計算
+    (float16 やメモリマップ行列を丸ごと float32 に展開しない)
+    """
+    query = np.asarray(query, dtype=np.float32).ravel()
+    out = np.empty(vectors.shape[0], dtype=np.float32)
+    for start in range(0, vectors.shape[0], block):
+        part = np.asarray(vectors[start:start + block], dtype=np.float32)
+        out[start:start + block] = part @ query
+    return out
+
+
+def batch_dot_scores(vectors: np.ndarray, queries: np.ndarray, block: int = 65536) -> np.ndarray:
+    """複数クエリ (nq, dim) と行列の内積 (nq, n) をブロック単位の行列積で計算"""
+    queries = np.asarray(queries, dtype=np.float32)
+    out = np.empty((queries.shape[0], vectors.shape[0]), dtype=np.float32)
+    for start in range(0, vectors.shape[0], block):
+        part = np.asarray(vectors[start:start + block], dtype=np.float32)
+        out[:, start:start + block] = queries @ part.T
+    return out
+
+
+def convert_json_index(
+    json_path: str,
+    out_path: str,
+    model: Optional[str] = None,
+    dtype: str = "float32",
+    normalize: bool = True,
+    shards: int = 1,
+) -> Dict[str, Any]:
+    """rag_index.json をバイナリ形式に変換"""
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    embedded = [d for d in data if d.get("embedding")]
+    dim = len(embedded[0]["embedding"]) if embedded else 0
+    model = model or KNOWN_MODELS.get(dim, "unknown")
+    skipped = len(data) - len(embedded)
+    if skipped:
+        print(f"Warning: {skipped} entries without embedding were skipped.")
+    return save_index(out_path, embedded, model, dtype=dtype, normalize=normalize,
+                      shards=shards)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert rag_index.json to binary index")
+    parser.add_argument("src", help="JSON index (e.g. rag_index.json)")
+    parser.add_argument("dst", help="output directory (e.g. rag_index.idx)")
+    parser.add_argument("--model", default=None, help="embedding model name")
+    parser.add_argument("--dtype", choices=sorted(DTYPES), default="float32")
+    parser.add_argument("--no-normalize", action="store_true",
+                        help="store vectors as-is (no L2 normalization)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split into N shards (searched in parallel by query_rag.py)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.src):
+        print(f"Error: {args.src} not found")
+        sys.exit(1)
+    manifest = convert_json_index(
+        args.src, args.dst, args.model, args.dtype, not args.no_normalize, args.shards
+    )
+    shards = len(manifest.get("shards", [])) or 1
+    print(f"✓ {manifest['count']} vectors ({manifest['dim']} dim, {manifest['dtype']}, "
+          f"model={manifest['model']}, {shards} shard(s)) -> {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
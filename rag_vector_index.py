@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_vector_index.py
+
+ベクトル検索インデックス (正規化済みベクトルの内積 = コサイン類似度)。
+- brute: 全件の行列積 + argpartition (厳密)
+- ivf:   k-means で粗クラスタリングし、近い nprobe 個のクラスタだけ走査
+- hnsw:  階層型近傍グラフを ef 幅で探索
+- int8:  次元ごとのスケールで int8 量子化したベクトルで一次走査 (クエリも int8 にして int32 で積和)
+- binary: 符号1ビットに量子化したベクトルのハミング距離で一次走査 (メモリ 1/32)
+  量子化の2方式は上位 k * rescore 件だけを元の精度のベクトルで再採点する
+  (バイナリ形式のインデックスなら元のベクトルはメモリマップのまま、再採点する行だけ読む)
+  メモリが 1/4・1/32 で済むのはこの場合だけで、JSON は元のベクトルも全件メモリに読み込む
+
+構造 (ベクトル本体は含まない) はインデックスファイルの隣に保存する:
+    rag_index.json -> rag_index.ann.npz
+    rag_index.idx/ -> rag_index.idx/v-<番号>/ann.npz (公開中の版のディレクトリ)
+    (シャード分割されていればシャードごとに rag_index.idx/v-<番号>/shard-000/ann.npz ...)
+構築元のインデックスの版 (rag_store.data_version) を一緒に保存し、読み込み時に照合する
+"""
+
+import os
+import heapq
+import math
+from abc import ABC, abstractmethod
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+
+from rag_store import (
+    data_version,
+    dot_scores,
+    is_binary_index,
+    is_sharded_index,
+    load_index,
+    resolve_index,
+    shard_paths,
+)
+
+ANN_KINDS = ("brute", "ivf", "hnsw", "int8", "binary")
+
+# "auto" の場合、この件数未満は全件走査 (近似による取りこぼしを避ける)
+AUTO_ANN_MIN = 10000
+
+DEFAULT_NPROBE = 8
+DEFAULT_EF = 64
+# 量子化インデックスで元の精度で再採点する候補数 (top_k の倍数)
+DEFAULT_RESCORE = 8
+# 量子化を行うブロックの行数と、一次走査のブロックの行数
+# (走査側は一時行列がキャッシュに収まる大きさにする)
+QUANT_BLOCK = 65536
+SCAN_BLOCK = 4096
+
+# 0-255 の各値の立っているビット数 (np.bitwise_count が無い numpy 用)
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def ann_path_for(index_path: str) -> str:
+    """インデックスに対応するANNファイルのパス"""
+    if is_binary_index(index_path):
+        return os.path.join(resolve_index(index_path), "ann.npz")
+    return os.path.splitext(index_path)[0] + ".ann.npz"
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコア上位 k 件の位置 (降順)"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part])]
+
+
+def _rows(vectors: np.ndarray, ids) -> np.ndarray:
+    return np.asarray(vectors[ids], dtype=np.float32)
+
+
+class BruteForceIndex:
+    """全件走査 (厳密)"""
+
+    kind = "brute"
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+
+    def search(self, query: np.ndarray, k: int, **_) -> Tuple[np.ndarray, np.ndarray]:
+        scores = dot_scores(self.vectors, query)
+        ids = top_k_indices(scores, k)
+        return ids, scores[ids]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {}
+
+
+class IVFIndex:
+    """転置ファイル (k-means によるクラスタ単位の絞り込み)"""
+
+    kind = "ivf"
+
+    def __init__(self, vectors: np.ndarray, centroids: np.ndarray,
+                 list_offsets: np.ndarray, list_ids: np.ndarray):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: Optional[int] = None,
+              iters: int = 20, seed: int = 0) -> "IVFIndex":
+        n = vectors.shape[0]
+        nlist = nlist or max(1, int(4 * math.sqrt(n)))
+        nlist = max(1, min(nlist, n))
+        rng = np.random.default_rng(seed)
+
+        # 学習はサンプルで行う (クラスタあたり最大256件)
+        sample_ids = np.sort(rng.choice(n, size=min(n, nlist * 256), replace=False))
+        sample = _rows(vectors, sample_ids)
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+                else:
+                    # 空クラスタはランダムな点で置き換え
+                    centroids[c] = sample[rng.integers(len(sample))]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        # 全件をクラスタに割り当て (ブロック単位)
+        assign = np.empty(n, dtype=np.int32)
+        for start in range(0, n, 65536):
+            block = _rows(vectors, slice(start, start + 65536))
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        counts = np.bincount(assign, minlength=nlist)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(vectors, centroids.astype(np.float32), offsets, order)
+
+    def search(self, query: np.ndarray, k: int, nprobe: Optional[int] = None,
+               **_) -> Tuple[np.ndarray, np.ndarray]:
+        query = np.asarray(query, dtype=np.float32).ravel()
+        nprobe = max(1, min(nprobe or DEFAULT_NPROBE, len(self.centroids)))
+        probes = top_k_indices(self.centroids @ query, nprobe)
+        cand = np.sort(np.concatenate([
+            self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes
+        ]))
+        if not len(cand):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = _rows(self.vectors, cand) @ query
+        top = top_k_indices(scores, k)
+        return cand[top].astype(np.int64), scores[top]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "centroids": self.centroids,
+            "list_offsets": self.list_offsets,
+            "list_ids": self.list_ids,
+        }
+
+
+class HNSWIndex:
+    """HNSW (Hierarchical Navigable Small World) グラフ"""
+
+    kind = "hnsw"
+
+    def __init__(self, vectors: np.ndarray, levels: np.ndarray, base: np.ndarray,
+                 upper: np.ndarray, upper_slot: np.ndarray, entry: int, m: int):
+        self.vectors = vectors
+        self.levels = levels          # 各ノードの最上位レベル
+        self.base = base              # (n, 2M) レベル0の近傍 (-1 埋め)
+        self.upper = upper            # (n_upper, max_level, M) レベル1以上の近傍
+        self.upper_slot = upper_slot  # ノード -> upper の行 (-1 ならレベル0のみ)
+        self.entry = entry
+        self.m = m
+
+    # --- 探索 ---
+    def _neighbors(self, node: int, level: int) -> np.ndarray:
+        row = self.base[node] if level == 0 else self.upper[self.upper_slot[node], level - 1]
+        return row[row >= 0]
+
+    def _search_layer(self, query: np.ndarray, entries: List[Tuple[float, int]],
+                      ef: int, level: int, neighbors=None) -> List[Tuple[float, int]]:
+        """レベル内の貪欲探索。(スコア, ノード) を最大 ef 件返す"""
+        neighbors = neighbors or self._neighbors
+        visited = {node for _, node in entries}
+        cand = [(-s, node) for s, node in entries]
+        heapq.heapify(cand)
+        best = list(entries)
+        heapq.heapify(best)
+        while len(best) > ef:
+            heapq.heappop(best)
+        while cand:
+            neg, node = heapq.heappop(cand)
+            if len(best) >= ef and -neg < best[0][0]:
+                break
+            fresh = [n for n in neighbors(node, level) if n not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            scores = _rows(self.vectors, fresh) @ query
+            for n, s in zip(fresh, scores.tolist()):
+                if len(best) < ef or s > best[0][0]:
+                    heapq.heappush(cand, (-s, n))
+                    heapq.heappush(best, (s, n))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+        return sorted(best, reverse=True)
+
+    def search(self, query: np.ndarray, k: int, ef: Optional[int] = None,
+               **_) -> Tuple[np.ndarray, np.ndarray]:
+        query = np.asarray(query, dtype=np.float32).ravel()
+        if self.entry < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ef = max(k, ef or DEFAULT_EF)
+        entries = [(float(_rows(self.vectors, [self.entry])[0] @ query), self.entry)]
+        for level in range(int(self.levels[self.entry]), 0, -1):
+            entries = self._search_layer(query, entries, 1, level)
+        found = self._search_layer(query, entries, ef, 0)[:k]
+        return (np.array([n for _, n in found], dtype=np.int64),
+                np.array([s for s, _ in found], dtype=np.float32))
+
+    # --- 構築 ---
+    @classmethod
+    def build(cls, vectors: np.ndarray, m: int = 16, ef_construction: int = 100,
+              seed: int = 0) -> "HNSWIndex":
+        n = vectors.shape[0]
+        rng = np.random.default_rng(seed)
+        ml = 1.0 / math.log(m)
+        levels = np.floor(-np.log(rng.random(n).clip(1e-12)) * ml).astype(np.int32)
+        graph: List[List[List[int]]] = [[[] for _ in range(lv + 1)] for lv in levels]
+        index = cls(vectors, levels, np.empty((0, 0), np.int32),
+                    np.empty((0, 0, 0), np.int32), np.full(n, -1, np.int32), -1, m)
+
+        def neighbors(node, level):
+            return graph[node][level]
+
+        def select(base_vec, cands: List[Tuple[float, int]], limit: int) -> List[int]:
+            """近傍選択ヒューリスティック (既に選んだ点より近いものだけ採用)"""
+            chosen: List[int] = []
+            chosen_vecs: List[np.ndarray] = []
+            for s, c in cands:
+                if len(chosen) >= limit:
+                    break
+                v = _rows(vectors, [c])[0]
+                if all(float(v @ cv) < s for cv in chosen_vecs):
+                    chosen.append(c)
+                    chosen_vecs.append(v)
+            # 足りなければ近い順に補充
+            for _, c in cands:
+                if len(chosen) >= limit:
+                    break
+                if c not in chosen:
+                    chosen.append(c)
+            return chosen
+
+        for node in range(n):
+            q = _rows(vectors, [node])[0]
+            level = int(levels[node])
+            if index.entry < 0:
+                index.entry = node
+                continue
+            entries = [(float(_rows(vectors, [index.entry])[0] @ q), index.entry)]
+            top = int(levels[index.entry])
+            for lv in range(top, level, -1):
+                entries = index._search_layer(q, entries, 1, lv, neighbors)
+            for lv in range(min(level, top), -1, -1):
+                entries = index._search_layer(q, entries, ef_construction, lv, neighbors)
+                limit = 2 * m if lv == 0 else m
+                chosen = select(q, entries, m)
+                graph[node][lv] = list(chosen)
+                for c in chosen:
+                    links = graph[c][lv]
+                    links.append(node)
+                    if len(links) > limit:
+                        cv = _rows(vectors, [c])[0]
+                        scores = _rows(vectors, links) @ cv
+                        keep = np.argsort(-scores)[:limit]
+                        graph[c][lv] = [links[i] for i in keep]
+            if level > top:
+                index.entry = node
+
+        # 配列に詰め直す
+        base = np.full((n, 2 * m), -1, dtype=np.int32)
+        upper_nodes = np.nonzero(levels > 0)[0]
+        max_level = int(levels.max()) if n else 0
+        upper = np.full((len(upper_nodes), max(max_level, 1), m), -1, dtype=np.int32)
+        upper_slot = np.full(n, -1, dtype=np.int32)
+        upper_slot[upper_nodes] = np.arange(len(upper_nodes), dtype=np.int32)
+        for node in range(n):
+            links = graph[node][0]
+            base[node, :len(links)] = links
+            for lv in range(1, int(levels[node]) + 1):
+                links = graph[node][lv]
+                upper[upper_slot[node], lv - 1, :len(links)] = links
+        return cls(vectors, levels, base, upper, upper_slot, index.entry, m)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "levels": self.levels,
+            "base": self.base,
+            "upper": self.upper,
+            "upper_slot": self.upper_slot,
+            "entry": np.array([self.entry]),
+            "m": np.array([self.m]),
+        }
+
+
+class _QuantizedIndex(ABC):
+    """量子化ベクトルで一次走査し、候補だけを元の精度で再採点する"""
+
+    kind = ""
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+
+    @abstractmethod
+    def _approx_scores(self, query: np.ndarray) -> np.ndarray:
+        """全件の近似スコア (大きいほど近い。順位だけを使う)"""
+
+    @abstractmethod
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """保存する量子化データ"""
+
+    def search(self, query: np.ndarray, k: int, rescore: Optional[int] = None,
+               **_) -> Tuple[np.ndarray, np.ndarray]:
+        query = np.asarray(query, dtype=np.float32).ravel()
+        approx = self._approx_scores(query)
+        cand = np.sort(top_k_indices(approx, k * max(1, rescore or DEFAULT_RESCORE)))
+        if not len(cand):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = _rows(self.vectors, cand) @ query
+        top = top_k_indices(scores, k)
+        return cand[top].astype(np.int64), scores[top]
+
+
+class Int8Index(_QuantizedIndex):
+    """次元ごとのスケール (コーパス中の最大絶対値 / 127) で int8 に量子化"""
+
+    kind = "int8"
+
+    def __init__(self, vectors: np.ndarray, codes: np.ndarray, scale: np.ndarray):
+        super().__init__(vectors)
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def build(cls, vectors: np.ndarray) -> "Int8Index":
+        n, dim = vectors.shape
+        max_abs = np.zeros(dim, dtype=np.float32)
+        for start in range(0, n, QUANT_BLOCK):
+            part = np.abs(np.asarray(vectors[start:start + QUANT_BLOCK], dtype=np.float32))
+            np.maximum(max_abs, part.max(axis=0), out=max_abs)
+        scale = np.where(max_abs == 0, 1.0, max_abs / 127.0).astype(np.float32)
+        codes = np.empty((n, dim), dtype=np.int8)
+        for start in range(0, n, QUANT_BLOCK):
+            part = np.asarray(vectors[start:start + QUANT_BLOCK], dtype=np.float32)
+            codes[start:start + QUANT_BLOCK] = np.clip(np.rint(part / scale), -127, 127)
+        return cls(vectors, codes, scale)
+
+    def _approx_scores(self, query: np.ndarray) -> np.ndarray:
+        # sum(code * scale * q) = code @ (scale * q)
+        # (scale * q) も int8 に量子化し、int8 のまま int32 で積和する (float32 の展開をしない)
+        # 候補の順位だけに使うので、クエリ側の共通のスケールは掛けない
+        scaled = query * self.scale
+        peak = float(np.abs(scaled).max()) if len(scaled) else 0.0
+        if peak == 0:
+            return np.zeros(self.codes.shape[0], dtype=np.int32)
+        q8 = np.rint(scaled * (127.0 / peak)).astype(np.int8)
+        # einsum は小さいバッファ単位で int32 に変換するので、行列全体のコピーを作らない
+        return np.einsum("ij,j->i", self.codes, q8, dtype=np.int32)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {"codes": self.codes, "scale": self.scale}
+
+
+class BinaryIndex(_QuantizedIndex):
+    """
+    各次元の符号を1ビットに量子化 (np.packbits)。類似度は -ハミング距離
+    E5 のベクトルは全体に共通の成分を持つため、コーパス平均を引いてから符号を取る
+    """
+
+    kind = "binary"
+
+    def __init__(self, vectors: np.ndarray, bits: np.ndarray, center: np.ndarray):
+        super().__init__(vectors)
+        self.bits = bits
+        self.center = center
+
+    @classmethod
+    def build(cls, vectors: np.ndarray) -> "BinaryIndex":
+        n, dim = vectors.shape
+        total = np.zeros(dim, dtype=np.float64)
+        for start in range(0, n, QUANT_BLOCK):
+            total += np.asarray(vectors[start:start + QUANT_BLOCK], dtype=np.float32).sum(axis=0)
+        center = (total / max(n, 1)).astype(np.float32)
+        bits = np.empty((n, (dim + 7) // 8), dtype=np.uint8)
+        for start in range(0, n, QUANT_BLOCK):
+            part = np.asarray(vectors[start:start + QUANT_BLOCK], dtype=np.float32)
+            bits[start:start + QUANT_BLOCK] = np.packbits(part > center, axis=1)
+        return cls(vectors, bits, center)
+
+    def _approx_scores(self, query: np.ndarray) -> np.ndarray:
+        qbits = np.packbits(query > self.center)
+        out = np.empty(self.bits.shape[0], dtype=np.float32)
+        for start in range(0, len(out), SCAN_BLOCK):
+            diff = np.bitwise_xor(self.bits[start:start + SCAN_BLOCK], qbits)
+            if hasattr(np, "bitwise_count"):
+                dist = np.bitwise_count(diff).sum(axis=1, dtype=np.int32)
+            else:
+                dist = _POPCOUNT[diff].sum(axis=1, dtype=np.int32)
+            out[start:start + SCAN_BLOCK] = -dist
+        return out
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {"bits": self.bits, "center": self.center}
+
+
+def build_vector_index(vectors: np.ndarray, kind: str = "brute", **params):
+    if kind == "brute":
+        return BruteForceIndex(vectors)
+    if kind == "ivf":
+        return IVFIndex.build(vectors, **params)
+    if kind == "hnsw":
+        return HNSWIndex.build(vectors, **params)
+    if kind == "int8":
+        return Int8Index.build(vectors)
+    if kind == "binary":
+        return BinaryIndex.build(vectors)
+    raise ValueError(f"unknown index kind: {kind} (choose from {ANN_KINDS})")
+
+
+def save_vector_index(index, path: str, source: str = ""):
+    """ANN構造を .npz で保存 (一時ファイル経由, source は構築元のインデックスの版)"""
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, kind=np.array(index.kind), source=np.array(source),
+             count=np.array([index.vectors.shape[0]]), **index.to_arrays())
+    os.replace(tmp_path, path)
+
+
+def load_vector_index(index_path: str, vectors: np.ndarray):
+    """
+    インデックスの隣に保存されたANN構造を読み込む
+    存在しない・構築元の版 (古いファイルは件数) が合わない場合は None (呼び出し側で全件走査に戻す)
+    """
+    path = ann_path_for(index_path)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        arrays = {k: data[k] for k in data.files}
+    source = str(arrays["source"]) if "source" in arrays else ""
+    if (source and source != data_version(index_path)) \
+            or int(arrays["count"][0]) != vectors.shape[0]:
+        print(f"Warning: {path} is stale (built from another version). Using exact search.")
+        return None
+    kind = str(arrays["kind"])
+    if kind == "ivf":
+        return IVFIndex(vectors, arrays["centroids"], arrays["list_offsets"], arrays["list_ids"])
+    if kind == "hnsw":
+        return HNSWIndex(vectors, arrays["levels"], arrays["base"], arrays["upper"],
+                         arrays["upper_slot"], int(arrays["entry"][0]), int(arrays["m"][0]))
+    if kind == "int8":
+        return Int8Index(vectors, arrays["codes"], arrays["scale"])
+    if kind == "binary":
+        return BinaryIndex(vectors, arrays["bits"], arrays["center"])
+    return BruteForceIndex(vectors)
+
+
+def normalized_vectors(vectors: np.ndarray, manifest: Dict[str, Any]) -> np.ndarray:
+    """マニフェストが未正規化なら L2 正規化したコピーを返す"""
+    if manifest.get("normalized"):
+        return vectors
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def build_ann_for_index(index_path: str, kind: str = "auto", **params) -> Optional[str]:
+    """
+    保存済みインデックスからANN構造を構築してインデックスの隣に保存
+    kind: brute / ivf / hnsw / int8 / binary / auto (件数で brute か ivf を選ぶ) / none
+    シャード分割されたインデックスはシャードごとに構築する (auto はシャードの件数で選ぶ)
+    """
+    if is_sharded_index(index_path):
+        built = [build_ann_for_index(p, kind, **params) for p in shard_paths(index_path)]
+        return os.path.join(resolve_index(index_path), "shard-*", "ann.npz") if any(built) else None
+    path = ann_path_for(index_path)
+    if kind == "none":
+        # 古いANN構造が残っていると不整合になるため削除
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    _, vectors, manifest = load_index(index_path)
+    if not len(vectors):
+        return None
+    if kind == "auto":
+        kind = "brute" if len(vectors) < AUTO_ANN_MIN else "ivf"
+    index = build_vector_index(normalized_vectors(vectors, manifest), kind, **params)
+    save_vector_index(index, path, data_version(index_path))
+    return path
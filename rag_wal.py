@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_wal.py
+
+インデックス構築の追記専用ログ (write-ahead log)。
+途中保存のたびにインデックス全体を書き直す代わりに、Embedding済みのパッセージを
+ソースファイル単位で JSONL に追記し、バッチごとに fsync する (保存コストは新しい分だけ)。
+
+    {"source": "docs/a.md", "passages": [{...}, ...], "dim": 1024, "vectors": "<base64 float32>"}
+
+- 1レコード = そのソースのパッセージを丸ごと置き換える (passages が空なら削除)
+- 再開時は本体インデックスを読み込んだ後にログを先頭から再生する
+- 本体インデックスへの保存 (コンパクション) が成功したらログを削除する
+- 書き込み途中で落ちた末尾の不完全な行は再生時に切り捨てる
+"""
+
+import os
+import json
+import base64
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+
+def log_path_for(index_path: str) -> str:
+    """インデックスに対応するログファイルのパス (.idx の中は保存ごとに版が替わるので外に置く)"""
+    return index_path.rstrip("/\\") + ".wal.jsonl"
+
+
+def _encode_record(source: str, passages: Sequence[Dict[str, Any]]) -> bytes:
+    record: Dict[str, Any] = {
+        "source": source,
+        "passages": [{k: v for k, v in p.items() if k != "embedding"} for p in passages],
+    }
+    if passages:
+        vectors = np.asarray([p["embedding"] for p in passages], dtype="<f4")
+        record["dim"] = vectors.shape[1]
+        record["vectors"] = base64.b64encode(vectors.tobytes()).decode("ascii")
+    line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+    return line.encode("utf-8") + b"\n"
+
+
+def _apply_record(record: Dict[str, Any], docs_map: Dict[str, Any],
+                  ids_by_source: Dict[str, List[str]]):
+    source = record["source"]
+    for key in ids_by_source.pop(source, []):
+        docs_map.pop(key, None)
+    passages: List[Dict[str, Any]] = record["passages"]
+    if not passages:
+        return
+    vectors = np.frombuffer(base64.b64decode(record["vectors"]), dtype="<f4")
+    vectors = vectors.reshape(len(passages), record["dim"])
+    for p, vec in zip(passages, vectors):
+        p["embedding"] = vec
+        docs_map[p["id"]] = p
+    ids_by_source[source] = [p["id"] for p in passages]
+
+
+def replay_log(path: str, docs_map: Dict[str, Any]) -> int:
+    """ログを docs_map (ID -> パッセージ) に適用し、適用したレコード数を返す"""
+    if not os.path.exists(path):
+        return 0
+    ids_by_source: Dict[str, List[str]] = {}
+    for key, d in docs_map.items():
+        ids_by_source.setdefault(d.get("source"), []).append(key)
+    applied = 0
+    valid_size = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            _apply_record(record, docs_map, ids_by_source)
+            applied += 1
+            valid_size += len(line)
+    if valid_size < os.path.getsize(path):
+        # 書き込み途中で中断された末尾を捨てる (続けて追記できるように)
+        print(f"Warning: {path}: discarded an incomplete record at the end")
+        with open(path, "r+b") as f:
+            f.truncate(valid_size)
+    return applied
+
+
+class IndexLog:
+    """ソース単位の置き換えレコードを追記するログ (最初の追記時にファイルを開く)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self.records = 0
+        self.bytes_written = 0
+
+    def append(self, source: str, passages: Sequence[Dict[str, Any]]):
+        """置き換えレコードを書き込む (durable にするには続けて sync() を呼ぶ)"""
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        data = _encode_record(source, passages)
+        self._file.write(data)
+        self.records += 1
+        self.bytes_written += len(data)
+
+    def sync(self):
+        """書き込んだレコードをディスクまで反映する"""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """コンパクション済みのログを削除"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self) -> "IndexLog":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
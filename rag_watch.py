@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rag_watch.py
+
+インデックスの監視モード (scripts/build_rag_index.py --watch) 用のファイル監視と、
+作り直したインデックスを検索プロセスへ知らせる公開マーカー。
+
+- watchdog があれば OS のファイル変更通知 (Linux は inotify) を使い、無ければ定期的に走査する
+- 保存やコピーで続けて届く通知は、debounce 秒新しい通知が無くなるまでまとめてから返す
+- ビルダーはインデックス・ANN・転置インデックスを全て書き終えてから
+  <出力>.published.json を一時ファイル経由で置き換える (公開)
+  検索プロセスはこのファイルの公開番号が変わったときだけ読み込み直すので、書きかけを読まない
+- バイナリ形式は保存ごとに別の版ディレクトリ (<出力>.idx/v-<番号>/) に書き、
+  マーカーの "current" で今の版を指す (使用中のディレクトリを消したり置き換えたりしない)
+  1つ前の版は読み込み直しが終わるまでの猶予として残し、それより古い版を公開時に削除する
+
+    pip install watchdog   (requirements.txt に含む。無い環境では定期走査になり、起動時にそう表示する)
+"""
+
+import os
+import json
+import time
+import queue
+import shutil
+from typing import Any, Callable, Dict, Iterator, Optional, Set, Tuple
+
+DEFAULT_DEBOUNCE = 1.0
+DEFAULT_POLL_INTERVAL = 2.0
+
+# 版ディレクトリの名前の接頭辞 (v-<保存時刻の16進>)
+VERSION_PREFIX = "v-"
+# 版に分かれていない古い形式 (.idx の直下に manifest.json) を指す版の名前
+LEGACY_VERSION = "."
+
+# 監視対象か (パス, ディレクトリか)
+PathFilter = Callable[[str, bool], bool]
+
+
+def published_path_for(index_path: str) -> str:
+    """公開マーカーのパス (版ディレクトリを切り替えるために .idx の外に置く)"""
+    return index_path.rstrip("/\\") + ".published.json"
+
+
+def new_version() -> str:
+    """新しい版ディレクトリの名前 (名前順 = 保存順)"""
+    return f"{VERSION_PREFIX}{time.time_ns():016x}"
+
+
+def read_published(index_path: str) -> Dict[str, Any]:
+    """公開マーカーの内容 (無い・壊れていれば空)"""
+    try:
+        with open(published_path_for(index_path), "r", encoding="utf-8") as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return marker if isinstance(marker, dict) else {}
+
+
+def publish(index_path: str, version: Optional[str] = None) -> str:
+    """
+    書き終えたインデックスを公開する (新しい公開番号を返す)
+    version: 公開する版ディレクトリの名前 (バイナリ形式)。1つ前の版より古い版は削除する
+    """
+    marker = read_published(index_path)
+    token = f"{time.time_ns():x}"
+    record: Dict[str, Any] = {"token": token, "published_at": time.time()}
+    if version:
+        previous = marker.get("current")
+        if previous == version:
+            previous = marker.get("previous")
+        elif previous is None and os.path.isfile(os.path.join(index_path, "manifest.json")):
+            previous = LEGACY_VERSION
+        record.update(current=version, previous=previous)
+    path = published_path_for(index_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(record, f)
+    os.replace(tmp_path, path)
+    if version:
+        prune_versions(index_path, {version, record["previous"]})
+    return token
+
+
+def published_token(index_path: str) -> Optional[str]:
+    """現在の公開番号 (マーカーが無ければ None)"""
+    return read_published(index_path).get("token")
+
+
+def published_version(index_path: str) -> Optional[str]:
+    """公開中の版ディレクトリの名前 (版に分かれていなければ None)"""
+    return read_published(index_path).get("current")
+
+
+def prune_versions(index_path: str, keep: Set[Optional[str]]):
+    """
+    keep 以外の版 (公開されずに終わった書きかけも含む) を削除する
+    読み込み中のプロセスがあって消せなかったもの (Windows のメモリマップ等) は次の公開で再試行
+    """
+    try:
+        names = os.listdir(index_path)
+    except OSError:
+        return
+    for name in names:
+        if name in keep:
+            continue
+        # 古い形式のファイルは、その版が不要になるまで残す
+        if LEGACY_VERSION in keep and not name.startswith(VERSION_PREFIX):
+            continue
+        full = os.path.join(index_path, name)
+        if os.path.isdir(full):
+            shutil.rmtree(full, ignore_errors=True)
+        else:
+            try:
+                os.remove(full)
+            except OSError:
+                pass
+
+
+class PollingWatcher:
+    """対象ファイルの (サイズ, 更新時刻) を定期的に比べる (watchdog が無い環境用)"""
+
+    kind = "polling"
+
+    def __init__(self, root: str, accept: PathFilter, interval: float = DEFAULT_POLL_INTERVAL):
+        self.root = root
+        self.accept = accept
+        self.interval = interval
+        self._state = self._snapshot()
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        state = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if self.accept(os.path.join(dirpath, d), True)]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if not self.accept(path, False):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                state[path] = (st.st_size, st.st_mtime_ns)
+        return state
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """変更のあったパス (timeout 秒以内に無ければ空, None なら変更があるまで待つ)"""
+        while True:
+            time.sleep(self.interval if timeout is None else timeout)
+            current = self._snapshot()
+            changed = {p for p in current.keys() | self._state.keys()
+                       if current.get(p) != self._state.get(p)}
+            self._state = current
+            if changed or timeout is not None:
+                return changed
+
+    def close(self):
+        pass
+
+
+class EventWatcher:
+    """OS のファイル変更通知 (watchdog: Linux は inotify, Windows は ReadDirectoryChangesW)"""
+
+    def __init__(self, root: str, accept: PathFilter):
+        from watchdog.events import FileSystemEventHandler  # type: ignore
+        from watchdog.observers import Observer  # type: ignore
+
+        self.accept = accept
+        self._events: "queue.Queue[str]" = queue.Queue()
+        handler = FileSystemEventHandler()
+        handler.on_any_event = self._on_event
+        self._observer = Observer()
+        self._observer.schedule(handler, root, recursive=True)
+        self._observer.start()
+        self.kind = f"file events ({type(self._observer).__name__})"
+
+    def _on_event(self, event):
+        # ディレクトリの更新 (中のファイルの追加など) は、ファイル自体の通知で分かる
+        if event.event_type not in ("created", "modified", "deleted", "moved"):
+            return
+        if event.is_directory and event.event_type == "modified":
+            return
+        for path in (event.src_path, getattr(event, "dest_path", None)):
+            if path and self.accept(os.fsdecode(path), event.is_directory):
+                self._events.put(os.fsdecode(path))
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """変更のあったパス (timeout 秒以内に無ければ空, None なら変更があるまで待つ)"""
+        try:
+            changed = {self._events.get(timeout=timeout)}
+        except queue.Empty:
+            return set()
+        while True:
+            try:
+                changed.add(self._events.get_nowait())
+            except queue.Empty:
+                return changed
+
+    def close(self):
+        self._observer.stop()
+        self._observer.join()
+
+
+def open_watcher(root: str, accept: PathFilter, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 polling: bool = False):
+    """
+    watchdog があれば変更通知、無ければ定期走査
+    polling=True なら常に定期走査 (通知の届かないネットワークドライブ用)
+    """
+    if not polling:
+        try:
+            return EventWatcher(root, accept)
+        except ImportError:
+            pass
+    return PollingWatcher(root, accept, poll_interval)
+
+
+def iter_changes(watcher, debounce: float = DEFAULT_DEBOUNCE) -> Iterator[Set[str]]:
+    """変更されたパスの集合を、debounce 秒新しい変更が無くなるごとにまとめて返す"""
+    while True:
+        changed = watcher.wait()
+        while True:
+            more = watcher.wait(debounce)
+            if not more:
+                break
+            changed |= more
+        yield changed
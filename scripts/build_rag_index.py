@@ -3,32 +3,63 @@
 """
 RAGインデックス構築スクリプト (Lint修正済み)
 - モデル: intfloat/multilingual-e5-large (高精度・日本語対応)
-- 機能: HTML/Markdownクリーニング、バッチ処理、差分更新(レジューム)
+- 機能: HTML/Markdownクリーニング、パッセージ分割、並列抽出、バッチ処理、
+        差分更新 (内容ハッシュで変更・削除を検出)、長さ別バッチ・int8 CPU 推論、
+        抽出結果のキャッシュ (モデルやチャンク設定を変えても PDF を再解析しない)、
+        ほぼ同じ内容のパッセージの除去 (MinHash/LSH, 代表に重複側の出典を記録)、
+        監視モード (--watch: モデルを読み込んだまま、変更されたファイルだけを反映して公開)
 - 完全オフライン動作
 """
 
 import os
 import sys
 import json
+import time
 import argparse
 import warnings
 import re
+import importlib.util
 from pathlib import Path
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Set
 from html.parser import HTMLParser
 
+import numpy as np
+
+# リポジトリ直下の共通モジュールを参照
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from rag_chunker import clean_text, chunk_document  # noqa: E402
+from rag_pdf import PageOffsets, extract_pdf_text  # noqa: E402
+from rag_store import save_index, load_docs_with_embeddings  # noqa: E402
+from rag_pipeline import iter_extracted, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE  # noqa: E402
+from rag_extract_cache import DEFAULT_CACHE_DIR, CachedExtractor, warm_cache  # noqa: E402
+from rag_fingerprint import check_fingerprint, file_fingerprint  # noqa: E402
+from rag_dedup import DEFAULT_DEDUP_THRESHOLD, Deduplicator  # noqa: E402
+from rag_vector_index import ANN_KINDS, ann_path_for, build_ann_for_index  # noqa: E402
+from rag_lexical import build_lexical_for_index, lexical_path_for  # noqa: E402
+from rag_metrics import METRICS  # noqa: E402
+from rag_bundle import BUNDLE_DTYPES, export_bundle, read_bundle_manifest, remove_bundle  # noqa: E402
+from rag_wal import IndexLog, log_path_for, replay_log  # noqa: E402
+from rag_watch import (  # noqa: E402
+    DEFAULT_DEBOUNCE,
+    DEFAULT_POLL_INTERVAL,
+    iter_changes,
+    open_watcher,
+    publish,
+)
+
 # === 依存ライブラリ ===
-try:
-    import pdfplumber  # type: ignore
+# pdfplumber は抽出ワーカー (rag_pdf) だけが読み込む。ここでは存在確認のみ
+if importlib.util.find_spec("pdfplumber") is not None:
     PDF_SUPPORT = True
-except ImportError:
+else:
     PDF_SUPPORT = False
     print("Warning: pdfplumber not installed. PDF support disabled.")
 
-try:
-    from sentence_transformers import SentenceTransformer  # type: ignore
+# 抽出ワーカー (子プロセス) で torch を読み込まないよう、存在確認のみ行う
+# 実際のインポートは LocalEmbeddingGenerator 生成時
+if importlib.util.find_spec("sentence_transformers") is not None:
     LOCAL_EMBEDDING_SUPPORT = True
-except ImportError:
+else:
     LOCAL_EMBEDDING_SUPPORT = False
     print("Error: sentence-transformers not installed.")
     print("Run: pip install sentence-transformers torch")
@@ -49,17 +80,65 @@ class Config:
     # E5モデルは "passage: " というプレフィックスが必要
     PREFIX: str = "passage: "
 
-    # テキスト処理
+    # テキスト処理 (チャンク分割しない場合のみ使用)
     MAX_TEXT_LENGTH: int = 8000
 
-    # バッチ処理 (VRAM不足なら小さくする: 4 or 8)
-    BATCH_SIZE: int = 8
+    # パッセージ分割 (文字数, 0 で分割しない)
+    CHUNK_SIZE: int = 800
+    CHUNK_OVERLAP: int = 100
+
+    # バッチ処理 (このパッセージ数がたまるごとに Embedding を生成)
+    # 途中経過はバッチごとに追記ログ (<出力>.wal.jsonl) へ保存し、最後に本体へまとめて書き込む
+    BATCH_SIZE: int = 128
 
-    # 保存間隔 (バッチ数ごと)
-    SAVE_INTERVAL: int = 10
+    # encode 1回あたりのトークン数の上限 (件数 x バッチ内の最大長、VRAM不足なら小さくする)
+    # バッチ内のパッセージは長さ順に並べて詰めるので、短い文書が長い文書の長さまでパディングされない
+    TOKEN_BUDGET: int = 8192
+
+    # CPU 推論を int8 動的量子化 (Linear 層) で行う
+    # 最初のバッチで元のモデルとのコサイン類似度を確認し、下回れば元のモデルに戻す
+    QUANTIZE: bool = False
+    QUANT_CHECK_SAMPLES: int = 32
+    QUANT_MIN_COSINE: float = 0.98
 
     SUPPRESS_PDF_WARNINGS: bool = True
 
+    # 並列抽出 (プロセス数, 0 でメインプロセスのみ) と抽出済みキューの上限
+    EXTRACT_WORKERS: int = DEFAULT_WORKERS
+    EXTRACT_QUEUE_SIZE: int = DEFAULT_QUEUE_SIZE
+    # 抽出ワーカーの起動方式。監視モードや2回目以降のプールは torch (OpenMP) のスレッドが
+    # 動いているプロセスから作るので、fork せず spawn で起動する
+    EXTRACT_START_METHOD: Optional[str] = "spawn"
+
+    # 抽出結果のキャッシュ (ファイル内容のハッシュごと, None で無効)
+    EXTRACT_CACHE: Optional[str] = DEFAULT_CACHE_DIR
+
+    # ほぼ同じ内容のパッセージの除去 (文字 5-gram の Jaccard 係数の閾値, None で無効)
+    # 重複は Embedding せず、代表のパッセージの "alternates" に出典だけを記録する
+    DEDUP_THRESHOLD: Optional[float] = DEFAULT_DEDUP_THRESHOLD
+
+    # 出力形式 ("json" or "binary") とバイナリ形式のベクトル型
+    OUTPUT_FORMAT: str = "json"
+    VECTOR_DTYPE: str = "float32"
+    # バイナリ形式のシャード数 (1 で分割しない、検索時はシャードごとに並列実行)
+    NUM_SHARDS: int = 1
+
+    # 検索用ANN構造 ("auto", "brute", "ivf", "hnsw", "none")
+    ANN_KIND: str = "auto"
+
+    # 文字 n-gram の転置インデックス (BM25) を作るか
+    BUILD_LEXICAL: bool = True
+
+    # new_index.html 用のブラウザ検索バンドル (None なら出力の隣に既にある場合だけ作り直す)
+    BUNDLE_DIR: Optional[str] = None
+    BUNDLE_DEFAULT_DIR: str = "rag_bundle"
+    BUNDLE_DTYPE: str = "int8"
+
+    # 監視モード: 通知が途切れてから反映するまでの秒数と、定期走査の間隔 (watchdog が無い場合)
+    WATCH_DEBOUNCE: float = DEFAULT_DEBOUNCE
+    WATCH_POLL_INTERVAL: float = DEFAULT_POLL_INTERVAL
+    WATCH_POLLING: bool = False
+
 
 # === HTML処理クラス ===
 class HTMLTextExtractor(HTMLParser):
@@ -91,39 +170,31 @@ def sanitize_filename(filename: str) -> str:
     return s.replace(' ', '_')
 
 
-def extract_text_from_file(path: Path) -> tuple[Optional[str], str]:
+def extract_text_from_file(
+    path: Path, max_chars: Optional[int] = None
+) -> tuple[Optional[str], str, Optional[PageOffsets]]:
     """
-    ファイルパスから (タイトル, テキスト) を抽出
+    ファイルパスから (タイトル, テキスト, ページオフセット) を抽出
     拡張子に応じてHTML処理やPDF処理を分岐
+    PDF はページ単位で読み、max_chars 文字集まった時点で残りのページを読まない
     """
     ext = path.suffix.lower()
     title = path.stem
     text = ""
+    pages = None
 
     try:
         if ext == '.pdf':
             if not PDF_SUPPORT:
-                return None, ""
+                return None, "", None
             # PDF処理
-            pages = []
-            if Config.SUPPRESS_PDF_WARNINGS:
-                with warnings.catch_warnings():
+            with warnings.catch_warnings():
+                if Config.SUPPRESS_PDF_WARNINGS:
                     warnings.filterwarnings('ignore')
-                    with pdfplumber.open(path) as pdf:
-                        for page in pdf.pages:
-                            t = page.extract_text()
-                            if t:
-                                pages.append(t)
-            else:
-                with pdfplumber.open(path) as pdf:
-                    for page in pdf.pages:
-                        t = page.extract_text()
-                        if t:
-                            pages.append(t)
+                text, pages = extract_pdf_text(path, max_chars)
 
-            if not pages:
-                return None, ""
-            text = "\n".join(pages)
+            if not text:
+                return None, "", None
 
         elif ext in {'.html', '.htm'}:
             # HTML処理 (タグ除去)
@@ -154,99 +225,394 @@ def extract_text_from_file(path: Path) -> tuple[Optional[str], str]:
 
     except Exception as e:
         print(f"Warning: Failed to read {path.name}: {e}")
-        return None, ""
+        return None, "", None
 
-    # 共通クリーニング
-    text = re.sub(r'\s+', ' ', text).strip()
-    return title, text
+    # 共通クリーニング (段落区切りは保持、PDF は抽出時に済んでいるのでオフセットは変わらない)
+    text = clean_text(text)
+    return title, text, pages
 
 
 # === Embedding生成クラス ===
+def token_buckets(lengths: List[int], budget: int) -> List[List[int]]:
+    """
+    位置を長さ順に並べ、パディング込みのトークン数 (件数 x 最大長) が budget 以内のバッチに分ける
+    (1件で budget を超える場合はその1件だけのバッチ)
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batches: List[List[int]] = []
+    current: List[int] = []
+    for i in order:
+        # 昇順なので追加する1件がバッチ内の最大長になる
+        if current and (len(current) + 1) * lengths[i] > budget:
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def quantize_model(model: Any) -> Any:
+    """Linear 層の重みを int8 にした動的量子化モデル (CPU専用、元のモデルは変更しない)"""
+    import torch  # type: ignore
+
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
 class LocalEmbeddingGenerator:
-    def __init__(self, model_name: str = Config.EMBEDDING_MODEL):
+    def __init__(self, model_name: str = Config.EMBEDDING_MODEL, model: Any = None):
+        """model に encode() を持つオブジェクトを渡すと読み込みを省略 (ベンチマーク用)"""
+        # 量子化モデルとの比較が済むまで保持する元のモデル
+        self._float_model = None
+        if model is not None:
+            self.model = model
+            return
+        from sentence_transformers import SentenceTransformer  # type: ignore
+
         print(f"\nLoading model: {model_name} ...")
         print("(This may take time on first run)")
-        self.model = SentenceTransformer(model_name)
-        print("✓ Model loaded\n")
-
-    def generate_batch(self, texts: List[str]) -> List[List[float]]:
-        # E5モデル用にプレフィックス "passage: " を付与
-        inputs = [Config.PREFIX + t for t in texts]
-
-        embeddings = self.model.encode(
+        if Config.QUANTIZE:
+            self._float_model = SentenceTransformer(model_name, device="cpu")
+            self.model = quantize_model(self._float_model)
+            print("✓ Model loaded (int8 dynamic quantization, CPU)\n")
+        else:
+            self.model = SentenceTransformer(model_name)
+            print("✓ Model loaded\n")
+
+    def _token_lengths(self, inputs: List[str]) -> List[int]:
+        """各入力のトークン数 (トークナイザが無いモデルは文字数で代用)"""
+        tokenizer = getattr(self.model, "tokenizer", None)
+        if tokenizer is None:
+            return [len(t) for t in inputs]
+        limit = getattr(self.model, "max_seq_length", None) or 512
+        ids = tokenizer(inputs, add_special_tokens=True, truncation=True,
+                        max_length=limit)["input_ids"]
+        return [len(x) for x in ids]
+
+    def _encode(self, model: Any, inputs: List[str]) -> np.ndarray:
+        return model.encode(
             inputs,
-            batch_size=Config.BATCH_SIZE,
+            batch_size=len(inputs),
             convert_to_numpy=True,
             normalize_embeddings=True,
-            show_progress_bar=True
+            show_progress_bar=False
         )
+
+    def _check_quantized(self, inputs: List[str]):
+        """量子化モデルと元のモデルの出力を比較し、ずれが大きければ元のモデルに戻す"""
+        sample = inputs[:Config.QUANT_CHECK_SAMPLES]
+        ref = self._encode(self._float_model, sample)
+        got = self._encode(self.model, sample)
+        cos = np.sum(ref * got, axis=1)
+        print(f"  int8 check: cosine to float model mean {cos.mean():.4f}, "
+              f"min {cos.min():.4f} ({len(sample)} passages)")
+        if cos.min() < Config.QUANT_MIN_COSINE:
+            print(f"  [Warning] int8 model is below {Config.QUANT_MIN_COSINE}. "
+                  "Using the float model.")
+            self.model = self._float_model
+        self._float_model = None
+
+    def generate_batch(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        # E5モデル用にプレフィックス "passage: " を付与
+        inputs = [Config.PREFIX + t for t in texts]
+        if self._float_model is not None:
+            self._check_quantized(inputs)
+
+        # 長さの近いもの同士でバッチを組み、結果は元の順番の位置に書き戻す
+        lengths = self._token_lengths(inputs)
+        embeddings = None
+        for ids in token_buckets(lengths, Config.TOKEN_BUDGET):
+            vecs = self._encode(self.model, [inputs[i] for i in ids])
+            if embeddings is None:
+                embeddings = np.empty((len(inputs), vecs.shape[1]), dtype=np.float32)
+            embeddings[ids] = vecs
+            METRICS.incr("embed_tokens", sum(lengths[i] for i in ids))
+            METRICS.incr("embed_padded_tokens", len(ids) * lengths[ids[-1]])
         return embeddings.tolist()
 
 
 # === インデックス構築 ===
-def build_index(root_dir: str, output_path: str, use_batch: bool = True):
+def is_source_file(file_path: Path) -> bool:
+    """対象拡張子のファイルか (隠しファイルを除く)"""
+    if file_path.name.startswith('.'):
+        return False
+    return file_path.suffix.lower() in {'.md', '.markdown', '.html', '.htm', '.txt', '.pdf'}
+
+
+def iter_source_files(root_path: Path):
+    """対象拡張子のファイル (隠しファイルを除く)"""
+    for file_path in root_path.rglob('*'):
+        if file_path.is_file() and is_source_file(file_path):
+            yield file_path
+
+
+def resolve_changes(root_path: Path, paths: Set[str], known_sources: Set[str]):
+    """
+    監視で通知されたパスから (確認するファイル, 確認し直すソースパス) を求める
+    ディレクトリ (作成・移動・削除) は、配下のファイルと配下にあった既存のソースに広げる
+    """
+    files: Set[Path] = set()
+    sources: Set[str] = set()
+    for path in paths:
+        path = Path(path)
+        try:
+            rel_path = str(path.relative_to(root_path)).replace("\\", "/")
+        except ValueError:
+            continue
+        sources.update(s for s in known_sources
+                       if s == rel_path or s.startswith(rel_path + "/"))
+        if path.is_dir():
+            files.update(iter_source_files(path))
+        elif path.is_file() and is_source_file(path):
+            files.add(path)
+    sources.update(str(f.relative_to(root_path)).replace("\\", "/") for f in files)
+    return sorted(files), sources
+
+
+def source_extractor() -> CachedExtractor:
+    """抽出結果のキャッシュを通す抽出関数 (ワーカープロセスに渡す)"""
+    return CachedExtractor(extract_text_from_file, Config.EXTRACT_CACHE, "scripts/build_rag_index")
+
+
+def extract_only(root_dir: str):
+    """Embedding を行わずに全ファイルを抽出してキャッシュに入れる"""
+    root_path = Path(root_dir).resolve()
+    text_budget = Config.MAX_TEXT_LENGTH if Config.CHUNK_SIZE <= 0 else None
+    files = [(file_path, None, text_budget) for file_path in iter_source_files(root_path)]
+    print(f"Extracting {len(files)} files with {Config.EXTRACT_WORKERS} worker(s)...")
+    counts = warm_cache(source_extractor(), files, Config.EXTRACT_WORKERS,
+                        Config.EXTRACT_QUEUE_SIZE)
+    print(f"\nCompleted! Extraction cache {Config.EXTRACT_CACHE}: "
+          f"{counts['extracted']} extracted, {counts['cached']} already cached, "
+          f"{counts['empty']} empty, {counts['failed']} failed")
+
+
+def alternates_by_source(docs_map: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """ソースパス -> 他のパッセージの重複として記録されたエントリ (指紋の確認・更新用)"""
+    alternates: Dict[str, List[Dict[str, Any]]] = {}
+    for d in docs_map.values():
+        for a in d.get('alternates', ()):
+            alternates.setdefault(a['source'], []).append(a)
+    return alternates
+
+
+def release_sources(docs_map: Dict[str, Any], sources: set) -> set:
+    """
+    作り直す・削除するファイルの重複記録を外し、
+    それらのパッセージを代表にしていた (自分は Embedding されていない) ファイルを返す
+    """
+    orphans = set()
+    for d in docs_map.values():
+        alternates = d.get('alternates')
+        if not alternates:
+            continue
+        if d['source'] in sources:
+            orphans.update(a['source'] for a in alternates)
+        kept = [a for a in alternates if a['source'] not in sources]
+        if kept:
+            d['alternates'] = kept
+        else:
+            del d['alternates']
+    return orphans - sources
+
+
+def build_index(root_dir: str, output_path: str, use_batch: bool = True,
+                generator: Optional[LocalEmbeddingGenerator] = None,
+                docs_map: Optional[Dict[str, Any]] = None,
+                changed_paths: Optional[Set[str]] = None,
+                dedup: Optional[Deduplicator] = None) -> Dict[str, Any]:
+    """
+    インデックスを差分更新して保存・公開し、保存した内容 (パッセージID -> パッセージ) を返す
+    監視モードでは前回の戻り値を docs_map に渡して読み込みを省き、
+    changed_paths (通知のあったパス) に含まれるファイルだけを確認する
+    dedup は重複判定の登録を次の呼び出しに引き継ぐ場合に渡す
+    """
     root_path = Path(root_dir).resolve()
-    print(f"Target: {root_path}")
-    print(f"Output: {output_path}")
+    if docs_map is None:
+        print(f"Target: {root_path}")
+        print(f"Output: {output_path}")
 
     # 1. レジューム機能: 既存データの読み込み
     existing_docs: Dict[str, Any] = {}
-    if os.path.exists(output_path):
+    if docs_map is not None:
+        existing_docs = docs_map
+    elif os.path.exists(output_path):
         try:
-            with open(output_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # ソースパスをキーにして高速検索可能に
-                existing_docs = {item['source']: item for item in data}
-            print(f"Resume: Loaded {len(existing_docs)} existing documents.")
+            with METRICS.span("load"):
+                data = load_docs_with_embeddings(output_path)
+            # チャンクIDをキーにして保持
+            existing_docs = {item['id']: item for item in data}
+            print(f"Resume: Loaded {len(existing_docs)} existing passages.")
         except Exception:
             print("Resume: No valid existing index found. Starting fresh.")
 
-    # 2. 処理対象ファイルの収集
-    files_to_process = []
-    skipped_count = 0
+    # 前回中断時の追記ログを再生 (本体に未反映の Embedding)
+    log = IndexLog(log_path_for(output_path))
+    replayed = replay_log(log.path, existing_docs) if docs_map is None else 0
+    if replayed:
+        print(f"Resume: Replayed {replayed} files from {log.path}.")
 
-    print("Scanning files...")
-    for file_path in root_path.rglob('*'):
-        if not file_path.is_file():
-            continue
-        if file_path.name.startswith('.'):
-            continue
-        if file_path.suffix.lower() not in {'.md', '.markdown', '.html', '.htm', '.txt', '.pdf'}:
-            continue
+    # ソースパス -> パッセージID一覧
+    ids_by_source: Dict[str, List[str]] = {}
+    for item in existing_docs.values():
+        ids_by_source.setdefault(item['source'], []).append(item['id'])
+    # 全パッセージが重複だったファイルは alternates にだけ記録されている
+    alternates = alternates_by_source(existing_docs)
 
-        rel_path = str(file_path.relative_to(root_path)).replace("\\", "/")
+    new_docs_map = existing_docs.copy()
 
-        # 既にEmbedding済みならスキップ
-        if rel_path in existing_docs and 'embedding' in existing_docs[rel_path]:
-            skipped_count += 1
+    # 2. 処理対象ファイルの収集 (指紋で追加・更新・未変更を判定)
+    files_to_process = []
+    fingerprints: Dict[str, Dict[str, Any]] = {}
+    known_sources = set(ids_by_source) | set(alternates)
+    added_count = updated_count = unchanged_count = 0
+    touched = False
+
+    if changed_paths is None:
+        print("Scanning files...")
+        candidates = iter_source_files(root_path)
+        seen_sources = set()
+    else:
+        # 通知の無かったファイルは変更なしとみなす (ツリー全体は走査しない)
+        candidates, recheck = resolve_changes(root_path, changed_paths, known_sources)
+        seen_sources = known_sources - recheck
+    for file_path in candidates:
+        rel_path = str(file_path.relative_to(root_path)).replace("\\", "/")
+        seen_sources.add(rel_path)
+
+        old_ids = ids_by_source.get(rel_path, [])
+        old_docs = [existing_docs[k] for k in old_ids]
+        entries = old_docs + alternates.get(rel_path, [])
+        complete = bool(entries) and all('embedding' in d for d in old_docs)
+        old_fp = entries[0].get('fingerprint') if complete else None
+        changed, fp = check_fingerprint(old_fp, file_path)
+
+        if not changed:
+            # 内容が同じでも更新時刻が変わっていれば指紋だけ更新
+            if fp is not old_fp:
+                for d in entries:
+                    d['fingerprint'] = fp
+                touched = True
+            unchanged_count += 1
             continue
 
+        if old_docs:
+            updated_count += 1
+        else:
+            added_count += 1
+        fingerprints[rel_path] = fp
         files_to_process.append((file_path, rel_path))
 
-    if not files_to_process:
-        print("All files are already processed! Nothing to do.")
-        return
+    # 削除されたファイルのエントリを除去
+    removed_sources = [src for src in known_sources if src not in seen_sources]
+
+    # 作り直す・削除するファイルのパッセージを代表にしていた重複は、Embedding し直す
+    released = set(removed_sources) | {rel_path for _, rel_path in files_to_process}
+    orphans = release_sources(new_docs_map, released)
+    reembed_count = 0
+    while orphans:
+        for rel_path in sorted(orphans):
+            file_path = root_path / rel_path
+            fingerprints[rel_path] = file_fingerprint(file_path)
+            files_to_process.append((file_path, rel_path))
+        reembed_count += len(orphans)
+        released |= orphans
+        orphans = release_sources(new_docs_map, orphans)
+    unchanged_count -= reembed_count
+
+    for src in removed_sources:
+        for key in ids_by_source.get(src, []):
+            del new_docs_map[key]
+
+    # 重複判定の代表には、作り直さないファイルの既存パッセージを登録しておく
+    # (監視モードでは前回までの登録を引き継ぎ、作り直す・削除したファイルの分だけ外す)
+    if not Config.DEDUP_THRESHOLD:
+        dedup = None
+    else:
+        with METRICS.span("dedup"):
+            if dedup is None or docs_map is None:
+                dedup = dedup or Deduplicator(Config.DEDUP_THRESHOLD)
+                for d in new_docs_map.values():
+                    if d['source'] not in released:
+                        dedup.register(d)
+            else:
+                for src in released:
+                    for key in ids_by_source.get(src, []):
+                        dedup.remove(existing_docs[key])
+        dedup.passages = dedup.duplicates = 0
 
-    print(f"New files to process: {len(files_to_process)} (Skipped: {skipped_count})")
-
-    # 3. Embedding実行
-    generator = LocalEmbeddingGenerator()
-    new_docs_map = existing_docs.copy()
+    print(
+        f"Changes: {added_count} added, {updated_count} updated, "
+        f"{len(removed_sources)} removed, {unchanged_count} unchanged"
+        + (f", {reembed_count} re-embedded (their duplicate was removed)" if reembed_count else "")
+    )
 
+    if not files_to_process:
+        if removed_sources or touched or replayed:
+            saved = compact(new_docs_map, output_path, log)
+            if saved:
+                publish_saved(output_path, saved, bool(new_docs_map))
+        else:
+            # 再生するレコードが無かったログ (書きかけの末尾のみ) を片付ける
+            log.remove()
+            if Config.ANN_KIND != "none" and not os.path.exists(ann_path_for(output_path)):
+                update_ann(output_path)
+            if Config.BUILD_LEXICAL and not os.path.exists(lexical_path_for(output_path)):
+                update_lexical(output_path)
+            if Config.BUNDLE_DIR and read_bundle_manifest(bundle_dir_for(output_path)) is None:
+                update_bundle(output_path, output_path, bool(new_docs_map))
+        print("All files are up to date! Nothing to embed.")
+        return new_docs_map
+
+    # 3. Embedding実行 (抽出はプロセスプールで並行して進む)
+    # モデルは最初のバッチで読み込む (抽出結果が全て空なら読み込まない)
     batch_docs = []
     batch_texts = []
+    # バッチに含まれるファイル (rel_path, パッセージ): Embedding後にログへ追記
+    batch_sources = []
 
     total_files = len(files_to_process)
-
-    for i, (file_path, rel_path) in enumerate(files_to_process):
-        title, text = extract_text_from_file(file_path)
+    print(f"Extracting with {Config.EXTRACT_WORKERS} worker(s)...")
+    # チャンク分割しない場合、PDF は先頭 MAX_TEXT_LENGTH 文字分のページだけ読む
+    text_budget = Config.MAX_TEXT_LENGTH if Config.CHUNK_SIZE <= 0 else None
+    extracted = iter_extracted(
+        source_extractor(),
+        # 指紋の内容ハッシュを渡し、キャッシュのキーのためにファイルを読み直さない
+        [(file_path, fingerprints[rel_path]["hash"], text_budget)
+         for file_path, rel_path in files_to_process],
+        workers=Config.EXTRACT_WORKERS,
+        queue_size=Config.EXTRACT_QUEUE_SIZE,
+        start_method=Config.EXTRACT_START_METHOD,
+    )
+    rel_paths = {file_path: rel_path for file_path, rel_path in files_to_process}
+
+    for i, ((file_path, _, _), result, error) in enumerate(extracted):
+        rel_path = rel_paths[file_path]
+
+        # 同じソースの古いエントリを除去
+        old_ids = ids_by_source.get(rel_path, [])
+        for key in old_ids:
+            new_docs_map.pop(key, None)
+
+        if error is not None:
+            print(f"Warning: Failed to extract {rel_path}: {error}")
+            if old_ids:
+                log.append(rel_path, [])
+            continue
+        (title, text, pages), cached = result
+        if cached:
+            METRICS.incr("extract_cache_hits")
 
         if not text:
             print(f"Skipping empty: {rel_path}")
+            if old_ids:
+                log.append(rel_path, [])
             continue
-
-        if len(text) > Config.MAX_TEXT_LENGTH:
-            text = text[:Config.MAX_TEXT_LENGTH]
+        METRICS.incr("documents")
+        METRICS.incr("bytes", fingerprints[rel_path]["size"])
+        METRICS.incr("chars", len(text))
 
         doc_id = sanitize_filename(rel_path)
         doc = {
@@ -256,65 +622,320 @@ def build_index(root_dir: str, output_path: str, use_batch: bool = True):
             "text": text
         }
 
-        batch_docs.append(doc)
-        batch_texts.append(text)
+        if Config.CHUNK_SIZE > 0:
+            chunks = chunk_document(doc, Config.CHUNK_SIZE, Config.CHUNK_OVERLAP, pages)
+        else:
+            doc["text"] = text[:Config.MAX_TEXT_LENGTH]
+            if pages:
+                doc["page"] = pages[0][1]
+            chunks = [doc]
+
+        for c in chunks:
+            c["fingerprint"] = fingerprints[rel_path]
+        METRICS.incr("passages", len(chunks))
+        if dedup:
+            # 既出のパッセージとほぼ同じものは Embedding せず、代表の alternates に出典を記録
+            n_passages = len(chunks)
+            with METRICS.span("dedup"):
+                chunks = dedup.filter(chunks)
+            METRICS.incr("duplicates", n_passages - len(chunks))
+
+        batch_docs.extend(chunks)
+        batch_texts.extend(str(c["text"]) for c in chunks)
+        batch_sources.append((rel_path, chunks))
+
+        # バッチ実行判定 (バッチサイズ到達)
+        if len(batch_docs) >= Config.BATCH_SIZE:
+            generator = generator or LocalEmbeddingGenerator()
+            embed_batch(generator, batch_docs, batch_texts, new_docs_map)
+            checkpoint(log, batch_sources)
+            print(f"Processed: {i+1}/{total_files} files")
+
+            batch_docs = []
+            batch_texts = []
+            batch_sources = []
+
+    # 残りのバッチ
+    if batch_docs:
+        generator = generator or LocalEmbeddingGenerator()
+        embed_batch(generator, batch_docs, batch_texts, new_docs_map)
+        checkpoint(log, batch_sources)
+        print(f"Processed: {total_files}/{total_files} files")
+
+    # 最終保存 (ログを本体インデックスへまとめる)
+    saved = compact(new_docs_map, output_path, log)
+    if saved:
+        publish_saved(output_path, saved, bool(new_docs_map))
+    if dedup:
+        print(f"\nNear-duplicates: {dedup.duplicates} of {dedup.passages} passages "
+              f"kept only as alternate sources")
+    print(f"\nCompleted! Total passages in index: {len(new_docs_map)}")
+    return new_docs_map
+
+
+def watch(root_dir: str, output_path: str):
+    """
+    モデルを読み込んだまま root_dir を監視し、変更されたファイルだけをインデックスに反映する
+    通知は Config.WATCH_DEBOUNCE 秒途切れるまでまとめ、保存のたびに検索プロセスへ公開する
+    """
+    generator = LocalEmbeddingGenerator()
+    dedup = Deduplicator(Config.DEDUP_THRESHOLD) if Config.DEDUP_THRESHOLD else None
+    docs_map = build_index(root_dir, output_path, generator=generator, dedup=dedup)
+
+    root_path = Path(root_dir).resolve()
+    # 出力 (インデックス・ログ・公開マーカー・一時ファイル・ブラウザ用バンドル) の書き込みは変更として扱わない
+    out_prefixes = tuple(os.path.abspath(p).rstrip("/\\")
+                         for p in (output_path, bundle_dir_for(output_path)))
+
+    def accept(path: str, is_dir: bool) -> bool:
+        if os.path.abspath(path).startswith(out_prefixes):
+            return False
+        return is_dir or is_source_file(Path(path))
+
+    watcher = open_watcher(str(root_path), accept, Config.WATCH_POLL_INTERVAL,
+                           Config.WATCH_POLLING)
+    print(f"\nWatching {root_path} ({watcher.kind}). Press Ctrl+C to stop.")
+    if watcher.kind == "polling" and not Config.WATCH_POLLING:
+        print(f"  (watchdog not installed: scanning every {Config.WATCH_POLL_INTERVAL}s. "
+              f"pip install watchdog for OS file events)")
+    try:
+        for changed in iter_changes(watcher, Config.WATCH_DEBOUNCE):
+            print(f"\n[{time.strftime('%H:%M:%S')}] {len(changed)} changed path(s)")
+            with METRICS.span("watch_update"):
+                docs_map = build_index(root_dir, output_path, generator=generator,
+                                       docs_map=docs_map, changed_paths=changed, dedup=dedup)
+    finally:
+        watcher.close()
+
+
+def embed_batch(generator: LocalEmbeddingGenerator, batch_docs: List[Dict[str, Any]],
+                batch_texts: List[str], docs_map: Dict[str, Any]):
+    """バッチのEmbeddingを生成して docs_map に格納"""
+    with METRICS.span("embed"):
+        vectors = generator.generate_batch(batch_texts)
+    for d, vec in zip(batch_docs, vectors):
+        d['embedding'] = vec
+        docs_map[d['id']] = d
+
+
+def checkpoint(log: IndexLog, sources: List[Any]):
+    """Embedding済みのファイルをログへ追記してディスクに反映 (中断しても失われない)"""
+    with METRICS.span("checkpoint"):
+        for rel_path, chunks in sources:
+            log.append(rel_path, chunks)
+        log.sync()
+
+
+def compact(data_map: Dict[str, Any], path: str, log: IndexLog) -> Optional[str]:
+    """インデックス全体を保存し、成功したら反映済みのログを削除して保存先を返す"""
+    saved = save_output(data_map, path)
+    if saved:
+        log.remove()
+        return saved
+    log.close()
+    print(f"  (Progress kept in {log.path})")
+    return None
+
+
+def publish_saved(output_path: str, saved: str, has_vectors: bool = True):
+    """
+    保存した版にANN・転置インデックスを書き足し、ブラウザ用バンドルを作り直してから検索プロセスに公開する
+    (バイナリ形式は saved が新しい版ディレクトリ、JSON は output_path そのもの)
+    """
+    update_ann(saved)
+    update_lexical(saved)
+    update_bundle(output_path, saved, has_vectors)
+    publish(output_path, None if saved == output_path else os.path.basename(saved))
+
+
+def update_ann(path: str):
+    """保存済みインデックスから検索用ANN構造を再構築"""
+    try:
+        with METRICS.span("build_ann"):
+            ann_path = build_ann_for_index(path, Config.ANN_KIND)
+        if ann_path:
+            print(f"  (ANN index saved: {ann_path})")
+    except Exception as e:
+        print(f"  [Error] Failed to build ANN index: {e}")
 
-        # バッチ実行判定 (バッチサイズ到達 or 最終ファイル)
-        if len(batch_docs) >= Config.BATCH_SIZE or i == total_files - 1:
-            if not batch_docs:
-                continue
 
-            # 生成
-            vectors = generator.generate_batch(batch_texts)
+def update_lexical(path: str):
+    """保存済みインデックスから文字 n-gram の転置インデックスを再構築"""
+    if not Config.BUILD_LEXICAL:
+        return
+    try:
+        with METRICS.span("build_lexical"):
+            lex_path = build_lexical_for_index(path)
+        if lex_path:
+            print(f"  (Lexical index saved: {lex_path})")
+    except Exception as e:
+        print(f"  [Error] Failed to build lexical index: {e}")
 
-            # 格納
-            for d, vec in zip(batch_docs, vectors):
-                d['embedding'] = vec
-                new_docs_map[d['source']] = d
 
-            # 進捗表示
-            print(f"Processed: {i+1}/{total_files} files")
+def bundle_dir_for(output_path: str) -> str:
+    """ブラウザ用バンドルの場所 (--bundle が無ければインデックスと同じディレクトリの rag_bundle/)"""
+    return Config.BUNDLE_DIR or os.path.join(
+        os.path.dirname(output_path.rstrip("/\\")), Config.BUNDLE_DEFAULT_DIR)
 
-            # 定期保存
-            current_batch_idx = i // Config.BATCH_SIZE
-            if current_batch_idx > 0 and current_batch_idx % Config.SAVE_INTERVAL == 0:
-                save_json(new_docs_map, output_path)
 
-            batch_docs = []
-            batch_texts = []
+def update_bundle(output_path: str, saved: str, has_vectors: bool = True):
+    """
+    保存した版からブラウザ用バンドルを作り直す
+    --bundle が無くても前回のバンドルがあれば作り直し (ページが古いバンドルを読み続けないように)、
+    ベクトルが無くなったら削除する
+    """
+    bundle_dir = bundle_dir_for(output_path)
+    previous = read_bundle_manifest(bundle_dir)
+    if not Config.BUNDLE_DIR and previous is None:
+        return
+    try:
+        if not has_vectors:
+            if previous is not None:
+                remove_bundle(bundle_dir)
+                print(f"  (Removed browser bundle {bundle_dir}: index has no vectors)")
+            return
+        dtype = Config.BUNDLE_DTYPE if Config.BUNDLE_DIR else previous.get("dtype", Config.BUNDLE_DTYPE)
+        with METRICS.span("export_bundle"):
+            bundle = export_bundle(saved, bundle_dir, dtype)
+        print(f"  (Browser bundle saved: {bundle_dir}, {bundle['count']} vectors, {bundle['dtype']})")
+    except Exception as e:
+        print(f"  [Error] Failed to export browser bundle: {e}")
+
+
+def save_output(data_map: Dict[str, Any], path: str) -> Optional[str]:
+    """設定された形式でインデックスを保存 (成功したら保存先、失敗したら None)"""
+    with METRICS.span("save"):
+        if Config.OUTPUT_FORMAT == "binary":
+            return save_binary(data_map, path)
+        return save_json(data_map, path)
+
 
-    # 最終保存
-    save_json(new_docs_map, output_path)
-    print(f"\nCompleted! Total documents in index: {len(new_docs_map)}")
+def save_binary(data_map: Dict[str, Any], path: str) -> Optional[str]:
+    """
+    バイナリ形式 (vectors.npy + meta.jsonl + manifest.json) で新しい版ディレクトリに保存
+    公開は publish_saved でANNなどを書き足してから行う
+    """
+    try:
+        manifest = save_index(path, list(data_map.values()), Config.EMBEDDING_MODEL,
+                              dtype=Config.VECTOR_DTYPE, normalize=True,
+                              shards=Config.NUM_SHARDS, publish=False)
+        print("  (Index Auto-Saved)")
+        return os.path.join(path, manifest["build"])
+    except Exception as e:
+        print(f"  [Error] Failed to save binary index: {e}")
+        return None
 
 
-def save_json(data_map: Dict[str, Any], path: str):
+def save_json(data_map: Dict[str, Any], path: str) -> Optional[str]:
     """安全なJSON保存 (一時ファイル経由)"""
     data_list = list(data_map.values())
     tmp_path = path + ".tmp"
     try:
         with open(tmp_path, 'w', encoding='utf-8') as f:
-            json.dump(data_list, f, ensure_ascii=False, indent=2)
+            # バイナリ形式から再開した場合、embedding は ndarray
+            json.dump(data_list, f, ensure_ascii=False, indent=2,
+                      default=lambda o: o.tolist())
 
-        if os.path.exists(path):
-            os.remove(path)
-        os.rename(tmp_path, path)
+        # 置き換えは一度に行う (読み込み中の検索プロセスが空のファイルを見ない)
+        os.replace(tmp_path, path)
         print("  (Index Auto-Saved)")
+        return path
     except Exception as e:
         print(f"  [Error] Failed to save JSON: {e}")
+        return None
 
 
 def main():
     parser = argparse.ArgumentParser(description="RAG Index Builder (Hybrid/Final)")
     parser.add_argument("--root", "-r", default=".", help="Root directory")
     parser.add_argument("--out", "-o", default="rag_index_local.json", help="Output file")
+    parser.add_argument("--chunk-size", type=int, default=Config.CHUNK_SIZE,
+                        help="Passage size in chars (0 = one entry per file)")
+    parser.add_argument("--chunk-overlap", type=int, default=Config.CHUNK_OVERLAP,
+                        help="Overlap between passages in chars")
+    parser.add_argument("--format", choices=["json", "binary"], default=None,
+                        help="Index format (default: binary if --out ends with .idx)")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default=Config.VECTOR_DTYPE,
+                        help="Vector dtype for binary format")
+    parser.add_argument("--shards", type=int, default=Config.NUM_SHARDS,
+                        help="Binary format: split the index into N shards searched in parallel")
+    parser.add_argument("--token-budget", type=int, default=Config.TOKEN_BUDGET,
+                        help="Max padded tokens per encode call (passages are length-bucketed)")
+    parser.add_argument("--quantize", action="store_true",
+                        help="CPU inference with an int8 dynamic-quantized model")
+    parser.add_argument("--extract-cache", default=Config.EXTRACT_CACHE,
+                        help="Directory for cached extracted text, keyed by file content hash")
+    parser.add_argument("--no-extract-cache", action="store_true",
+                        help="Always re-extract text (do not read or write the cache)")
+    parser.add_argument("--extract-only", action="store_true",
+                        help="Only extract text into the cache (no model, no index written)")
+    parser.add_argument("--dedup-threshold", type=float, default=Config.DEDUP_THRESHOLD,
+                        help="Drop passages whose character 5-gram Jaccard similarity to an "
+                             "earlier one is at least this (recorded as alternate sources)")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Embed every passage, including near-duplicates")
+    parser.add_argument("--workers", "-j", type=int, default=Config.EXTRACT_WORKERS,
+                        help="Extraction worker processes (0 = main process only)")
+    parser.add_argument("--ann", choices=("auto", "none") + ANN_KINDS, default=Config.ANN_KIND,
+                        help="Vector search structure saved next to the index")
+    parser.add_argument("--no-lexical", action="store_true",
+                        help="Do not build the character n-gram (BM25) index")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep the model loaded and re-index changed files as they change "
+                             "(OS file events with watchdog installed, otherwise polling)")
+    parser.add_argument("--debounce", type=float, default=Config.WATCH_DEBOUNCE,
+                        help="Watch mode: seconds without file events before re-indexing")
+    parser.add_argument("--poll", action="store_true",
+                        help="Watch mode: always poll instead of OS file events (network drives)")
+    parser.add_argument("--poll-interval", type=float, default=Config.WATCH_POLL_INTERVAL,
+                        help="Watch mode: polling interval in seconds (without watchdog)")
+    parser.add_argument("--bundle", default=None, metavar="DIR",
+                        help="Also export a browser search bundle for new_index.html (e.g. rag_bundle); "
+                             "an existing rag_bundle next to --out is refreshed on every build")
+    parser.add_argument("--bundle-dtype", choices=BUNDLE_DTYPES, default=Config.BUNDLE_DTYPE,
+                        help="Vector dtype of the browser bundle")
+    parser.add_argument("--metrics", default=None, metavar="FILE",
+                        help="Write a JSON summary of stage timings and counters ('-' = stderr)")
     args = parser.parse_args()
 
+    Config.ANN_KIND = args.ann
+    Config.BUILD_LEXICAL = not args.no_lexical
+    Config.BUNDLE_DIR = args.bundle
+    Config.BUNDLE_DTYPE = args.bundle_dtype
+    Config.EXTRACT_WORKERS = args.workers
+    Config.OUTPUT_FORMAT = args.format or ("binary" if args.out.endswith(".idx") else "json")
+    Config.VECTOR_DTYPE = args.dtype
+    Config.NUM_SHARDS = args.shards
+    Config.TOKEN_BUDGET = args.token_budget
+    Config.QUANTIZE = args.quantize
+    Config.EXTRACT_CACHE = None if args.no_extract_cache else args.extract_cache
+    Config.DEDUP_THRESHOLD = None if args.no_dedup else args.dedup_threshold
+    Config.WATCH_DEBOUNCE = args.debounce
+    Config.WATCH_POLL_INTERVAL = args.poll_interval
+    Config.WATCH_POLLING = args.poll
+    if args.watch and args.extract_only:
+        parser.error("--watch and --extract-only cannot be combined")
+    if args.extract_only and not Config.EXTRACT_CACHE:
+        parser.error("--extract-only needs the extraction cache")
+
+    Config.CHUNK_SIZE = args.chunk_size
+    Config.CHUNK_OVERLAP = args.chunk_overlap
+
+    if args.metrics:
+        METRICS.enable()
+
     try:
-        build_index(args.root, args.out)
+        if args.extract_only:
+            extract_only(args.root)
+        elif args.watch:
+            watch(args.root, args.out)
+        else:
+            build_index(args.root, args.out)
     except KeyboardInterrupt:
         print("\nInterrupted by user. Progress saved.")
         sys.exit(0)
+    finally:
+        METRICS.dump(args.metrics)
 
 if __name__ == "__main__":
     main()
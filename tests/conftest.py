@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""リポジトリ直下のモジュールと benchmarks/fakes.py (スタブ) を import できるようにする"""
+
+import os
+import sys
+import json
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+# テスト用インデックスの次元数と本文 (FakeEmbedder で埋め込む)
+DIM = 64
+TEXTS = [
+    "ゼロトラストブラウザは社外の Web サイトを隔離して表示する。",
+    "導入費用はユーザー数に応じた年額ライセンスで決まる。",
+    "管理コンソールからポリシーを一括で配布できる。",
+]
+
+
+@pytest.fixture
+def json_index(tmp_path):
+    """TEXTS を FakeEmbedder で埋め込んだ JSON インデックスのパス"""
+    pytest.importorskip("numpy")
+    from fakes import FakeEmbedder
+
+    vectors = FakeEmbedder(DIM).encode(["passage: " + t for t in TEXTS],
+                                       normalize_embeddings=True)
+    docs = [
+        {"id": f"d{i}", "title": "t", "source": f"s{i}.md", "offset": 0, "text": text,
+         "embedding": vec.tolist()}
+        for i, (text, vec) in enumerate(zip(TEXTS, vectors))
+    ]
+    path = tmp_path / "rag_index.json"
+    path.write_text(json.dumps(docs, ensure_ascii=False), encoding="utf-8")
+    return str(path)
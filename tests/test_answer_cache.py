@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""バッチモード (query_rag.py --batch) の回答キャッシュ"""
+
+import io
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+# query_rag は起動時に sentence_transformers の存在を確認する (モデルは FakeEmbedder を渡す)
+pytest.importorskip("sentence_transformers")
+
+import query_rag  # noqa: E402
+from conftest import DIM  # noqa: E402
+from fakes import FakeEmbedder  # noqa: E402
+from rag_cache import AnswerCache  # noqa: E402
+from rag_watch import publish  # noqa: E402
+
+
+class CountingGenerator:
+    """GeminiGenerationClient の代わりに呼び出し回数を数える"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def stream_generate(self, prompt):
+        self.calls += 1
+        yield "資料によると"
+        yield "年額ライセンスです。"
+
+
+def test_batch_reuses_answer_for_repeated_question(json_index):
+    bot = query_rag.RAGChatbot(json_index, "test-key", embedder=FakeEmbedder(DIM),
+                               mode="dense")
+    bot.wait_until_ready()
+    generator = bot.generator = CountingGenerator()
+
+    question = "導入費用はどう決まりますか"
+    out = io.StringIO()
+    # parallel=1 なので1件目の回答を保存してから2件目を処理する
+    bot.run_batch([{"id": 1, "question": question}, {"id": 2, "question": question}],
+                  out, parallel=1, top_k=2)
+
+    records = {r["id"]: r for r in map(json.loads, out.getvalue().splitlines())}
+    assert generator.calls == 1
+    assert "cached" not in records[1]
+    assert records[2]["cached"] is True
+    assert records[2]["answer"] == records[1]["answer"]
+
+
+def test_reload_invalidates_caches_in_place(json_index):
+    bot = query_rag.RAGChatbot(json_index, "test-key", embedder=FakeEmbedder(DIM),
+                               mode="dense")
+    bot.wait_until_ready()
+    generator = bot.generator = CountingGenerator()
+    question = "導入費用はどう決まりますか"
+    "".join(bot.generate_answer(question, bot.search(question, top_k=2)))
+    query_cache, answer_cache = bot.query_cache, bot.answer_cache
+    assert len(query_cache) == len(answer_cache) == 1
+
+    # ビルダーと同じく、書き換えたインデックスを公開する
+    with open(json_index, encoding="utf-8") as f:
+        docs = json.load(f)
+    with open(json_index, "w", encoding="utf-8") as f:
+        json.dump(docs[:2], f, ensure_ascii=False)
+    publish(json_index)
+    assert bot.reload_if_published()
+
+    assert bot.query_cache is query_cache and bot.answer_cache is answer_cache
+    assert len(query_cache) == len(answer_cache) == 0
+    assert query_cache.version == answer_cache.version == bot.version
+    "".join(bot.generate_answer(question, bot.search(question, top_k=2)))
+    assert generator.calls == 2
+    assert query_cache.stats["misses"] == 2
+
+
+def test_answer_from_previous_version_is_not_stored():
+    cache = AnswerCache(version="v1")
+    cache.invalidate("v2")
+    cache.store("質問", [1.0, 0.0], ["d0"], "回答", version="v1")
+    assert len(cache) == 0
+    cache.store("質問", [1.0, 0.0], ["d0"], "回答", version="v2")
+    assert len(cache) == 1
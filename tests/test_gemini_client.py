@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""GeminiEmbeddingClient の再試行・バックオフ・レート制限 (StubGeminiServer に対して実行)"""
+
+import time
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import rag_gemini  # noqa: E402
+from rag_gemini import GeminiEmbeddingClient, TokenBucket, backoff_delay  # noqa: E402
+from fakes import StubGeminiServer  # noqa: E402
+
+DIM = 16
+# テストではトークンバケットで待たない
+FAST_RPM = 60000
+
+
+def make_client(stub, **kwargs):
+    kwargs.setdefault("requests_per_minute", FAST_RPM)
+    return GeminiEmbeddingClient("test-key", base_url=stub.base_url, **kwargs)
+
+
+def texts(n):
+    return [f"パッセージ {i}" for i in range(n)]
+
+
+def test_one_request_per_batch():
+    with StubGeminiServer(embed_dim=DIM) as stub:
+        client = make_client(stub, batch_size=4)
+        vectors = client.embed(texts(10))
+
+    assert len(vectors) == 10
+    assert all(len(v) == DIM for v in vectors)
+    assert client.stats == {"requests": 3, "rate_limited": 0, "failed_batches": 0}
+    assert stub.embed_requests == 3
+
+
+def test_rate_limited_batches_are_retried_until_success():
+    # Retry-After: 0 なのでバックオフで待たない
+    with StubGeminiServer(embed_dim=DIM, error_rate=0.5, error_status=429,
+                          retry_after=0, seed=1) as stub:
+        client = make_client(stub, batch_size=1, max_retries=20)
+        vectors = client.embed(texts(8))
+
+    assert stub.embed_errors > 0
+    assert all(v is not None for v in vectors)
+    assert client.stats["requests"] == stub.embed_requests == 8 + stub.embed_errors
+    assert client.stats["rate_limited"] == stub.embed_errors
+    assert client.stats["failed_batches"] == 0
+
+
+def test_unavailable_backs_off_then_gives_up(monkeypatch):
+    attempts = []
+
+    def record(attempt, base=1.0, cap=60.0):
+        attempts.append(attempt)
+        return 0.0
+
+    monkeypatch.setattr(rag_gemini, "backoff_delay", record)
+    with StubGeminiServer(embed_dim=DIM, error_rate=1.0, error_status=503) as stub:
+        client = make_client(stub, batch_size=2, max_retries=3)
+        vectors = client.embed(texts(2))
+
+    assert vectors == [None, None]
+    # Retry-After が無いので試行ごとに指数バックオフ、最後の失敗の後は待たない
+    assert attempts == [0, 1, 2]
+    assert stub.embed_requests == client.stats["requests"] == 4
+    # 503 はレート制限として数えない
+    assert client.stats["rate_limited"] == 0
+    assert client.stats["failed_batches"] == 1
+
+
+def test_retry_after_header_overrides_backoff(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("backoff_delay must not be used when Retry-After is present")
+
+    monkeypatch.setattr(rag_gemini, "backoff_delay", fail)
+    with StubGeminiServer(embed_dim=DIM, error_rate=1.0, error_status=429,
+                          retry_after=0.05) as stub:
+        client = make_client(stub, batch_size=1, max_retries=2)
+        start = time.monotonic()
+        vectors = client.embed(texts(1))
+        elapsed = time.monotonic() - start
+
+    assert vectors == [None]
+    assert elapsed >= 0.1
+    assert stub.embed_requests == 3
+    assert client.stats["rate_limited"] == 2
+    assert client.stats["failed_batches"] == 1
+
+
+def test_backoff_delay_is_full_jitter_below_cap():
+    for attempt in range(10):
+        for _ in range(20):
+            assert 0.0 <= backoff_delay(attempt, base=0.5, cap=4.0) <= min(4.0, 0.5 * 2 ** attempt)
+
+
+def test_token_bucket_paces_after_burst():
+    bucket = TokenBucket(600, burst=2)  # 10 回/秒
+
+    async def acquire(n):
+        for _ in range(n):
+            await bucket.acquire()
+
+    start = time.monotonic()
+    asyncio.run(acquire(6))
+    elapsed = time.monotonic() - start
+    # 最初の 2 回はバーストで即時、残り 4 回は 0.1 秒ずつ
+    assert elapsed >= 0.39
+
+
+def test_client_requests_are_paced_by_rate_limit():
+    with StubGeminiServer(embed_dim=DIM) as stub:
+        # concurrency=1 なのでバーストも 1 (1200 回/分 = 0.05 秒間隔)
+        client = make_client(stub, batch_size=1, concurrency=1, requests_per_minute=1200)
+        start = time.monotonic()
+        client.embed(texts(5))
+        elapsed = time.monotonic() - start
+
+    assert stub.embed_requests == 5
+    assert elapsed >= 0.19
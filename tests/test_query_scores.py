@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""検索結果のスコア表示 (hybrid の RRF スコアとコサイン類似度)"""
+
+import io
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("sentence_transformers")
+
+import query_rag  # noqa: E402
+from conftest import DIM  # noqa: E402
+from fakes import FakeEmbedder  # noqa: E402
+from rag_lexical import build_lexical_for_index  # noqa: E402
+
+
+def _bot(index_path, mode):
+    bot = query_rag.RAGChatbot(index_path, "test-key", embedder=FakeEmbedder(DIM), mode=mode)
+    bot.wait_until_ready()
+    return bot
+
+
+def test_hybrid_batch_reports_similarity_and_rrf(json_index):
+    build_lexical_for_index(json_index)
+    bot = _bot(json_index, "hybrid")
+    assert bot.mode == "hybrid"
+
+    out = io.StringIO()
+    bot.run_batch([{"id": 1, "question": "導入費用"}], out, top_k=2, generate=False)
+    sources = json.loads(out.getvalue())["sources"]
+
+    vectors = {d["id"]: d["vector"] for d in bot.search("導入費用", top_k=2)}
+    query = bot.encode_queries(["導入費用"])[0]
+    for s in sources:
+        # score はコサイン類似度、RRF スコアは rrf に分ける
+        assert s["score"] == pytest.approx(float(vectors[s["id"]] @ query), abs=1e-5)
+        # RRF スコアは 2 つの順位リストの 1/(60 + 順位) の和 (2/61 以下)
+        assert 0 < s["rrf"] <= 2 / 61 + 1e-6
+
+
+def test_dense_batch_has_no_rrf(json_index):
+    bot = _bot(json_index, "dense")
+    out = io.StringIO()
+    bot.run_batch([{"id": 1, "question": "導入費用"}], out, top_k=2, generate=False)
+    for s in json.loads(out.getvalue())["sources"]:
+        assert "rrf" not in s
+        assert -1.0 <= s["score"] <= 1.0